@@ -0,0 +1,110 @@
+"""
+Enrollment microbenchmark: the old per-word INSERT + commit loop from
+cmd_start against the single INSERT ... SELECT from enrollment.py.
+
+Needs a separate database with the bot schema and vocabulary (e.g. one
+seeded with seed.py), the bot database itself is refused. Creates
+temporary users with negative tg_id and deletes them and everything the
+triggers made for them afterwards.
+
+    python benchmarks/bench_enrollment.py --dbname azbot_bench --users 200
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from psycopg import AsyncConnection
+from psycopg.conninfo import make_conninfo
+from psycopg.rows import dict_row
+
+import db
+from enrollment import enroll_level
+from secret_constants import POSTGRE_DB_NAME
+
+BENCH_TG_ID_BASE = -900000000
+
+
+async def create_user(conn, tg_id):
+    cursor = await conn.execute(
+        '''INSERT INTO users (tg_id, username, first_name, registration_date)
+        VALUES (%s, %s, %s, %s)
+        RETURNING id''',
+        (tg_id, 'bench', 'bench', datetime.now())
+    )
+    user_id = (await cursor.fetchone())['id']
+    await conn.commit()
+    return user_id
+
+
+async def per_row_enroll(conn, user_id):
+    # Так cmd_start записывал слова раньше: INSERT и commit на каждое слово
+    words = await (await conn.execute('SELECT * FROM vocabulary WHERE level = 1')).fetchall()
+    for word in words:
+        await conn.execute(
+            '''INSERT INTO user_vocabulary (user_id, vocabulary_id, correct_answer_id, num_right_guesses, poll_id)
+            VALUES (%s, %s, %s, %s, %s)
+            ON CONFLICT DO NOTHING''',
+            (user_id, word["id"], -1, 0, None)
+        )
+        await conn.commit()
+    return len(words), len(words)
+
+
+async def bulk_enroll(conn, user_id):
+    added = await enroll_level(conn, user_id, level=1)
+    await conn.commit()
+    return len(added), 1
+
+
+async def run(name, conn, enroll, tg_ids):
+    words = commits = 0
+    started = time.perf_counter()
+    for tg_id in tg_ids:
+        user_id = await create_user(conn, tg_id)
+        added, committed = await enroll(conn, user_id)
+        words += added
+        commits += committed + 1
+    elapsed = time.perf_counter() - started
+    print(
+        f'{name:<10} users={len(tg_ids):<6} words={words:<8} commits={commits:<8} '
+        f'{elapsed:8.3f}s  {len(tg_ids) / elapsed:8.1f} users/s  {commits / elapsed:8.1f} commits/s'
+    )
+
+
+async def cleanup(conn, tg_ids):
+    user_ids = 'SELECT id FROM users WHERE tg_id = ANY(%s)'
+    await conn.execute(f'DELETE FROM user_vocabulary WHERE user_id IN ({user_ids})', (tg_ids,))
+    # Строки user_progress создают триггеры user_vocabulary, в том числе при удалении выше
+    await conn.execute(f'DELETE FROM user_progress WHERE user_id IN ({user_ids})', (tg_ids,))
+    await conn.execute('DELETE FROM users WHERE tg_id = ANY(%s)', (tg_ids,))
+    await conn.commit()
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dbname', required=True, help='database for benchmarks, not the bot one')
+    parser.add_argument('--users', type=int, default=100)
+    args = parser.parse_args()
+    if args.dbname == POSTGRE_DB_NAME:
+        parser.error('--dbname is the bot database, use a separate one')
+
+    conn = await AsyncConnection.connect(make_conninfo(db.pool.conninfo, dbname=args.dbname), row_factory=dict_row)
+    per_row_ids = [BENCH_TG_ID_BASE - i for i in range(args.users)]
+    bulk_ids = [BENCH_TG_ID_BASE - args.users - i for i in range(args.users)]
+    try:
+        await cleanup(conn, per_row_ids + bulk_ids)
+        await run('per-row', conn, per_row_enroll, per_row_ids)
+        await run('bulk', conn, bulk_enroll, bulk_ids)
+    finally:
+        await conn.rollback()
+        await cleanup(conn, per_row_ids + bulk_ids)
+        await conn.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
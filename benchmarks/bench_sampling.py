@@ -0,0 +1,129 @@
+"""
+Random word sampling benchmark: the old row_number() OVER (ORDER BY random())
+filler query from planner.py against the index probes from sampling.py,
+for one user at a time (the fast path after a poll answer) and for a batch
+of users (the scheduled broadcast).
+
+Works on a temporary table with synthetic users, each with --words
+enrolled words, so nothing in the bot tables is touched:
+
+    python benchmarks/bench_sampling.py --users 200 --words 2000
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from psycopg import AsyncConnection
+from psycopg.rows import dict_row
+
+import db
+from sampling import pivots, sample_sql
+
+TABLE = 'bench_user_vocabulary'
+CONDITION = 'num_right_guesses < 10 AND due_at > %(now)s'
+
+SETUP_SQL = [
+    f'''
+    CREATE TEMP TABLE {TABLE} (
+        user_id bigint NOT NULL,
+        vocabulary_id bigint NOT NULL,
+        num_right_guesses integer NOT NULL,
+        due_at timestamp NOT NULL
+    )
+    ''',
+    f'''
+    INSERT INTO {TABLE}
+    SELECT user_id, vocabulary_id, floor(random() * 14)::integer - 1,
+        NOW() + (random() - 0.5) * interval '24 hours'
+    FROM generate_series(1, %(users)s) AS user_id
+    CROSS JOIN generate_series(1, %(words)s) AS vocabulary_id
+    ''',
+    f'CREATE INDEX ON {TABLE} (user_id, vocabulary_id)',
+    f'ANALYZE {TABLE}',
+]
+
+TARGET = 'WITH target AS (SELECT unnest(%(ids)s::bigint[]) AS id) '
+
+# Прежний вариант из planner.py
+ORDER_BY_RANDOM_SQL = TARGET + f'''
+    SELECT user_id, vocabulary_id, num_right_guesses
+    FROM (
+        SELECT user_id, vocabulary_id, num_right_guesses,
+            row_number() OVER (PARTITION BY user_id ORDER BY random()) AS pick
+        FROM {TABLE}
+        JOIN target ON {TABLE}.user_id = target.id
+        WHERE {CONDITION}
+    ) AS shuffled
+    WHERE pick <= %(count)s
+'''
+
+SAMPLE_SQL = TARGET + sample_sql(CONDITION, table=TABLE)
+
+
+def params(ids, count, words):
+    return {
+        'ids': ids,
+        'count': count,
+        'now': datetime.now(),
+        'pivots': pivots(count, words + 1),
+        'pivot_range': words + 1,
+    }
+
+
+async def measure(conn, name, query, batches, count, words):
+    rows = 0
+    started = time.perf_counter()
+    for ids in batches:
+        rows += len(await (await conn.execute(query, params(ids, count, words))).fetchall())
+    elapsed = time.perf_counter() - started
+    plan = (await (await conn.execute(
+        'EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ' + query, params(batches[0], count, words)
+    )).fetchone())['QUERY PLAN'][0]
+    buffers = plan['Plan'].get('Shared Hit Blocks', 0) + plan['Plan'].get('Shared Read Blocks', 0)
+    buffers += plan['Plan'].get('Local Hit Blocks', 0) + plan['Plan'].get('Local Read Blocks', 0)
+    print(
+        f'{name:<16}{len(batches):>6} queries {elapsed / len(batches) * 1000:>9.2f} ms/query '
+        f'{rows / len(batches):>9.1f} rows/query {buffers:>8} blocks'
+    )
+    return elapsed / len(batches)
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--words', type=int, default=2000, help='enrolled words per user')
+    parser.add_argument('--count', type=int, default=10, help='words to sample per user')
+    parser.add_argument('--rounds', type=int, default=200, help='single-user queries')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    conn = await AsyncConnection.connect(db.pool.conninfo, row_factory=dict_row, autocommit=True)
+    try:
+        for statement in SETUP_SQL:
+            await conn.execute(statement, {'users': args.users, 'words': args.words} if '%(' in statement else None)
+        print(f'{args.users} users x {args.words} words, sampling {args.count} per user\n')
+        results = {}
+        single = [[random.randint(1, args.users)] for _ in range(args.rounds)]
+        batch = [list(range(1, args.users + 1))]
+        for label, batches in (('single user', single), (f'{args.users} users', batch)):
+            print(label)
+            old = await measure(conn, 'ORDER BY random()', ORDER_BY_RANDOM_SQL, batches, args.count, args.words)
+            new = await measure(conn, 'index probes', SAMPLE_SQL, batches, args.count, args.words)
+            print(f'speedup {old / new:.1f}x\n')
+            results[label] = {'order_by_random_ms': old * 1000, 'index_probes_ms': new * 1000}
+        if args.json:
+            with open(args.json, 'w') as file:
+                json.dump({'users': args.users, 'words': args.words, 'count': args.count, 'results': results}, file, indent=2)
+    finally:
+        await conn.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
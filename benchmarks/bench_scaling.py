@@ -0,0 +1,167 @@
+"""
+Scaling benchmark: seeds the database from seed.py up to every size in
+--sizes and times the bot's main paths against the local fake Telegram:
+
+- send_messages for one user (the "Ещё слово" button), --samples users;
+- poll_answer round trips for polls those calls sent;
+- send_statistics_by_ids for one user and for everybody;
+- adm_statistics (the admin button, after a dashboard refresh);
+- a full scheduled send_messages broadcast.
+
+    createdb azbot_bench
+    python benchmarks/bench_scaling.py --dbname azbot_bench --sizes 1000 10000 100000 --json scaling.json
+
+The bot's handlers change the data, so runs are comparable only on a fresh
+database. Telegram limits are lifted by default (--telegram-rate), so the
+broadcast shows the database and bot side only.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import seed
+from fake_telegram import FakeTelegram
+from load_test import message_update, percentile, poll_answer_update
+from secret_constants import POSTGRE_DB_NAME
+
+update_ids = itertools.count(1)
+
+
+def summary(latencies):
+    if not latencies:
+        return {'count': 0}
+    return {
+        'count': len(latencies),
+        'mean_ms': sum(latencies) / len(latencies) * 1000,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'max_ms': max(latencies) * 1000,
+    }
+
+
+async def timed(coroutine):
+    started = time.perf_counter()
+    await coroutine
+    return time.perf_counter() - started
+
+
+async def measure(bot_main, fake, tg_ids, args):
+    from aiogram import types
+    from constants import ADMINS, Keyboard
+
+    async def process_update(update):
+        await bot_main.dp.process_update(types.Update.to_object({'update_id': next(update_ids), **update}))
+
+    results = {}
+    results['send_messages'] = summary([await timed(bot_main.send_messages(tg_id)) for tg_id in tg_ids])
+
+    answers = []
+    for tg_id in tg_ids:
+        if fake.polls[tg_id]:
+            poll_id, correct_option_id, options = fake.polls[tg_id].pop()
+            answers.append(await timed(process_update(poll_answer_update(tg_id, poll_id, correct_option_id))))
+    results['poll_answer'] = summary(answers)
+
+    results['send_statistics'] = summary([await timed(bot_main.send_statistics_by_ids([tg_id])) for tg_id in tg_ids])
+    # Пустой список, как у шардовой задачи: отчёт всем незаблокированным
+    results['send_statistics_all'] = {'seconds': await timed(bot_main.send_statistics_by_ids([]))}
+
+    refresh = await timed(bot_main.dashboard.refresh())
+    results['adm_statistics'] = summary([
+        await timed(process_update(message_update(ADMINS[0], Keyboard.ADM_STAT.value)))
+        for _ in range(args.admin_rounds)
+    ])
+    results['adm_statistics']['refresh_seconds'] = refresh
+
+    if not args.skip_broadcast:
+        users = len(bot_main.identities.active_tg_ids())
+        seconds = await timed(bot_main.send_messages(silent=True))
+        results['broadcast'] = {'users': users, 'seconds': seconds, 'users_per_second': users / seconds}
+    return results
+
+
+def report(size, results):
+    print(f'\n{size} users')
+    print(f'{"path":<22}{"count":>8}{"mean ms":>10}{"p50 ms":>10}{"p95 ms":>10}{"max ms":>10}')
+    for name, result in results.items():
+        if 'mean_ms' in result:
+            print(
+                f'{name:<22}{result["count"]:>8}'
+                + ''.join(f'{result[key]:>10.1f}' for key in ('mean_ms', 'p50_ms', 'p95_ms', 'max_ms'))
+            )
+        elif 'seconds' in result:
+            rate = f'  {result["users_per_second"]:.1f} users/s' if 'users_per_second' in result else ''
+            print(f'{name:<22}{result["seconds"]:>17.2f} s{rate}')
+
+
+async def run(args):
+    fake = FakeTelegram(latency_ms=args.latency_ms)
+    url = await fake.start(port=args.port)
+    # Настройки читаются при импорте, поэтому main импортируем после них
+    os.environ['TELEGRAM_API_SERVER'] = url
+    os.environ['TELEGRAM_GLOBAL_RATE'] = str(args.telegram_rate)
+    os.environ['TELEGRAM_PER_CHAT_INTERVAL'] = '0'
+    os.environ['SHARD_WORKER_IN_BOT'] = '0'
+    from aiogram import Bot, Dispatcher
+    import main as bot_main
+
+    seed.use_database(args.dbname)
+    Bot.set_current(bot_main.bot)
+    Dispatcher.set_current(bot_main.dp)
+    await bot_main.on_startup(bot_main.dp)
+    runs = []
+    try:
+        for size in sorted(args.sizes):
+            seeded = await seed.seed(size, args.vocabulary, args.per_user, args.blocked, args.days, args.batch)
+            await bot_main.content.load()
+            await bot_main.identities.load()
+            active = bot_main.identities.active_tg_ids()
+            tg_ids = random.sample(active, min(args.samples, len(active)))
+            results = await measure(bot_main, fake, tg_ids, args)
+            report(size, results)
+            runs.append({'users': size, 'seed': seeded, 'results': results})
+    finally:
+        await bot_main.on_shutdown(bot_main.dp)
+        await (await bot_main.bot.get_session()).close()
+        await fake.stop()
+    print(f'\nTelegram calls: {dict(fake.calls)}')
+    return runs
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    seed.add_arguments(parser)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000], help='numbers of users')
+    parser.add_argument('--samples', type=int, default=100, help='users for the per-user paths')
+    parser.add_argument('--admin-rounds', type=int, default=20)
+    parser.add_argument('--skip-broadcast', action='store_true')
+    parser.add_argument('--telegram-rate', type=float, default=100000, help='global Telegram calls per second')
+    parser.add_argument('--latency-ms', type=float, default=0, help='fake Telegram latency')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+    # Проверяем до запуска fake Telegram и импорта бота; use_database тоже откажет
+    if args.dbname == POSTGRE_DB_NAME:
+        parser.error('--dbname is the bot database, use a separate one')
+    runs = asyncio.run(run(args))
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump({
+                'vocabulary': args.vocabulary,
+                'per_user': args.per_user,
+                'blocked': args.blocked,
+                'samples': args.samples,
+                'runs': runs,
+            }, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+"""
+Transcription benchmark: the letter-by-letter transcription_inner that
+main.py used before against transcription.transcribe (compiled rule
+table, with and without the LRU cache) over the whole vocabulary.
+
+    python benchmarks/bench_transcription.py            # words from the database
+    python benchmarks/bench_transcription.py --synthetic 5000
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from constants import transcribe_az_dict
+from transcription import transcribe
+
+
+def transcription_inner(word: str):
+    # Прежняя реализация из main.py, оставлена для сравнения
+    transcription = ''
+    is_start = True
+    is_end = False
+    count = 0
+    letter_after = word[1]
+    letter_before = ''
+    for letter in word:
+        transcribe_part = ''
+        is_transcribed = False
+        letter = letter.lower()
+        is_end = (count == len(word) - 1)
+        if not is_end:
+            letter_after = word[count + 1]
+        if not is_start:
+            letter_before = word[count - 1]
+        if letter in transcribe_az_dict:
+            transcription_rule = transcribe_az_dict[letter]
+            if is_start & ('start' in transcription_rule):
+                transcribe_part = transcription_rule['start']
+                is_transcribed = True
+            if 'after' in transcription_rule:
+                for key in transcription_rule['after']:
+                    if letter_before in key:
+                        transcribe_part = transcription_rule['after'][key]
+                        is_transcribed = True
+            if 'before' in transcription_rule:
+                for key in transcription_rule['before']:
+                    if letter_after in key:
+                        transcribe_part = transcription_rule['before'][key]
+                        is_transcribed = True
+            if not is_transcribed:
+                transcribe_part = transcription_rule['regular']
+        else:
+            transcribe_part = letter
+        transcription += transcribe_part
+        is_start = False
+        count += 1
+    return transcription
+
+
+async def vocabulary_words():
+    import db
+    await db.open_pool()
+    try:
+        rows = await db.fetchall('SELECT word_az FROM vocabulary')
+    finally:
+        await db.close_pool()
+    return [row['word_az'] for row in rows]
+
+
+def synthetic_words(count):
+    letters = list(transcribe_az_dict)
+    return [''.join(random.choice(letters) for _ in range(random.randint(2, 10))) for _ in range(count)]
+
+
+def measure(name, function, words, rounds):
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for word in words:
+            function(word)
+    elapsed = time.perf_counter() - started
+    calls = rounds * len(words)
+    print(f'{name:<22}{calls / elapsed:>14,.0f} words/s{elapsed / calls * 1e6:>10.2f} us/word')
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--synthetic', type=int, default=0, help='use N random words instead of the database')
+    parser.add_argument('--rounds', type=int, default=20)
+    args = parser.parse_args()
+
+    words = synthetic_words(args.synthetic) if args.synthetic else asyncio.run(vocabulary_words())
+    # Прежняя функция падала на однобуквенных словах
+    words = [word for word in words if len(word) > 1]
+    mismatches = [word for word in words if transcription_inner(word) != transcribe(word)]
+    print(f'{len(words)} words, {len(mismatches)} differ from the old transcription {mismatches[:10]}')
+
+    legacy = measure('transcription_inner', transcription_inner, words, args.rounds)
+    compiled = measure('compiled, no cache', transcribe.__wrapped__, words, args.rounds)
+    transcribe.cache_clear()
+    cached = measure('compiled + lru_cache', transcribe, words, args.rounds)
+    print(f'\nspeedup: {legacy / compiled:.1f}x compiled, {legacy / cached:.1f}x with cache')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+"""
+Plan regression check for the hot queries: runs EXPLAIN (ANALYZE, BUFFERS)
+for every per-user statement of main.py and the modules it calls against a
+seeded database and fails (exit code 1) when a query reads a big table with
+a sequential scan or touches more rows than its budget.
+
+Needs a separate database the bot user can write to. Migrations and the
+module schemas are applied, synthetic users and words from seed.py are
+added while the database has fewer than --users of them:
+
+    createdb azbot_explain
+    python benchmarks/explain_check.py --dbname azbot_explain --users 2000
+
+Every statement runs in a transaction that is rolled back, so the data
+stays the same between runs. tests/test_explain.py runs the same checks
+under pytest when EXPLAIN_DBNAME names such a database.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+from collections import namedtuple
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import dashboard
+import db
+import main
+import seed
+from enrollment import ENROLL_LEVEL_SQL, ENROLL_NEXT_WORDS_SQL
+from planner import CANDIDATES_PER_STAGE, USERS_PLAN_SQL
+from poll_registry import POLL_BY_ID_SQL
+from progress_buffer import FLUSH_SQL
+from sampling import pivots
+from user_stats import USERS_STATISTICS_SQL
+
+# Таблицы, растущие с числом пользователей: по ним Seq Scan в горячем запросе — ошибка.
+# vocabulary, lessons и stage_intervals маленькие, их читать целиком можно.
+BIG_TABLES = {'users', 'user_vocabulary', 'user_progress', 'outbox', 'shard_jobs'}
+
+Check = namedtuple('Check', ['name', 'query', 'params', 'max_rows'])
+
+
+async def sample():
+    """
+    A random active user with words and one of their words carrying a poll.
+    """
+    user = await db.fetchone('''
+        SELECT users.id, users.tg_id FROM users
+        WHERE is_blocked = false AND EXISTS (SELECT 1 FROM user_vocabulary WHERE user_id = users.id)
+        ORDER BY random() LIMIT 1
+    ''')
+    word = await db.fetchone(
+        'SELECT vocabulary_id FROM user_vocabulary WHERE user_id = %s ORDER BY random() LIMIT 1', (user['id'],)
+    )
+    poll_id = f'explain-{user["id"]}-{word["vocabulary_id"]}'
+    await db.execute(main.SAVE_POLL_SQL, (1, poll_id, user['id'], word['vocabulary_id']))
+    pivot_range = (await db.fetchone('SELECT COALESCE(MAX(id), 0) + 1 AS max FROM vocabulary'))['max']
+    return user, word['vocabulary_id'], poll_id, pivot_range
+
+
+def checks(user, vocabulary_id, poll_id, pivot_range, vocabulary):
+    target = {'user_ids': [user['id']], 'tg_ids': [user['tg_id']]}
+    now = datetime.now()
+    return [
+        Check('plan next action', USERS_PLAN_SQL, {
+            **target,
+            'now': now,
+            'candidates': CANDIDATES_PER_STAGE,
+            'pivots': pivots(CANDIDATES_PER_STAGE, pivot_range),
+            'pivot_range': pivot_range,
+        }, 2000),
+        Check('user statistics', USERS_STATISTICS_SQL, target, 10),
+        Check('poll by id', POLL_BY_ID_SQL, (poll_id,), 10),
+        Check('save poll', main.SAVE_POLL_SQL, (1, poll_id, user['id'], vocabulary_id), 10),
+        Check('progress flush', FLUSH_SQL, ([user['id']], [vocabulary_id], [None], [1], [now]), 10),
+        Check('old words back', main.OLD_WORDS_BACK_SQL, (user['id'],), 1000),
+        Check('enroll next words', ENROLL_NEXT_WORDS_SQL, {'user_id': user['id'], 'limit': 20}, vocabulary * 3),
+        Check('enroll level', ENROLL_LEVEL_SQL, (user['id'], 1), vocabulary * 3),
+        Check('register user', main.REGISTER_USER_SQL, (user['tg_id'], 'explain', 'Explain', now), 10),
+        Check('mark blocked', main.MARK_BLOCKED_SQL, (user['tg_id'],), 10),
+        Check('fresh registrations', dashboard.FRESH_REGISTERED_SQL, None, 100),
+    ]
+
+
+def walk(node):
+    yield node
+    for child in node.get('Plans', ()):
+        yield from walk(child)
+
+
+def inspect(plan):
+    """
+    (rows read from tables, sequential scans of big tables) for a JSON plan.
+    """
+    rows = 0
+    seq_scans = []
+    for node in walk(plan['Plan']):
+        if 'Relation Name' not in node:
+            continue
+        loops = node.get('Actual Loops', 1)
+        rows += (node.get('Actual Rows', 0) + node.get('Rows Removed by Filter', 0)) * loops
+        if node['Node Type'] == 'Seq Scan' and node['Relation Name'] in BIG_TABLES:
+            seq_scans.append(node['Relation Name'])
+    return rows, seq_scans
+
+
+async def explain(conn, check):
+    try:
+        cursor = await conn.execute('EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ' + check.query, check.params)
+        return (await cursor.fetchone())['QUERY PLAN'][0]
+    finally:
+        await conn.rollback()
+
+
+async def run(args):
+    await seed.prepare()
+    await seed.seed(args.users, args.vocabulary, args.per_user, args.blocked, args.days, args.batch)
+    user, vocabulary_id, poll_id, pivot_range = await sample()
+    vocabulary = (await db.fetchone('SELECT COUNT(*) AS count FROM vocabulary'))['count']
+    results = []
+    async with db.pool.connection() as conn:
+        for check in checks(user, vocabulary_id, poll_id, pivot_range, vocabulary):
+            plan = await explain(conn, check)
+            rows, seq_scans = inspect(plan)
+            problems = [f'Seq Scan on {table}' for table in seq_scans]
+            if rows > check.max_rows:
+                problems.append(f'{rows} rows > budget {check.max_rows}')
+            results.append({
+                'name': check.name,
+                'ms': plan['Execution Time'],
+                'rows': rows,
+                'max_rows': check.max_rows,
+                'problems': problems,
+            })
+            status = 'FAIL ' + ', '.join(problems) if problems else 'ok'
+            print(f'{check.name:<22}{plan["Execution Time"]:>9.2f} ms {rows:>8} rows  {status}')
+            if problems and args.verbose:
+                print(json.dumps(plan, indent=2, default=str))
+    return results
+
+
+async def start(args):
+    seed.use_database(args.dbname, max_size=2)
+    await db.open_pool()
+    try:
+        return await run(args)
+    finally:
+        await db.close_pool()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser()
+    seed.add_arguments(parser)
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('--verbose', action='store_true', help='print plans of failed queries')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    results = asyncio.run(start(args))
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(results, file, indent=2)
+    failed = [result['name'] for result in results if result['problems']]
+    if failed:
+        print(f'\n{len(failed)} of {len(results)} queries failed: {", ".join(failed)}')
+        sys.exit(1)
+    print(f'\nAll {len(results)} queries within budget')
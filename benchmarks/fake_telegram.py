@@ -0,0 +1,209 @@
+"""
+Local stand-in for the Telegram Bot API, enough for what main.py calls:
+getMe, sendMessage, sendPoll, sendPhoto, deleteMessage, getUpdates,
+setWebhook / deleteWebhook.
+
+Errors and latency can be injected to see how the bot copes with them:
+
+    python benchmarks/fake_telegram.py --port 8081 --latency-ms 30 \
+        --retry-after-rate 0.01 --blocked-rate 0.001
+
+and start the bot with TELEGRAM_API_SERVER=http://127.0.0.1:8081.
+Updates pushed with FakeTelegram.push_update() are returned by getUpdates
+or, once setWebhook was called, posted to the webhook with its secret token.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import random
+import time
+from collections import Counter, defaultdict
+
+from aiohttp import ClientSession, web
+
+
+logger = logging.getLogger('fake_telegram')
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'Fake', 'username': 'fake_bot'}
+
+
+class FakeTelegram:
+
+    def __init__(self, latency_ms=0, retry_after_rate=0.0, retry_after=1, blocked_rate=0.0, blocked_chats=()):
+        self.latency_ms = latency_ms
+        self.retry_after_rate = retry_after_rate
+        self.retry_after = retry_after
+        self.blocked_rate = blocked_rate
+        self.blocked_chats = set(blocked_chats)
+        self.calls = Counter()
+        self.errors = Counter()
+        # chat_id -> последние отправленные опросы: (poll_id, correct_option_id, количество вариантов)
+        self.polls = defaultdict(list)
+        self.messages = defaultdict(list)
+        self.webhook_url = None
+        self.webhook_secret = None
+        self._message_ids = itertools.count(1)
+        self._poll_ids = itertools.count(1)
+        self._update_ids = itertools.count(1)
+        self._updates = asyncio.Queue()
+        self._runner = None
+
+    def make_app(self):
+        app = web.Application()
+        app.router.add_route('*', '/bot{token}/{method}', self.handle)
+        return app
+
+    async def start(self, host='127.0.0.1', port=8081):
+        self._runner = web.AppRunner(self.make_app())
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        logger.info(f'Fake Telegram listening on http://{host}:{port}')
+        return f'http://{host}:{port}'
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    async def push_update(self, update):
+        update = {'update_id': next(self._update_ids), **update}
+        if self.webhook_url:
+            headers = {'X-Telegram-Bot-Api-Secret-Token': self.webhook_secret} if self.webhook_secret else {}
+            async with ClientSession() as session:
+                async with session.post(self.webhook_url, json=update, headers=headers) as response:
+                    return response.status
+        await self._updates.put(update)
+
+    async def handle(self, request):
+        method = request.match_info['method']
+        params = await self._params(request)
+        self.calls[method] += 1
+        if self.latency_ms:
+            await asyncio.sleep(self.latency_ms / 1000)
+        chat_id = params.get('chat_id')
+        if chat_id is not None:
+            chat_id = int(chat_id)
+            error = self._injected_error(chat_id)
+            if error is not None:
+                self.errors[error['error_code']] += 1
+                return web.json_response(error, status=error['error_code'])
+        handler = getattr(self, f'method_{method.lower()}', None)
+        if handler is None:
+            return web.json_response({'ok': False, 'error_code': 404, 'description': 'Not Found: method not found'}, status=404)
+        return web.json_response({'ok': True, 'result': await handler(chat_id, params)})
+
+    async def _params(self, request):
+        if request.content_type == 'application/json':
+            params = await request.json()
+        else:
+            params = dict(await request.post())
+        for key in ('options', 'reply_markup'):
+            if isinstance(params.get(key), str):
+                params[key] = json.loads(params[key])
+        return params
+
+    def _injected_error(self, chat_id):
+        if chat_id in self.blocked_chats or random.random() < self.blocked_rate:
+            self.blocked_chats.add(chat_id)
+            return {'ok': False, 'error_code': 403, 'description': 'Forbidden: bot was blocked by the user'}
+        if random.random() < self.retry_after_rate:
+            return {
+                'ok': False,
+                'error_code': 429,
+                'description': f'Too Many Requests: retry after {self.retry_after}',
+                'parameters': {'retry_after': self.retry_after},
+            }
+        return None
+
+    def _message(self, chat_id, **fields):
+        message = {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': BOT_USER,
+            **fields,
+        }
+        self.messages[chat_id].append(message)
+        return message
+
+    async def method_getme(self, chat_id, params):
+        return BOT_USER
+
+    async def method_sendmessage(self, chat_id, params):
+        return self._message(chat_id, text=params.get('text', ''))
+
+    async def method_sendphoto(self, chat_id, params):
+        return self._message(chat_id, photo=[{'file_id': 'photo', 'file_unique_id': 'photo', 'width': 1, 'height': 1}])
+
+    async def method_sendpoll(self, chat_id, params):
+        poll_id = str(next(self._poll_ids))
+        options = params.get('options', [])
+        correct_option_id = int(params.get('correct_option_id', 0))
+        self.polls[chat_id].append((poll_id, correct_option_id, len(options)))
+        return self._message(chat_id, poll={
+            'id': poll_id,
+            'question': params.get('question', ''),
+            'options': [{'text': option, 'voter_count': 0} for option in options],
+            'total_voter_count': 0,
+            'is_closed': False,
+            'is_anonymous': False,
+            'type': params.get('type', 'quiz'),
+            'allows_multiple_answers': False,
+            'correct_option_id': correct_option_id,
+        })
+
+    async def method_deletemessage(self, chat_id, params):
+        return True
+
+    async def method_setwebhook(self, chat_id, params):
+        self.webhook_url = params.get('url') or None
+        self.webhook_secret = params.get('secret_token')
+        return True
+
+    async def method_deletewebhook(self, chat_id, params):
+        self.webhook_url = None
+        return True
+
+    async def method_getupdates(self, chat_id, params):
+        timeout = float(params.get('timeout', 0) or 0)
+        updates = []
+        try:
+            updates.append(await asyncio.wait_for(self._updates.get(), timeout) if timeout else self._updates.get_nowait())
+        except (asyncio.TimeoutError, asyncio.QueueEmpty):
+            return []
+        while not self._updates.empty() and len(updates) < int(params.get('limit', 100) or 100):
+            updates.append(self._updates.get_nowait())
+        return updates
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency-ms', type=float, default=0)
+    parser.add_argument('--retry-after-rate', type=float, default=0)
+    parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--blocked-rate', type=float, default=0)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    fake = FakeTelegram(
+        latency_ms=args.latency_ms,
+        retry_after_rate=args.retry_after_rate,
+        retry_after=args.retry_after,
+        blocked_rate=args.blocked_rate,
+    )
+    await fake.start(args.host, args.port)
+    try:
+        while True:
+            await asyncio.sleep(60)
+            logger.info(f'Calls: {dict(fake.calls)}, errors: {dict(fake.errors)}')
+    finally:
+        await fake.stop()
+
+
+if __name__ == '__main__':
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,185 @@
+"""
+Load generator for the dispatcher. Simulated users send /start, tap
+"Ещё слово" and answer the polls the bot sends them; the bot talks to the
+local fake Telegram from fake_telegram.py. Reports p50/p95/p99 handler
+latency per update kind and overall throughput.
+
+In-process (default): main.dp handles the updates directly against a
+separate database given with --dbname (the bot database is refused).
+
+    createdb azbot_bench
+    python benchmarks/seed.py --dbname azbot_bench --users 0
+    python benchmarks/load_test.py --dbname azbot_bench --users 1000 --actions 10 --concurrency 100
+
+Webhook: start the bot separately with BOT_MODE=webhook,
+TELEGRAM_API_SERVER=http://127.0.0.1:8081 and WEBHOOK_URL pointing at it;
+updates are then posted to the webhook by the fake server.
+
+    python benchmarks/load_test.py --webhook --port 8081 --users 200
+
+Test users get tg_id below --tg-id-base. In-process they are deleted
+afterwards together with their words, progress and outbox rows.
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import random
+import sys
+import time
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import seed
+from fake_telegram import FakeTelegram
+from secret_constants import POSTGRE_DB_NAME
+
+MORE_WORDS = 'Ещё слово'
+message_ids = itertools.count(1)
+
+
+def user(tg_id):
+    return {'id': tg_id, 'is_bot': False, 'first_name': 'Load', 'username': f'load{abs(tg_id)}'}
+
+
+def message_update(tg_id, text):
+    message = {
+        'message_id': next(message_ids),
+        'date': int(time.time()),
+        'chat': {'id': tg_id, 'type': 'private'},
+        'from': user(tg_id),
+        'text': text,
+    }
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return {'message': message}
+
+
+def poll_answer_update(tg_id, poll_id, option):
+    return {'poll_answer': {'poll_id': poll_id, 'user': user(tg_id), 'option_ids': [option]}}
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(percent / 100 * len(values)) - 1))
+    return values[index]
+
+
+def report(latencies, errors, elapsed):
+    total = sum(len(values) for values in latencies.values())
+    print(f'{"update":<12}{"count":>8}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}{"max ms":>10}')
+    for kind, values in sorted(latencies.items()):
+        print(
+            f'{kind:<12}{len(values):>8}'
+            + ''.join(f'{percentile(values, p) * 1000:>10.1f}' for p in (50, 95, 99, 100))
+        )
+    print(f'\n{total} updates in {elapsed:.1f}s: {total / elapsed:.1f} updates/s, {sum(errors.values())} errors {dict(errors)}')
+
+
+async def cleanup(db, tg_ids):
+    user_ids = 'SELECT id FROM users WHERE tg_id = ANY(%s)'
+    await db.execute('DELETE FROM outbox WHERE chat_id = ANY(%s)', (tg_ids,))
+    await db.execute(f'DELETE FROM user_vocabulary WHERE user_id IN ({user_ids})', (tg_ids,))
+    # Строки user_progress создают триггеры user_vocabulary, в том числе при удалении выше
+    await db.execute(f'DELETE FROM user_progress WHERE user_id IN ({user_ids})', (tg_ids,))
+    await db.execute('DELETE FROM users WHERE tg_id = ANY(%s)', (tg_ids,))
+
+
+async def run(args):
+    fake = FakeTelegram(
+        latency_ms=args.latency_ms,
+        retry_after_rate=args.retry_after_rate,
+        blocked_rate=args.blocked_rate,
+    )
+    url = await fake.start(port=args.port)
+    os.environ['TELEGRAM_API_SERVER'] = url
+
+    if args.webhook:
+        print('Waiting for the bot to register its webhook...')
+        while not fake.webhook_url:
+            await asyncio.sleep(0.5)
+        process_update = fake.push_update
+        db = None
+    else:
+        # Плановые рассылки не нужны, shard_jobs остаются нетронутыми
+        os.environ['SHARD_WORKER_IN_BOT'] = '0'
+        from aiogram import Bot, Dispatcher, types
+        import main as bot_main
+        import db
+        seed.use_database(args.dbname)
+        Bot.set_current(bot_main.bot)
+        Dispatcher.set_current(bot_main.dp)
+        await bot_main.on_startup(bot_main.dp)
+
+        async def process_update(update):
+            update = {'update_id': next(message_ids), **update}
+            await bot_main.dp.process_update(types.Update.to_object(update))
+
+    latencies = defaultdict(list)
+    errors = defaultdict(int)
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def send(kind, update):
+        started = time.perf_counter()
+        try:
+            await process_update(update)
+        except Exception as e:
+            errors[type(e).__name__] += 1
+        latencies[kind].append(time.perf_counter() - started)
+
+    async def simulate(tg_id):
+        async with semaphore:
+            await send('start', message_update(tg_id, '/start'))
+            for _ in range(args.actions):
+                if fake.polls[tg_id] and random.random() < args.answer_rate:
+                    poll_id, correct_option_id, options = fake.polls[tg_id].pop()
+                    option = correct_option_id if random.random() < 0.8 else random.randrange(max(options, 1))
+                    await send('poll_answer', poll_answer_update(tg_id, poll_id, option))
+                else:
+                    await send('more_words', message_update(tg_id, MORE_WORDS))
+
+    tg_ids = [args.tg_id_base - i for i in range(args.users)]
+    started = time.perf_counter()
+    try:
+        await asyncio.gather(*(simulate(tg_id) for tg_id in tg_ids))
+        elapsed = time.perf_counter() - started
+        report(latencies, errors, elapsed)
+        print(f'Telegram calls: {dict(fake.calls)}, injected errors: {dict(fake.errors)}')
+    finally:
+        if db is not None:
+            if args.cleanup:
+                # Сначала остановим то, что ещё пишет в базу после обработчиков
+                await bot_main.outbox.sender.stop()
+                await bot_main.progress.stop()
+                await cleanup(db, tg_ids)
+            await bot_main.on_shutdown(bot_main.dp)
+            await (await bot_main.bot.get_session()).close()
+        await fake.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--actions', type=int, default=10, help='updates per user after /start')
+    parser.add_argument('--concurrency', type=int, default=50, help='users active at the same time')
+    parser.add_argument('--answer-rate', type=float, default=0.6, help='chance to answer a pending poll')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency-ms', type=float, default=0)
+    parser.add_argument('--retry-after-rate', type=float, default=0)
+    parser.add_argument('--blocked-rate', type=float, default=0)
+    parser.add_argument('--tg-id-base', type=int, default=-800000000)
+    parser.add_argument('--webhook', action='store_true', help='post updates to the running bot webhook')
+    parser.add_argument('--dbname', help='database for the in-process run, not the bot one')
+    parser.add_argument('--no-cleanup', dest='cleanup', action='store_false')
+    args = parser.parse_args()
+    if not args.webhook and not args.dbname:
+        parser.error('--dbname is required unless --webhook is given')
+    if args.dbname == POSTGRE_DB_NAME:
+        parser.error('--dbname is the bot database, use a separate one')
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
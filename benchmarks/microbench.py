@@ -0,0 +1,246 @@
+"""
+Microbenchmarks for the per-message CPU work in the event loop thread,
+with the database and Telegram replaced by in-memory stand-ins:
+
+- due_candidates: splitting a plan into due words per stage;
+- distractors.pick: wrong answers for a quiz;
+- get_transcription: cached and uncached;
+- default_menu and the MarkdownV2 text of a new words message;
+- translation_quiz, new_words_message and a whole send_user_message for
+  a planned quiz, up to the (fake) Bot API call.
+
+Reports ops/s, CPU time per op and tracemalloc allocations per op. With
+--check exits with 1 when a path takes more CPU per op than its budget in
+BUDGETS_US times --budget-scale, so slow machines can loosen it:
+
+    python benchmarks/microbench.py
+    python benchmarks/microbench.py --check --budget-scale 2 --json micro.json
+
+tests/test_microbench.py runs the same check under pytest.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiogram.utils.markdown import escape_md
+
+import db
+import main as bot_main
+import transcription
+from content_cache import content
+from distractors import distractors
+from planner import due_candidates
+
+LETTERS = 'abcçdeəfgğhxıijkqlmnoöprsştuüvyz'
+STAGES = ('plain', 'az_ru', 'ru_az')
+
+# Бюджет CPU на одну операцию, микросекунды, с запасом примерно в 4 раза от обычных замеров
+BUDGETS_US = {
+    'due_candidates': 50,
+    'distractors.pick': 40,
+    'distractors.pick hard': 50,
+    'get_transcription cached': 25,
+    'get_transcription uncached': 60,
+    'default_menu': 10,
+    'new words text': 400,
+    'translation_quiz': 500,
+    'new_words_message': 500,
+    'send_user_message': 600,
+}
+
+
+class FakeBot:
+    """
+    Answers send_poll / send_message like the Bot API would, without I/O.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self._poll_ids = itertools.count(1)
+
+    async def send_poll(self, **params):
+        self.calls += 1
+        return SimpleNamespace(poll=SimpleNamespace(id=str(next(self._poll_ids))))
+
+    async def send_message(self, *args, **params):
+        self.calls += 1
+
+
+async def fake_query(query, params=None):
+    return []
+
+
+def fake_word(length):
+    return ''.join(random.choice(LETTERS) for _ in range(length))
+
+
+def fake_vocabulary(size):
+    return {
+        word_id: {
+            'id': word_id,
+            'word_az': fake_word(random.randint(3, 12)),
+            'word_ru': fake_word(random.randint(3, 12)),
+            'word_emoji': '🦋',
+            'level': 1 + word_id // 100,
+            'transcription': None,
+        }
+        for word_id in range(1, size + 1)
+    }
+
+
+def fake_plan(user_id, words, candidates=10):
+    rows = []
+    for stage, guesses in zip(STAGES, (0, 4, 8)):
+        for word in random.sample(words, candidates):
+            rows.append({
+                **word,
+                'user_id': user_id,
+                'vocabulary_id': word['id'],
+                'num_right_guesses': random.choice((-1, guesses)),
+                'is_due': True,
+                'stage': stage,
+            })
+    return {'user_id': user_id, 'plain': 30, 'az_ru': 30, 'ru_az': 30, 'asked': 0, 'candidates': rows}
+
+
+def new_words_text(words):
+    # То же, что собирает new_words_message, без отправки
+    message = ''
+    for word in words:
+        if word['num_right_guesses'] == -1:
+            escaped = escape_md(f'{word["word_emoji"]} {word["word_ru"]} - {word["word_az"]} [{transcription.get_transcription(word)}]')
+        else:
+            escaped = f'{escape_md(word["word_emoji"])} {escape_md(word["word_ru"])} \\- ||{escape_md(word["word_az"])} \\[{escape_md(transcription.get_transcription(word))}\\]||'
+        message += f'{escaped}\n'
+    return message
+
+
+def cases(plan, words):
+    due = due_candidates(plan, 'ru_az')
+    plain = due_candidates(plan, 'plain')
+    fresh = itertools.cycle(fake_word(random.randint(3, 12)) for _ in range(100000))
+    return {
+        'due_candidates': lambda: [due_candidates(plan, stage) for stage in STAGES],
+        'distractors.pick': lambda: distractors.pick(random.choice(due), 'word_ru'),
+        'distractors.pick hard': lambda: distractors.pick(random.choice(due), 'word_az', hard=True),
+        'get_transcription cached': lambda: transcription.get_transcription(random.choice(words)),
+        'get_transcription uncached': lambda: transcription.transcribe.__wrapped__(next(fresh)),
+        'default_menu': lambda: bot_main.default_menu(plan['user_id']),
+        'new words text': lambda: new_words_text(plain[:5]),
+        'translation_quiz': lambda: bot_main.translation_quiz(plan['user_id'], plan['candidates'], due, 'word_ru', 'word_az'),
+        'new_words_message': lambda: bot_main.new_words_message(plan['user_id'], plan['user_id'], plain),
+        'send_user_message': lambda: bot_main.send_user_message(plan['user_id'], plan=plan),
+    }
+
+
+async def call(function):
+    result = function()
+    if asyncio.iscoroutine(result):
+        await result
+
+
+async def measure(function, iterations):
+    for _ in range(min(iterations, 100)):
+        await call(function)
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    for _ in range(iterations):
+        await call(function)
+    cpu = time.process_time() - cpu
+    wall = time.perf_counter() - wall
+
+    # Аллокации отдельным проходом: tracemalloc сам сильно замедляет код
+    allocation_runs = max(iterations // 10, 1)
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    tracemalloc.reset_peak()
+    for _ in range(allocation_runs):
+        await call(function)
+    after = tracemalloc.take_snapshot()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    allocated = sum(stat.size_diff for stat in after.compare_to(before, 'filename') if stat.size_diff > 0)
+    blocks = sum(stat.count_diff for stat in after.compare_to(before, 'filename') if stat.count_diff > 0)
+    return {
+        'ops_per_second': iterations / wall,
+        'cpu_us': cpu / iterations * 1e6,
+        'retained_bytes_per_op': allocated / allocation_runs,
+        'retained_blocks_per_op': blocks / allocation_runs,
+        'peak_kb': peak / 1024,
+    }
+
+
+async def run(args):
+    random.seed(args.seed)
+    # Подмены ниже возвращаются в конце, чтобы тесты в том же процессе видели настоящий бот
+    saved = (db.execute, db.fetchall, db.fetchone, bot_main.bot, bot_main.OUTBOX_ENABLED, content.words, content.version)
+    content.words = fake_vocabulary(args.vocabulary)
+    content.version += 1
+    words = list(content.words.values())
+    plan = fake_plan(args.user_id, words)
+    # Ни базы, ни Telegram: только работа процесса
+    db.execute = db.fetchall = db.fetchone = fake_query
+    bot_main.bot = FakeBot()
+    bot_main.OUTBOX_ENABLED = False
+    results = {}
+    print(f'{"path":<28}{"ops/s":>12}{"cpu us/op":>12}{"budget":>9}{"B/op":>10}{"blocks/op":>11}{"peak KB":>10}')
+    try:
+        for name, function in cases(plan, words).items():
+            if args.only and name not in args.only:
+                continue
+            result = await measure(function, args.iterations)
+            result['budget_us'] = BUDGETS_US[name] * args.budget_scale
+            result['over_budget'] = result['cpu_us'] > result['budget_us']
+            results[name] = result
+            print(
+                f'{name:<28}{result["ops_per_second"]:>12.0f}{result["cpu_us"]:>12.1f}{result["budget_us"]:>9.0f}'
+                f'{result["retained_bytes_per_op"]:>10.0f}{result["retained_blocks_per_op"]:>11.1f}{result["peak_kb"]:>10.1f}'
+                + ('  OVER' if result['over_budget'] else '')
+            )
+    finally:
+        db.execute, db.fetchall, db.fetchone, bot_main.bot, bot_main.OUTBOX_ENABLED, content.words, content.version = saved
+    return results
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--iterations', type=int, default=5000)
+    parser.add_argument('--vocabulary', type=int, default=2000)
+    parser.add_argument('--user-id', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--only', nargs='+', help='run only these paths')
+    parser.add_argument('--check', action='store_true', help='exit with 1 when a path is over its CPU budget')
+    parser.add_argument('--budget-scale', type=float, default=1.0)
+    parser.add_argument('--log', action='store_true', help='keep the bot log output')
+    parser.add_argument('--json', help='also write the results to this file')
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_args()
+    if not args.log:
+        # Сообщения всё равно форматируются, но никуда не пишутся
+        logging.getLogger().handlers = [logging.NullHandler()]
+    results = asyncio.run(run(args))
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump({'iterations': args.iterations, 'started': datetime.now().isoformat(), 'results': results}, file, indent=2)
+    over = [name for name, result in results.items() if result['over_budget']]
+    if args.check and over:
+        print(f'\nOver CPU budget: {", ".join(over)}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
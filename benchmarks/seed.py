@@ -0,0 +1,201 @@
+"""
+Synthetic data for benchmarks: users, vocabulary and user_vocabulary with
+a realistic spread, loaded with COPY in batches of users.
+
+- vocabulary: --vocabulary words, 100 per level, answers of 3-12 letters;
+- users: tg_id below TG_ID_BASE, registrations over --days days, --blocked
+  of them have blocked the bot;
+- user_vocabulary: every user has the lowest levels enrolled, about
+  --per-user words on average with a long tail of heavy learners; stages
+  follow STAGES, earlier words are further along; last_send is recent
+  for active users and weeks old for dormant ones.
+
+Adds users until the database has --users seeded ones, so a bigger size
+can be seeded on top of a smaller one:
+
+    createdb azbot_bench
+    python benchmarks/seed.py --dbname azbot_bench --users 100000 --vocabulary 2000
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from psycopg.conninfo import make_conninfo
+from psycopg.rows import dict_row
+from psycopg_pool import AsyncConnectionPool
+
+import db
+import migrations
+from secret_constants import POSTGRE_DB_NAME
+
+TG_ID_BASE = -1000000000
+WORDS_PER_LEVEL = 100
+LETTERS = 'abcçdeəfgğhxıijkqlmnoöprsştuüvyz'
+
+# Доли слов пользователя по стадиям: (num_right_guesses от, до, доля)
+STAGES = [
+    (-1, -1, 0.15),  # записано, но ещё не показано
+    (0, 1, 0.25),  # plain
+    (2, 7, 0.25),  # az_ru
+    (8, 9, 0.10),  # ru_az
+    (10, 13, 0.25),  # выучено
+]
+ACTIVE_SHARE = 0.3
+
+
+def use_database(dbname, max_size=None):
+    """
+    Points db.pool at another database, e.g. one made for benchmarks.
+    The bot database is refused: callers seed and change data in bulk.
+    """
+    if dbname == POSTGRE_DB_NAME:
+        raise SystemExit(f'{dbname} is the bot database, use a separate one for benchmarks')
+    db.pool = AsyncConnectionPool(
+        conninfo=make_conninfo(db.pool.conninfo, dbname=dbname),
+        min_size=1,
+        max_size=max_size or db.pool.max_size,
+        kwargs={'row_factory': dict_row},
+        open=False,
+    )
+
+
+async def prepare():
+    await migrations.setup()
+
+
+def fake_word(length):
+    return ''.join(random.choice(LETTERS) for _ in range(length))
+
+
+async def seed_vocabulary(size):
+    count = (await db.fetchone('SELECT COUNT(*) AS count FROM vocabulary'))['count']
+    if count >= size:
+        return 0
+    async with db.transaction() as conn:
+        async with conn.cursor().copy('COPY vocabulary (word_az, word_ru, word_emoji, level) FROM STDIN') as copy:
+            for number in range(count, size):
+                await copy.write_row((
+                    fake_word(random.randint(3, 12)),
+                    fake_word(random.randint(3, 12)),
+                    '',
+                    1 + number // WORDS_PER_LEVEL,
+                ))
+    return size - count
+
+
+def guesses(position, enrolled):
+    # Чем раньше слово записано, тем дальше оно продвинулось
+    stage = random.choices(STAGES, weights=[share for _, _, share in STAGES])[0]
+    if random.random() < position / enrolled:
+        stage = random.choices(STAGES[:3], weights=[share for _, _, share in STAGES[:3]])[0]
+    return random.randint(stage[0], stage[1])
+
+
+def user_rows(number, now, days, blocked):
+    return (
+        TG_ID_BASE - number,
+        f'seed{number}',
+        'Seed',
+        now - timedelta(days=random.uniform(0, days)),
+        random.random() < blocked,
+    )
+
+
+def vocabulary_rows(user_id, word_ids, per_user, now):
+    enrolled = int(min(len(word_ids), max(WORDS_PER_LEVEL, random.expovariate(1 / per_user))))
+    active = random.random() < ACTIVE_SHARE
+    lag = timedelta(0) if active else timedelta(days=random.uniform(1, 60))
+    for position, word_id in enumerate(word_ids[:enrolled]):
+        num_right_guesses = guesses(position, enrolled)
+        last_send = None if num_right_guesses < 0 else now - lag - timedelta(hours=random.expovariate(1 / 12))
+        yield user_id, word_id, -1, num_right_guesses, None, last_send
+
+
+async def seed_users(size, per_user, blocked=0.05, days=365, batch=1000):
+    """
+    Adds seeded users until there are size of them. Returns
+    (users added, user_vocabulary rows added).
+    """
+    count = (await db.fetchone('SELECT COUNT(*) AS count FROM users WHERE tg_id <= %s', (TG_ID_BASE,)))['count']
+    rows = await db.fetchall('SELECT id FROM vocabulary ORDER BY level, id')
+    word_ids = [row['id'] for row in rows]
+    now = datetime.now()
+    added = words = 0
+    for start in range(count + 1, size + 1, batch):
+        numbers = range(start, min(start + batch, size + 1))
+        async with db.transaction() as conn:
+            async with conn.cursor().copy(
+                'COPY users (tg_id, username, first_name, registration_date, is_blocked) FROM STDIN'
+            ) as copy:
+                for number in numbers:
+                    await copy.write_row(user_rows(number, now, days, blocked))
+            cursor = await conn.execute(
+                'SELECT id FROM users WHERE tg_id BETWEEN %s AND %s',
+                (TG_ID_BASE - numbers[-1], TG_ID_BASE - numbers[0])
+            )
+            user_ids = [row['id'] for row in await cursor.fetchall()]
+            async with conn.cursor().copy(
+                'COPY user_vocabulary (user_id, vocabulary_id, correct_answer_id, num_right_guesses, poll_id, last_send) FROM STDIN'
+            ) as copy:
+                for user_id in user_ids:
+                    for row in vocabulary_rows(user_id, word_ids, per_user, now):
+                        await copy.write_row(row)
+                        words += 1
+        added += len(numbers)
+    return added, words
+
+
+async def seed(users, vocabulary=2000, per_user=300, blocked=0.05, days=365, batch=1000):
+    """
+    Brings the database up to users seeded users and vocabulary words,
+    then analyzes it. Returns what was added and how long it took.
+    """
+    started = time.perf_counter()
+    words_added = await seed_vocabulary(vocabulary)
+    users_added, rows_added = await seed_users(users, per_user, blocked, days, batch)
+    if words_added or users_added:
+        await db.execute('ANALYZE')
+    elapsed = time.perf_counter() - started
+    return {
+        'vocabulary_added': words_added,
+        'users_added': users_added,
+        'user_vocabulary_added': rows_added,
+        'seconds': elapsed,
+    }
+
+
+def add_arguments(parser):
+    parser.add_argument('--dbname', required=True, help='database for benchmarks, not the bot one')
+    parser.add_argument('--vocabulary', type=int, default=2000, help='vocabulary size')
+    parser.add_argument('--per-user', type=int, default=300, help='average enrolled words per user')
+    parser.add_argument('--blocked', type=float, default=0.05, help='share of users who blocked the bot')
+    parser.add_argument('--days', type=int, default=365, help='registrations spread over this many days')
+    parser.add_argument('--batch', type=int, default=1000, help='users per COPY transaction')
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    add_arguments(parser)
+    parser.add_argument('--users', type=int, default=10000)
+    args = parser.parse_args()
+    use_database(args.dbname)
+    await db.open_pool()
+    try:
+        await prepare()
+        result = await seed(args.users, args.vocabulary, args.per_user, args.blocked, args.days, args.batch)
+        print(
+            f'Added {result["users_added"]} users, {result["user_vocabulary_added"]} user words and '
+            f'{result["vocabulary_added"]} vocabulary words in {result["seconds"]:.1f}s'
+        )
+    finally:
+        await db.close_pool()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
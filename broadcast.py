@@ -0,0 +1,199 @@
+import asyncio
+import logging
+import time
+
+from aiogram.utils import exceptions
+
+import metrics
+from settings import (
+    BROADCAST_WORKERS, BROADCAST_MAX_RETRIES, BROADCAST_PROGRESS_SECONDS,
+    TELEGRAM_GLOBAL_RATE, TELEGRAM_PER_CHAT_INTERVAL,
+)
+
+
+logger = logging.getLogger('broadcast')
+
+SENT = 'sent'
+BLOCKED = 'blocked'
+NOT_FOUND = 'not_found'
+FAILED = 'failed'
+RETRIED = 'retried'
+GAVE_UP = 'gave_up'
+
+
+class TokenBucket:
+    """
+    Global limit on outgoing Telegram calls. Telegram allows roughly 30
+    messages per second per bot, burst is capped by capacity.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class ChatLimiter:
+    """
+    Per-chat spacing: no more than one message per interval to the same chat.
+    """
+
+    def __init__(self, interval, max_chats=10000):
+        self.interval = interval
+        self.max_chats = max_chats
+        self._next_allowed = {}
+
+    async def acquire(self, chat_id):
+        now = time.monotonic()
+        if len(self._next_allowed) > self.max_chats:
+            self._next_allowed = {chat: at for chat, at in self._next_allowed.items() if at > now}
+        allowed_at = max(now, self._next_allowed.get(chat_id, now))
+        self._next_allowed[chat_id] = allowed_at + self.interval
+        if allowed_at > now:
+            await asyncio.sleep(allowed_at - now)
+
+
+telegram_limiter = TokenBucket(TELEGRAM_GLOBAL_RATE)
+chat_limiter = ChatLimiter(TELEGRAM_PER_CHAT_INTERVAL)
+
+
+async def _attempt(chat_id, send, on_blocked=None):
+    # RetryAfter is left to the caller: the broadcast requeues, deliver() waits
+    try:
+        await send(chat_id)
+        return SENT
+    except exceptions.BotBlocked:
+        logger.warning(f"Bot was blocked by user {chat_id}")
+        if on_blocked is not None:
+            try:
+                await on_blocked(chat_id)
+            except Exception as e:
+                # Пометка не записалась, но сообщение всё равно не доставить; рассылка идёт дальше
+                logger.exception(f"Failed to mark {chat_id} as blocked: {e}")
+        return BLOCKED
+    except exceptions.ChatNotFound:
+        logger.warning(f"Chat not found for user {chat_id}")
+        return NOT_FOUND
+    except exceptions.RetryAfter:
+        raise
+    except exceptions.TelegramAPIError as e:
+        logger.exception(f"Failed to send message to user {chat_id}. Exception: {e}")
+        return FAILED
+    except Exception as e:
+        logger.exception(f"Something happened: {e}")
+        return FAILED
+
+
+async def deliver(chat_id, send, on_blocked=None):
+    """
+    Interactive path for a single recipient: same error handling as the
+    broadcast, but without queueing and rate limiting.
+    """
+    try:
+        return await _attempt(chat_id, send, on_blocked)
+    except exceptions.RetryAfter as e:
+        logger.warning(f"Rate limited. Sleeping for {e.timeout} seconds")
+        await asyncio.sleep(e.timeout)
+        return RETRIED
+
+
+async def broadcast(name, chat_ids, send, on_blocked=None, workers=BROADCAST_WORKERS, limit=True):
+    """
+    Calls send(chat_id) for every chat using a bounded pool of workers.
+    Each call takes a token from the global bucket and respects the per-chat
+    interval. Chats hit by RetryAfter are put back into the queue after the
+    requested timeout, the rest of the run keeps going. limit=False skips
+    the rate limits when send() only queues messages (the outbox applies
+    them itself).
+    Returns counters by outcome and the total duration.
+    """
+    chat_ids = list(dict.fromkeys(chat_ids))
+    stats = {SENT: 0, BLOCKED: 0, NOT_FOUND: 0, FAILED: 0, RETRIED: 0, GAVE_UP: 0}
+    if not chat_ids:
+        stats['duration'] = 0.0
+        return stats
+
+    metrics.BROADCAST_TOTAL.set(len(chat_ids), broadcast=name)
+    metrics.BROADCAST_DONE.set(0, broadcast=name)
+    queue = asyncio.Queue()
+    for chat_id in chat_ids:
+        queue.put_nowait((chat_id, 0))
+    started = time.monotonic()
+    done = 0
+    last_report = started
+
+    async def requeue(item, timeout):
+        try:
+            await asyncio.sleep(timeout)
+            queue.put_nowait(item)
+        finally:
+            queue.task_done()
+
+    async def process(chat_id, attempt):
+        # True, если чат снова поставлен в очередь: task_done тогда сделает requeue
+        nonlocal done, last_report
+        if limit:
+            await telegram_limiter.acquire()
+            await chat_limiter.acquire(chat_id)
+        try:
+            status = await _attempt(chat_id, send, on_blocked)
+        except exceptions.RetryAfter as e:
+            if attempt < BROADCAST_MAX_RETRIES:
+                logger.warning(f"{name}: rate limited on {chat_id}, retry in {e.timeout} seconds")
+                stats[RETRIED] += 1
+                metrics.BROADCAST_MESSAGES.inc(broadcast=name, status=RETRIED)
+                task = asyncio.create_task(requeue((chat_id, attempt + 1), e.timeout))
+                retries.add(task)
+                task.add_done_callback(retries.discard)
+                return True
+            logger.warning(f"{name}: giving up on {chat_id} after {attempt} retries")
+            status = GAVE_UP
+        stats[status] += 1
+        done += 1
+        metrics.BROADCAST_MESSAGES.inc(broadcast=name, status=status)
+        metrics.BROADCAST_DONE.set(done, broadcast=name)
+        now = time.monotonic()
+        if now - last_report >= BROADCAST_PROGRESS_SECONDS:
+            last_report = now
+            metrics.BROADCAST_RATE.set(done / (now - started), broadcast=name)
+            logger.info(f"{name}: {done}/{len(chat_ids)} done, {done / (now - started):.1f} users/s")
+        return False
+
+    async def worker():
+        while True:
+            chat_id, attempt = await queue.get()
+            requeued = False
+            try:
+                requeued = await process(chat_id, attempt)
+            except Exception as e:
+                # Один неудачный пользователь не должен останавливать воркер и подвешивать queue.join()
+                logger.exception(f"{name}: failed on {chat_id}: {e}")
+            finally:
+                if not requeued:
+                    queue.task_done()
+
+    retries = set()
+    tasks = [asyncio.create_task(worker()) for _ in range(min(workers, len(chat_ids)))]
+    try:
+        await queue.join()
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    stats['duration'] = time.monotonic() - started
+    metrics.BROADCAST_RATE.set(len(chat_ids) / stats['duration'] if stats['duration'] else 0, broadcast=name)
+    logger.info(f"{name}: finished {len(chat_ids)} users in {stats['duration']:.1f}s {stats}")
+    return stats
@@ -53,9 +53,14 @@ ADM_HELP = md.escape_md("""Команды:
 
 /adm_message [сообщение] - отправить сообщение всем пользователям бота
 /test_adm_message [сообщение] - отправить сообщение только админам
+/adm_reload - перечитать словарь и уроки из базы
 """)
 
 
+ADMINS = [127869357, 5632448031]
+ADMINS_ALL = [1, 9, 127869357, 5632448031]
+
+
 class Keyboard(Enum):
     ADM_STAT = '(АДМ) Статистика'
     ADM_HELP = '(АДМ) Команды'
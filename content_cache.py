@@ -0,0 +1,112 @@
+import asyncio
+import logging
+
+from psycopg import AsyncConnection
+
+import db
+
+
+logger = logging.getLogger('content_cache')
+
+CHANNEL = 'content_changed'
+
+# Любое изменение словаря или уроков рассылает NOTIFY, все процессы бота перечитывают кэш
+SCHEMA = [
+    f'''
+    CREATE OR REPLACE FUNCTION notify_content_changed() RETURNS trigger
+    LANGUAGE plpgsql AS $$
+    BEGIN
+        PERFORM pg_notify('{CHANNEL}', TG_TABLE_NAME);
+        RETURN NULL;
+    END
+    $$
+    ''',
+    'DROP TRIGGER IF EXISTS vocabulary_content_changed ON vocabulary',
+    '''
+    CREATE TRIGGER vocabulary_content_changed
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON vocabulary
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_content_changed()
+    ''',
+    'DROP TRIGGER IF EXISTS lessons_content_changed ON lessons',
+    '''
+    CREATE TRIGGER lessons_content_changed
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON lessons
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_content_changed()
+    ''',
+]
+
+# Все колонки: part_of_speech, если он есть, нужен для подбора неправильных вариантов
+VOCABULARY_SQL = 'SELECT * FROM vocabulary'
+LESSONS_SQL = 'SELECT * FROM lessons ORDER BY learn_order ASC'
+
+
+class ContentCache:
+    """
+    Vocabulary and lessons kept in memory, so hot paths only query
+    user_vocabulary. version grows on every reload.
+    """
+
+    def __init__(self):
+        self.version = 0
+        self.words = {}
+        self.lessons = []
+        self.lessons_by_id = {}
+        self._listener = None
+
+    async def load(self):
+        words = await db.fetchall(VOCABULARY_SQL)
+        lessons = await db.fetchall(LESSONS_SQL)
+        self.words = {word['id']: word for word in words}
+        self.lessons = lessons
+        self.lessons_by_id = {lesson['id']: lesson for lesson in lessons}
+        self.version += 1
+        logger.info(f'Content cache v{self.version}: {len(self.words)} words, {len(self.lessons)} lessons')
+
+    async def with_words(self, rows):
+        """
+        Adds word_az / word_ru / word_emoji / level / transcription to rows
+        that only have vocabulary_id. Reloads once if a word is unknown,
+        rows for words that are still missing are dropped.
+        """
+        if any(row['vocabulary_id'] not in self.words for row in rows):
+            await self.load()
+        enriched = []
+        for row in rows:
+            word = self.words.get(row['vocabulary_id'])
+            if word is not None:
+                enriched.append({**word, **row})
+        return enriched
+
+    async def _listen(self):
+        while True:
+            try:
+                async with await AsyncConnection.connect(db.pool.conninfo, autocommit=True) as conn:
+                    await conn.execute(f'LISTEN {CHANNEL}')
+                    # Пока соединения не было, изменения могли пройти мимо
+                    await self.load()
+                    async for notify in conn.notifies():
+                        logger.info(f'{notify.payload} changed, reloading content')
+                        await self.load()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('Content listener failed, reconnecting in 5 seconds')
+                await asyncio.sleep(5)
+
+    def start(self):
+        if self._listener is None:
+            self._listener = asyncio.create_task(self._listen())
+
+    async def stop(self):
+        if self._listener is not None:
+            self._listener.cancel()
+            await asyncio.gather(self._listener, return_exceptions=True)
+            self._listener = None
+
+
+content = ContentCache()
+
+
+async def ensure_schema():
+    for statement in SCHEMA:
+        await db.execute(statement)
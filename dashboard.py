@@ -0,0 +1,89 @@
+import logging
+
+import db
+from progress_buffer import progress
+
+
+logger = logging.getLogger('dashboard')
+
+LEADERBOARD_SIZE = 40
+FRESH_REGISTERED_SIZE = 30
+
+# Слова, показанные пользователю за последние 24 часа, и их максимальный уровень.
+# day_shown в user_progress считает показы, а не разные слова, поэтому берётся
+# только как отбор: показ за последние сутки значит, что суточное окно началось
+# не раньше 48 часов назад, и user_vocabulary читается лишь по этим пользователям.
+DAY_WORDS_SQL = '''
+    SELECT user_progress.user_id, COUNT(*) AS words_learned, MAX(vocabulary.level) AS max_level
+    FROM user_progress
+    JOIN user_vocabulary ON user_vocabulary.user_id = user_progress.user_id
+    JOIN vocabulary ON user_vocabulary.vocabulary_id = vocabulary.id
+    WHERE user_progress.day_started_at > NOW() - interval '48 hours'
+        AND user_vocabulary.last_send >= NOW() - interval '24 hours'
+    GROUP BY user_progress.user_id
+    HAVING COUNT(*) > 1
+'''
+
+# Статистика для админов собирается в materialized view по расписанию,
+# нажатие кнопки читает готовые 40 + 1 строк и 30 последних регистраций по индексу
+SCHEMA = [
+    'CREATE INDEX IF NOT EXISTS user_progress_day_started_idx ON user_progress (day_started_at)',
+    f'''
+    CREATE MATERIALIZED VIEW IF NOT EXISTS admin_leaderboard AS
+    SELECT day_words.user_id,
+        (CASE WHEN (username IS NULL OR username = '') THEN tg_id::name ELSE username END) AS user,
+        max_level,
+        words_learned
+    FROM ({DAY_WORDS_SQL}) AS day_words
+    JOIN users ON day_words.user_id = users.id
+    ORDER BY words_learned DESC
+    LIMIT {LEADERBOARD_SIZE}
+    ''',
+    'CREATE UNIQUE INDEX IF NOT EXISTS admin_leaderboard_user_idx ON admin_leaderboard (user_id)',
+    f'''
+    CREATE MATERIALIZED VIEW IF NOT EXISTS admin_summary AS
+    SELECT 1 AS id,
+        NOW() AS refreshed_at,
+        (SELECT COUNT(*) FROM ({DAY_WORDS_SQL}) AS day_words) AS active,
+        (SELECT COUNT(*) FROM users
+            WHERE registration_date > NOW() - interval '24 hours') AS registered_today,
+        (SELECT COUNT(*) FROM users
+            WHERE registration_date > NOW() - interval '48 hours'
+                AND registration_date <= NOW() - interval '24 hours') AS registered_yesterday
+    ''',
+    'CREATE UNIQUE INDEX IF NOT EXISTS admin_summary_id_idx ON admin_summary (id)',
+]
+
+LEADERBOARD_SQL = 'SELECT * FROM admin_leaderboard ORDER BY words_learned DESC'
+SUMMARY_SQL = 'SELECT * FROM admin_summary'
+FRESH_REGISTERED_SQL = f'''
+    SELECT (CASE WHEN (username IS NULL OR username = '') THEN tg_id::name ELSE username END) as user, first_name, registration_date, is_blocked
+    FROM users
+    ORDER BY registration_date DESC
+    LIMIT {FRESH_REGISTERED_SIZE}
+'''
+
+
+async def ensure_schema():
+    for statement in SCHEMA:
+        await db.execute(statement)
+
+
+async def refresh():
+    """
+    Recomputes the admin views. CONCURRENTLY keeps them readable meanwhile.
+    """
+    await progress.flush()
+    for view in ('admin_leaderboard', 'admin_summary'):
+        await db.execute(f'REFRESH MATERIALIZED VIEW CONCURRENTLY {view}')
+    logger.info('Admin dashboard refreshed')
+
+
+async def load():
+    """
+    Returns (leaderboard rows, summary row, recently registered users).
+    """
+    leaderboard = await db.fetchall(LEADERBOARD_SQL)
+    summary = await db.fetchone(SUMMARY_SQL)
+    fresh_registered = await db.fetchall(FRESH_REGISTERED_SQL)
+    return leaderboard, summary, fresh_registered
@@ -0,0 +1,116 @@
+import contextlib
+import functools
+import logging
+import time
+
+from psycopg.conninfo import make_conninfo
+from psycopg.rows import dict_row
+from psycopg_pool import AsyncConnectionPool
+
+import metrics
+from secret_constants import POSTGRE_USER, POSTGRE_PWD, POSTGRE_DB_NAME
+from settings import DB_HOST, DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, DB_POOL_TIMEOUT, METRICS_ENABLED
+
+
+logger = logging.getLogger('db')
+
+pool = AsyncConnectionPool(
+    conninfo=make_conninfo(dbname=POSTGRE_DB_NAME, user=POSTGRE_USER, password=POSTGRE_PWD, host=DB_HOST),
+    min_size=DB_POOL_MIN_SIZE,
+    max_size=DB_POOL_MAX_SIZE,
+    timeout=DB_POOL_TIMEOUT,
+    kwargs={'row_factory': dict_row},
+    open=False,
+)
+
+
+async def open_pool():
+    await pool.open(wait=True)
+    logger.info(f'Connection pool opened (min={DB_POOL_MIN_SIZE}, max={DB_POOL_MAX_SIZE})')
+
+
+async def close_pool():
+    await pool.close()
+    logger.info('Connection pool closed')
+
+
+def transaction():
+    """
+    Connection from the pool for several statements in one transaction.
+    Commits when the block exits normally, rolls back on exception.
+    """
+    return pool.connection()
+
+
+async def fetchall(query, params=None):
+    async with pool.connection() as conn:
+        cursor = await conn.execute(query, params)
+        return await cursor.fetchall()
+
+
+async def fetchone(query, params=None):
+    async with pool.connection() as conn:
+        cursor = await conn.execute(query, params)
+        return await cursor.fetchone()
+
+
+async def execute(query, params=None):
+    async with pool.connection() as conn:
+        await conn.execute(query, params)
+
+
+async def _observe(query, call):
+    statement = metrics.statement_name(query)
+    started = time.perf_counter()
+    try:
+        return await call()
+    except Exception:
+        metrics.DB_ERRORS.inc(statement=statement)
+        raise
+    finally:
+        metrics.DB_SECONDS.observe(time.perf_counter() - started, statement=statement)
+
+
+def timed_statement(function):
+    @functools.wraps(function)
+    async def wrapper(query, params=None):
+        return await _observe(query, lambda: function(query, params))
+    return wrapper
+
+
+class TimedConnection:
+    """
+    Connection handed out by transaction() with metrics on: execute() is
+    timed like the helpers above, the rest goes to the connection itself.
+    """
+
+    __slots__ = ('_conn',)
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    async def execute(self, query, params=None, **kwargs):
+        return await _observe(query, lambda: self._conn.execute(query, params, **kwargs))
+
+
+@contextlib.asynccontextmanager
+async def timed_transaction():
+    async with pool.connection() as conn:
+        yield TimedConnection(conn)
+
+
+if METRICS_ENABLED:
+    fetchall = timed_statement(fetchall)
+    fetchone = timed_statement(fetchone)
+    execute = timed_statement(execute)
+    transaction = timed_transaction
+
+
+@metrics.collector
+def pool_stats():
+    # pool_size, pool_available, requests_waiting и накопленные счётчики пула
+    for stat, value in pool.get_stats().items():
+        metrics.DB_POOL.set(value, stat=stat)
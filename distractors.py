@@ -0,0 +1,76 @@
+import logging
+import random
+from collections import defaultdict
+
+from content_cache import content
+
+
+logger = logging.getLogger('distractors')
+
+LANGUAGES = ('word_az', 'word_ru')
+
+
+class DistractorIndex:
+    """
+    Wrong answers for quizzes, grouped once per vocabulary version:
+    words of the same level and part of speech (if vocabulary has a
+    part_of_speech column), the same level, and for harder quizzes words
+    whose answer has about the same length. Picking samples a few random
+    entries from the pools instead of scanning the user's words.
+    """
+
+    def __init__(self):
+        self.version = None
+        self.by_group = {}
+        self.by_level = {}
+        self.by_length = {}
+        self.all = []
+
+    def build(self, words):
+        by_group = defaultdict(list)
+        by_level = defaultdict(list)
+        by_length = {language: defaultdict(list) for language in LANGUAGES}
+        for word in words:
+            by_group[(word['level'], word.get('part_of_speech'))].append(word)
+            by_level[word['level']].append(word)
+            for language in LANGUAGES:
+                by_length[language][len(word[language])].append(word)
+        self.by_group = dict(by_group)
+        self.by_level = dict(by_level)
+        self.by_length = {language: dict(lengths) for language, lengths in by_length.items()}
+        self.all = list(words)
+        self.version = content.version
+        logger.info(f'Distractor index v{self.version}: {len(self.all)} words, {len(self.by_group)} groups')
+
+    def _pools(self, word, language, hard):
+        if hard:
+            length = len(word[language])
+            for delta in (0, -1, 1):
+                yield self.by_length[language].get(length + delta, ())
+        yield self.by_group.get((word['level'], word.get('part_of_speech')), ())
+        yield self.by_level.get(word['level'], ())
+        yield self.all
+
+    def pick(self, word, language, count=3, hard=False, prefer=()):
+        """
+        Up to count words whose text in language differs from the word's
+        and from each other. Words from prefer (e.g. ones the user has
+        already seen) are taken first.
+        """
+        if self.version != content.version:
+            self.build(content.words.values())
+        texts = {word[language]}
+        picked = []
+        for pool in [prefer, *self._pools(word, language, hard)]:
+            # Несколько случайных попыток на пул: O(count), а не проход по всему пулу
+            for _ in range(min(len(pool), count * 4)):
+                if len(picked) == count:
+                    return picked
+                candidate = random.choice(pool)
+                if candidate[language] not in texts:
+                    texts.add(candidate[language])
+                    picked.append(candidate)
+        return picked
+
+
+distractors = DistractorIndex()
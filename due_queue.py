@@ -0,0 +1,96 @@
+import logging
+
+import db
+from settings import DUE_INTERVALS
+
+
+logger = logging.getLogger('due_queue')
+
+# Каждая строка user_vocabulary хранит due_at — момент, когда слово снова можно
+# показывать. Считается триггером из last_send и интервала стадии, поэтому
+# любой UPDATE num_right_guesses / last_send держит очередь в актуальном виде.
+SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS stage_intervals (
+        stage text PRIMARY KEY,
+        delay interval NOT NULL
+    )
+    ''',
+    '''
+    CREATE OR REPLACE FUNCTION learning_stage(num_right_guesses integer) RETURNS text
+    LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+        SELECT CASE
+            WHEN num_right_guesses >= 10 THEN 'review'
+            WHEN num_right_guesses > 7 THEN 'ru_az'
+            WHEN num_right_guesses >= 2 THEN 'az_ru'
+            ELSE 'plain'
+        END
+    $$
+    ''',
+    'ALTER TABLE user_vocabulary ADD COLUMN IF NOT EXISTS due_at timestamp',
+    '''
+    CREATE OR REPLACE FUNCTION user_vocabulary_set_due_at() RETURNS trigger
+    LANGUAGE plpgsql AS $$
+    BEGIN
+        IF NEW.last_send IS NULL THEN
+            NEW.due_at := '-infinity';
+        ELSE
+            NEW.due_at := NEW.last_send + COALESCE(
+                (SELECT delay FROM stage_intervals WHERE stage = learning_stage(NEW.num_right_guesses)),
+                interval '0'
+            );
+        END IF;
+        RETURN NEW;
+    END
+    $$
+    ''',
+    'DROP TRIGGER IF EXISTS user_vocabulary_due_at ON user_vocabulary',
+    '''
+    CREATE TRIGGER user_vocabulary_due_at
+    BEFORE INSERT OR UPDATE OF num_right_guesses, last_send ON user_vocabulary
+    FOR EACH ROW EXECUTE FUNCTION user_vocabulary_set_due_at()
+    ''',
+    '''
+    CREATE INDEX IF NOT EXISTS user_vocabulary_due_idx
+    ON user_vocabulary (user_id, learning_stage(num_right_guesses), due_at)
+    ''',
+]
+
+SYNC_INTERVAL_SQL = '''
+    INSERT INTO stage_intervals (stage, delay)
+    VALUES (%s, %s)
+    ON CONFLICT (stage) DO UPDATE SET delay = EXCLUDED.delay
+    WHERE stage_intervals.delay IS DISTINCT FROM EXCLUDED.delay
+    RETURNING stage
+'''
+
+# Пересчёт due_at: UPDATE OF last_send запускает триггер
+RECOMPUTE_STAGE_SQL = '''
+    UPDATE user_vocabulary
+    SET last_send = last_send
+    WHERE learning_stage(num_right_guesses) = %s
+'''
+
+BACKFILL_SQL = '''
+    UPDATE user_vocabulary
+    SET last_send = last_send
+    WHERE due_at IS NULL
+'''
+
+
+async def ensure_schema():
+    """
+    Creates the due_at column, its trigger and index, stores the configured
+    stage intervals and recomputes due_at for stages whose interval changed.
+    """
+    async with db.transaction() as conn:
+        for statement in SCHEMA:
+            await conn.execute(statement)
+        for stage, delay in DUE_INTERVALS.items():
+            changed = await (await conn.execute(SYNC_INTERVAL_SQL, (stage, delay))).fetchone()
+            if changed:
+                cursor = await conn.execute(RECOMPUTE_STAGE_SQL, (stage,))
+                logger.info(f'Interval for {stage} is {delay}, recomputed due_at for {cursor.rowcount} words')
+        cursor = await conn.execute(BACKFILL_SQL)
+        if cursor.rowcount:
+            logger.info(f'Backfilled due_at for {cursor.rowcount} words')
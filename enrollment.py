@@ -0,0 +1,50 @@
+import db
+
+
+# Записываем пользователю все слова уровня одним INSERT ... SELECT
+ENROLL_LEVEL_SQL = '''
+    INSERT INTO user_vocabulary (user_id, vocabulary_id, correct_answer_id, num_right_guesses, poll_id)
+    SELECT %s, id, -1, 0, NULL
+    FROM vocabulary
+    WHERE level = %s
+    ON CONFLICT DO NOTHING
+    RETURNING vocabulary_id
+'''
+
+# Следующие по уровню слова, которых у пользователя ещё нет
+ENROLL_NEXT_WORDS_SQL = '''
+    WITH added AS (
+        INSERT INTO user_vocabulary (user_id, vocabulary_id, correct_answer_id, num_right_guesses, poll_id)
+        SELECT %(user_id)s, vocabulary.id, -1, -1, NULL
+        FROM vocabulary
+        WHERE NOT EXISTS (
+            SELECT 1 FROM user_vocabulary
+            WHERE user_vocabulary.user_id = %(user_id)s AND user_vocabulary.vocabulary_id = vocabulary.id
+        )
+        ORDER BY vocabulary.level ASC
+        LIMIT %(limit)s
+        ON CONFLICT DO NOTHING
+        RETURNING vocabulary_id, num_right_guesses
+    )
+    SELECT added.vocabulary_id, added.num_right_guesses, word_az, word_ru, word_emoji, level, transcription
+    FROM added
+    JOIN vocabulary ON added.vocabulary_id = vocabulary.id
+    ORDER BY level ASC
+'''
+
+
+async def enroll_level(conn, user_id, level=1):
+    """
+    Adds every word of the level to the user in the caller's transaction.
+    Returns ids of the words that were actually added.
+    """
+    cursor = await conn.execute(ENROLL_LEVEL_SQL, (user_id, level))
+    return [row['vocabulary_id'] for row in await cursor.fetchall()]
+
+
+async def enroll_next_words(user_id, limit=20):
+    """
+    Adds up to limit new words of the lowest levels in one transaction and
+    returns them with their text, marked as never shown (num_right_guesses = -1).
+    """
+    return await db.fetchall(ENROLL_NEXT_WORDS_SQL, {'user_id': user_id, 'limit': limit})
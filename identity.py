@@ -0,0 +1,124 @@
+import asyncio
+import logging
+from collections import namedtuple
+
+from psycopg import AsyncConnection
+
+import db
+from constants import ADMINS_ALL
+
+
+logger = logging.getLogger('identity')
+
+CHANNEL = 'users_changed'
+
+Identity = namedtuple('Identity', ['id', 'is_blocked', 'is_admin'])
+
+# Регистрация и блокировка в любом процессе рассылают NOTIFY с tg_id,
+# остальные процессы перечитывают только эту строку
+SCHEMA = [
+    f'''
+    CREATE OR REPLACE FUNCTION notify_user_changed() RETURNS trigger
+    LANGUAGE plpgsql AS $$
+    BEGIN
+        PERFORM pg_notify('{CHANNEL}', NEW.tg_id::text);
+        RETURN NULL;
+    END
+    $$
+    ''',
+    'DROP TRIGGER IF EXISTS users_identity_changed ON users',
+    '''
+    CREATE TRIGGER users_identity_changed
+    AFTER INSERT OR UPDATE OF tg_id, is_blocked ON users
+    FOR EACH ROW EXECUTE FUNCTION notify_user_changed()
+    ''',
+]
+
+USERS_SQL = 'SELECT id, tg_id, is_blocked FROM users'
+SOME_USERS_SQL = 'SELECT id, tg_id, is_blocked FROM users WHERE tg_id = ANY(%(tg_ids)s)'
+
+# Пользователи из кэша вместо users в запросах: параметры user_ids и tg_ids
+TARGET_SQL = 'SELECT * FROM unnest(%(user_ids)s::bigint[], %(tg_ids)s::bigint[]) AS target (id, tg_id)'
+
+
+class IdentityCache:
+    """
+    tg_id -> Identity(users.id, is_blocked, is_admin) for every user,
+    so hot queries can go to user_vocabulary by users.id without joining
+    users. Loaded at startup, updated by /start, BotBlocked and NOTIFY
+    from other processes. Unknown tg_ids are looked up in the database.
+    """
+
+    def __init__(self):
+        self.by_tg_id = {}
+        self._listener = None
+
+    def _identity(self, row):
+        return Identity(row['id'], row['is_blocked'], row['tg_id'] in ADMINS_ALL)
+
+    async def load(self):
+        rows = await db.fetchall(USERS_SQL)
+        self.by_tg_id = {row['tg_id']: self._identity(row) for row in rows}
+        logger.info(f'Identity cache: {len(self.by_tg_id)} users, {len(self.active_tg_ids())} active')
+
+    async def reload(self, tg_ids):
+        rows = await db.fetchall(SOME_USERS_SQL, {'tg_ids': list(tg_ids)})
+        for row in rows:
+            self.by_tg_id[row['tg_id']] = self._identity(row)
+        return rows
+
+    async def resolve(self, tg_ids):
+        """
+        tg_id -> Identity for the given users, unregistered ones are left out.
+        """
+        missing = [tg_id for tg_id in tg_ids if tg_id not in self.by_tg_id]
+        if missing:
+            await self.reload(missing)
+        return {tg_id: self.by_tg_id[tg_id] for tg_id in tg_ids if tg_id in self.by_tg_id}
+
+    async def get(self, tg_id):
+        return (await self.resolve([tg_id])).get(tg_id)
+
+    def remember(self, tg_id, user_id, is_blocked=False):
+        self.by_tg_id[tg_id] = Identity(user_id, is_blocked, tg_id in ADMINS_ALL)
+
+    def mark_blocked(self, tg_id):
+        identity = self.by_tg_id.get(tg_id)
+        if identity is not None:
+            self.by_tg_id[tg_id] = identity._replace(is_blocked=True)
+
+    def active_tg_ids(self):
+        return [tg_id for tg_id, identity in self.by_tg_id.items() if not identity.is_blocked]
+
+    async def _listen(self):
+        while True:
+            try:
+                async with await AsyncConnection.connect(db.pool.conninfo, autocommit=True) as conn:
+                    await conn.execute(f'LISTEN {CHANNEL}')
+                    # Пока соединения не было, изменения могли пройти мимо
+                    await self.load()
+                    async for notify in conn.notifies():
+                        await self.reload([int(notify.payload)])
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('Identity listener failed, reconnecting in 5 seconds')
+                await asyncio.sleep(5)
+
+    def start(self):
+        if self._listener is None:
+            self._listener = asyncio.create_task(self._listen())
+
+    async def stop(self):
+        if self._listener is not None:
+            self._listener.cancel()
+            await asyncio.gather(self._listener, return_exceptions=True)
+            self._listener = None
+
+
+identities = IdentityCache()
+
+
+async def ensure_schema():
+    for statement in SCHEMA:
+        await db.execute(statement)
@@ -4,26 +4,41 @@ import os
 import random
 import re
 from random import shuffle
-import sqlite3
 from typing import List
 
 from aiogram import Bot, Dispatcher, types, md
+from aiogram.bot.api import TelegramAPIServer
 from aiogram.dispatcher.filters import Text
-from aiogram.utils import exceptions, executor
+from aiogram.utils import executor
+from broadcast import broadcast, deliver
+from content_cache import content
+from metrics import HandlerTimingMiddleware, InstrumentedBot
+from distractors import distractors
+from enrollment import enroll_level, enroll_next_words
+from identity import identities
+from planner import plan_next_actions, due_candidates
+from poll_registry import polls, find_poll
+from progress_buffer import progress
 from safe_schedule import SafeScheduler
-import time
-from datetime import datetime, time, timedelta
-import psycopg
+from transcription import get_transcription
+from user_actors import actors
+from user_stats import collect_statistics
+from datetime import datetime
 from aiogram.utils.markdown import escape_md, quote_html
-from psycopg.rows import dict_row
 
-from constants import HELLO_MESSAGE, LEARNING_SOURCES, FEEDBACK, STATISTICS, transcribe_az_dict, ADM_HELP, Keyboard
-from secret_constants import TELEGRAM_API_TOKEN, POSTGRE_USER, POSTGRE_PWD, POSTGRE_DB_NAME
+import dashboard
+import db
+import metrics
+import migrations
+import outbox
+import progress_buffer
+import shards
+import webhook
+from constants import HELLO_MESSAGE, LEARNING_SOURCES, FEEDBACK, STATISTICS, ADM_HELP, ADMINS, ADMINS_ALL, Keyboard
+from secret_constants import TELEGRAM_API_TOKEN
+from settings import BOT_MODE, DASHBOARD_REFRESH_MINUTES, DISTRACTORS_PREFER_KNOWN, METRICS_ENABLED, OUTBOX_ENABLED, SHARD_MAX_ATTEMPTS, SHARD_WORKER_IN_BOT, TELEGRAM_API_SERVER
 
 path = os.path.dirname(os.path.abspath(__file__))
-conn = psycopg.connect(dbname=POSTGRE_DB_NAME, user=POSTGRE_USER, password=POSTGRE_PWD, host='localhost')
-conn.row_factory = dict_row
-c = conn.cursor()
 
 # Включаем логирование, чтобы не пропустить важные сообщения
 logging.basicConfig(
@@ -32,17 +47,56 @@ logging.basicConfig(
     datefmt="%Y-%m-%d %H:%M:%S"
 )
 # Объект бота
-bot = Bot(token=TELEGRAM_API_TOKEN, parse_mode=types.ParseMode.MARKDOWN_V2)
+BotClass = InstrumentedBot if METRICS_ENABLED else Bot
+if TELEGRAM_API_SERVER:
+    bot = BotClass(token=TELEGRAM_API_TOKEN, parse_mode=types.ParseMode.MARKDOWN_V2, server=TelegramAPIServer.from_base(TELEGRAM_API_SERVER))
+else:
+    bot = BotClass(token=TELEGRAM_API_TOKEN, parse_mode=types.ParseMode.MARKDOWN_V2)
 # Диспетчер
 dp = Dispatcher(bot)
+if METRICS_ENABLED:
+    dp.middleware.setup(HandlerTimingMiddleware())
 
 USER_IDS_TO_SEND_MESSAGES_TO = [127869357, 5632448031]
 MORNING_TIME = '05:30'
 EVENING_TIME = '15:30'
 SCHEDULE = [MORNING_TIME, EVENING_TIME]
 
-ADMINS = [127869357, 5632448031]
-ADMINS_ALL = [1, 9, 127869357, 5632448031]
+# Запросы горячего пути вынесены в константы, их планы проверяет benchmarks/explain_check.py
+REGISTER_USER_SQL = '''
+    INSERT INTO users (tg_id, username, first_name, registration_date)
+    VALUES (%s, %s, %s, %s)
+    ON CONFLICT (tg_id) DO UPDATE SET is_blocked = FALSE
+    RETURNING id
+'''
+
+MARK_BLOCKED_SQL = '''
+    UPDATE users
+    SET is_blocked = true
+    WHERE tg_id = %s
+'''
+
+SAVE_POLL_SQL = '''
+    UPDATE user_vocabulary
+    SET correct_answer_id = %s, poll_id = %s
+    WHERE
+    user_id = %s AND vocabulary_id = %s
+'''
+
+OLD_WORDS_BACK_SQL = '''
+    UPDATE user_vocabulary
+    SET num_right_guesses = num_right_guesses -2
+    WHERE id in (
+        SELECT id
+        FROM user_vocabulary
+        WHERE user_id = %s AND learning_stage(num_right_guesses) = 'review' AND due_at <= NOW()
+        ORDER BY due_at ASC
+        LIMIT 5
+    )
+'''
+
+MORE_WORDS_KEYBOARD = types.InlineKeyboardMarkup()
+MORE_WORDS_KEYBOARD.add(types.InlineKeyboardButton(text="Ещё слово", callback_data='learn_more '))
 
 
 @dp.message_handler(commands=['start'])
@@ -51,26 +105,12 @@ async def cmd_start(message: types.Message):
     username = message.from_user.username
     first_name = message.from_user.first_name
     now = datetime.now()
-    c.execute(
-        '''INSERT INTO users (tg_id, username, first_name, registration_date)
-        VALUES (%s, %s, %s, %s)
-        ON CONFLICT (tg_id) DO UPDATE SET is_blocked = FALSE''',
-        (tg_id, username, first_name, now)
-    )
-    conn.commit()
-    id = c.execute('SELECT id FROM users WHERE users.tg_id = %s', (tg_id,))
-    user_id = id.fetchone()['id']
-    words = c.execute('SELECT * FROM vocabulary WHERE level = 1')
-    words = words.fetchall()
-    logging.info(f"Words to add for {tg_id}: {words}")
-    for word in words:
-        c.execute(
-            '''INSERT INTO user_vocabulary (user_id, vocabulary_id, correct_answer_id, num_right_guesses, poll_id)
-            VALUES (%s, %s, %s, %s, %s)
-            ON CONFLICT DO NOTHING''',
-            (user_id, word["id"], -1, 0, None)
-        )
-        conn.commit()
+    async with db.transaction() as conn:
+        user = await conn.execute(REGISTER_USER_SQL, (tg_id, username, first_name, now))
+        user_id = (await user.fetchone())['id']
+        added = await enroll_level(conn, user_id, level=1)
+    identities.remember(tg_id, user_id)
+    logging.info(f"Added {len(added)} words for {tg_id}")
     logging.info(f"Registered user {tg_id}")
     await message.answer(HELLO_MESSAGE, reply_markup=default_menu(user_id))
     await send_alphabet(message)
@@ -88,31 +128,28 @@ async def words_now(message: types.Message):
 @dp.message_handler(commands=['adm_message'])
 async def send_to_all(message: types.Message):
     logging.info(f'Got admin broadcast message {message.md_text}')
-    c.execute('SELECT DISTINCT tg_id FROM users WHERE is_blocked = false')
-    ids = [row["tg_id"] for row in c.fetchall()]
+    ids = identities.active_tg_ids()
     tg_id = message.from_user.id
     if tg_id in ADMINS:
         broadcast_message = message.md_text.replace('/adm\\_message ', '')
-        for id in ids:
-            await bot.send_message(
-                chat_id=id,
-                text=broadcast_message,
-            )
+        await broadcast(
+            'adm_message',
+            ids,
+            lambda chat_id: send_message(chat_id, broadcast_message),
+            on_blocked=mark_blocked,
+            limit=not OUTBOX_ENABLED,
+        )
 
 
 @dp.message_handler(commands=['test_adm_message'])
 async def send_to_all(message: types.Message):
     logging.info(f'Got admin broadcast message {message.md_text}')
-    c.execute('SELECT DISTINCT tg_id FROM users WHERE is_blocked = false')
     ids = ADMINS
     tg_id = message.from_user.id
     if tg_id in ADMINS:
         broadcast_message = message.md_text.replace('/test\\_adm\\_message ', '')
         for id in ids:
-            await bot.send_message(
-                chat_id=id,
-                text=broadcast_message,
-            )
+            await send_message(id, broadcast_message)
 
 
 @dp.message_handler(Text('Ещё слово'))
@@ -146,48 +183,27 @@ async def adm_statistics(message: types.Message):
     tg_id = message.from_user.id
     if tg_id not in ADMINS_ALL:
         return
+    leaderboard, summary, fresh_registered = await dashboard.load()
     stat = 'Топ за вчера: \n\n'
-    top = c.execute(
-        '''SELECT MAX(level) as max_level, COUNT(word_az) as words_learned, (CASE WHEN (username IS NULL OR username = '') THEN tg_id::name ELSE username END) as user FROM user_vocabulary
-        JOIN users ON user_vocabulary.user_id = users.id
-        JOIN vocabulary ON user_vocabulary.vocabulary_id = vocabulary.id
-        WHERE NOW() - last_send <= interval '24 hours'
-        GROUP BY username, tg_id
-        ORDER BY words_learned DESC'''
-    ).fetchall()
-    top_manual = [user for user in top if user["words_learned"] > 1]
-    for top_man in top_manual[:40]:
+    for top_man in leaderboard:
         stat += f'@{top_man["user"]} - {top_man["words_learned"]} слов (Уровень {top_man["max_level"]})\n'
-    stat += f'\nАктивных за 24 часа: {len(top_manual)}\n\n'
+    stat += f'\nАктивных за 24 часа: {summary["active"]}\n\n'
     stat += '\nНедавно зарегистрировавшиеся:\n'
-    fresh_registered = c.execute(
-        '''
-            SELECT (CASE WHEN (username IS NULL OR username = '') THEN tg_id::name ELSE username END) as user, first_name, registration_date, is_blocked
-            FROM users
-            ORDER BY registration_date DESC
-            LIMIT 30
-        '''
-    ).fetchall()
     for registered in fresh_registered:
         stat += f'@{registered["user"]} {registered["first_name"]} - {registered["registration_date"]}. Блок: {registered["is_blocked"]}.\n'
-    today_registered = c.execute(
-        '''
-            SELECT COUNT(*)
-            FROM users
-            WHERE NOW() - registration_date <= interval '24 hours'
-        '''
-    ).fetchall()
-    yesterday_registered = c.execute(
-        '''
-            SELECT COUNT(*)
-            FROM users
-            WHERE NOW() - registration_date <= interval '48 hours' AND NOW() - registration_date > interval '24 hours'
-        '''
-    ).fetchall()
-    stat += f'\nЗарегистрировалось за сегодня: {today_registered[0]["count"]}'
-    stat += f'\nЗарегистрировалось за вчера: {yesterday_registered[0]["count"]}\n'
+    stat += f'\nЗарегистрировалось за сегодня: {summary["registered_today"]}'
+    stat += f'\nЗарегистрировалось за вчера: {summary["registered_yesterday"]}\n'
+    stat += f'\nОбновлено: {summary["refreshed_at"]:%H:%M}\n'
     logging.info(f'Adm message: {quote_html(stat)}')
-    await message.answer(text=quote_html(stat), parse_mode=types.ParseMode.HTML)
+    await send_message(message.chat.id, quote_html(stat), parse_mode=types.ParseMode.HTML)
+
+
+@dp.message_handler(commands=['adm_reload'])
+async def adm_reload(message: types.Message):
+    if message.from_user.id not in ADMINS:
+        return
+    await content.load()
+    await send_message(message.chat.id, escape_md(f'Словарь и уроки перечитаны, версия кэша {content.version}'))
 
 
 @dp.message_handler(Text(Keyboard.ADM_HELP.value))
@@ -195,21 +211,13 @@ async def adm_help(message: types.Message):
     tg_id = message.from_user.id
     if tg_id not in ADMINS_ALL:
         return
-    await message.answer(
-        text=ADM_HELP,
-    )
+    await send_message(message.chat.id, ADM_HELP)
 
 
 @dp.message_handler(Text('Уроки грамматики'))
 async def more_words(message: types.Message):
-    lessons = c.execute(
-        '''
-        SELECT * FROM lessons
-        ORDER BY learn_order ASC
-        '''
-    )
     reply_text = ''
-    for lesson in lessons:
+    for lesson in content.lessons:
         reply_text += f'{lesson["name"]} /lesson_{lesson["id"]}\n'
     await message.answer(text=escape_md(reply_text))
 
@@ -217,16 +225,9 @@ async def more_words(message: types.Message):
 @dp.message_handler(Text(startswith='/lesson_'))
 async def more_words(message: types.Message):
     lesson_id = re.search(r'\/lesson_(\d+)', message.text).group(1)
-    lessons = c.execute(
-        '''
-        SELECT * FROM lessons
-        WHERE id = %s
-        ORDER BY learn_order ASC
-        ''',
-        (lesson_id,)
-    )
+    lesson = content.lessons_by_id.get(int(lesson_id))
     reply_text = ''
-    for lesson in lessons:
+    if lesson is not None:
         reply_text += f'{lesson["link"]}\n'
     await message.answer(text=escape_md(reply_text))
 
@@ -242,15 +243,7 @@ async def more_words(callback_query: types.CallbackQuery):
         user_id = parsed.group(2)
         word_id = parsed.group(3)
         dt = datetime.now()
-        c.execute(
-            '''
-            UPDATE user_vocabulary
-            SET num_right_guesses = 10, poll_id = NULL, correct_answer_id = -1, last_send = %s
-            WHERE user_id = %s AND vocabulary_id = %s
-            ''',
-            (dt, user_id, word_id)
-        )
-        conn.commit()
+        await progress.add(callback_query.from_user.id, int(user_id), int(word_id), dt, set_to=10)
         await callback_query.message.answer('Слово помечено выученным')
         await bot.delete_message(callback_query.message.chat.id, callback_query.message.message_id)
         await words_now(callback_query.message)
@@ -262,148 +255,198 @@ async def more_words(callback_query: types.CallbackQuery):
 
 # Define a function to send the messages
 @dp.message_handler()
-async def send_messages(id: int = None, fast: bool = False, silent: bool = False):
-    c.execute('SELECT DISTINCT tg_id FROM users WHERE is_blocked = false')
-    USER_IDS_TO_SEND_MESSAGES_TO = [row["tg_id"] for row in c.fetchall()]
-    ids_to_send = [id] if id else USER_IDS_TO_SEND_MESSAGES_TO
-    logging.info(f"Checking messages to {ids_to_send}")
-    for user_id in ids_to_send:
-        try:
-            word_translation = []
-            az_ru_quiz = []
-            ru_az_quiz = []
-            words = c.execute(
-                '''SELECT word_az, word_ru, word_emoji, user_id, vocabulary_id, num_right_guesses, last_send FROM user_vocabulary
-                JOIN users ON user_vocabulary.user_id = users.id
-                JOIN vocabulary ON user_vocabulary.vocabulary_id = vocabulary.id
-                WHERE users.tg_id = %s AND user_vocabulary.num_right_guesses < 10
-                ORDER BY random()''',
-                (user_id,)
-            )
-            words = words.fetchall()
-            user_in_voc_id = words[0]['user_id']
-            for word in words:
-                if word['num_right_guesses'] < 2:
-                    word_translation.append(word)
-                elif word['num_right_guesses'] > 7:
-                    ru_az_quiz.append(word)
-                else:
-                    az_ru_quiz.append(word)
-            logging.info(f'User {user_id} ru_az:{len(ru_az_quiz)}, az_ru:{len(az_ru_quiz)}, plain:{len(word_translation)}')
-            logging.info(f'User {user_id} learned {len(get_asked_words(words))} words today')
-            if len(get_asked_words(words)) >= 70:
-                if not silent:
-                    await bot.send_message(
-                        chat_id=user_id,
-                        text=md.escape_md(f'''За последние 6 часов было показано 70 слов! Отдохните и возвращайтесь позже 🙃'''),
-                        reply_markup=default_menu(user_id)
-                    )
-                continue
-            if len(ru_az_quiz) > 10:
-                ru_az_quiz = get_unasked_words(ru_az_quiz)
-                if len(ru_az_quiz) > 0:
-                    await translation_quiz(user_id, words, ru_az_quiz, 'word_ru', 'word_az', is_fast=fast)
-                    continue
-            if len(az_ru_quiz) > 20:
-                az_ru_quiz = get_unasked_words(az_ru_quiz)
-                if len(az_ru_quiz) > 0:
-                    await translation_quiz(user_id, words, az_ru_quiz, 'word_az', 'word_ru', is_fast=fast)
-                    continue
-            if len(word_translation) > 20:
-                word_translation = get_unasked_words(word_translation)
-                if len(word_translation) >= 5:
-                    await new_words_message(user_id, user_in_voc_id, word_translation)
-                    continue
-            new_words = add_new_words_for_user(user_in_voc_id)
-            check_old_words(user_in_voc_id)
-            if len(new_words) >= 5:
-                await new_words_message(user_id, user_in_voc_id, new_words)
-            else:
-                if not silent:
-                    await bot.send_message(
-                        chat_id=user_id,
-                        text=md.escape_md(f'''На текущий момент это все слова, которые есть в боте, хорошая работа! Скоро будут новые наборы :)'''),
-                        reply_markup=default_menu(user_id)
-                    )
-                continue
-
-        except exceptions.BotBlocked:
-            logging.warning(f"Bot was blocked by user {user_id}")
-            c.execute(
-                '''
-                UPDATE users
-                SET is_blocked = true
-                WHERE tg_id = %s
-                ''',
-                (user_id,)
+@metrics.timed(metrics.HANDLER_SECONDS, handler='send_messages')
+async def send_messages(id: int = None, fast: bool = False, silent: bool = False, tg_ids=None):
+    if id:
+        logging.info(f"Checking messages to {id}")
+        # Частые нажатия и ответы одного пользователя выполняются по очереди и схлопываются в один
+        await actors.run(id, lambda: deliver(id, lambda user_id: send_user_message(user_id, fast=fast, silent=silent), on_blocked=mark_blocked))
+        return
+    plans = await plan_next_actions(tg_ids)
+    logging.info(f"Checking messages to {len(plans)} users")
+    # Рассылка идёт через те же очереди пользователей, что и кнопки с ответами,
+    # иначе её сообщение может разойтись с тем, что отправляет нажатие
+    await broadcast(
+        'send_messages',
+        plans.keys(),
+        lambda user_id: actors.call(
+            user_id, lambda: send_user_message(user_id, fast=fast, silent=silent, plan=plans[user_id])
+        ),
+        on_blocked=mark_blocked,
+        limit=not OUTBOX_ENABLED,
+    )
+
+
+async def send_user_message(user_id, fast: bool = False, silent: bool = False, plan=None):
+    if plan is None:
+        plan = (await plan_next_actions([user_id])).get(user_id)
+        if plan is None:
+            logging.warning(f'User {user_id} is not registered')
+            return
+    if actors.is_stale():
+        logging.info(f'User {user_id} sent something newer, skipping this message')
+        return
+    user_in_voc_id = plan['user_id']
+    words = plan['candidates']
+    logging.info(f'User {user_id} ru_az:{plan["ru_az"]}, az_ru:{plan["az_ru"]}, plain:{plan["plain"]}')
+    logging.info(f'User {user_id} learned {plan["asked"]} words today')
+    if plan['asked'] >= 70:
+        if not silent:
+            text = md.escape_md(f'''За последние 6 часов было показано 70 слов! Отдохните и возвращайтесь позже 🙃''')
+            await send_message(user_id, text, reply_markup=default_menu(user_id))
+        return
+    if plan['ru_az'] > 10:
+        ru_az_quiz = due_candidates(plan, 'ru_az')
+        if len(ru_az_quiz) > 0:
+            await translation_quiz(user_id, words, ru_az_quiz, 'word_ru', 'word_az', is_fast=fast)
+            return
+    if plan['az_ru'] > 20:
+        az_ru_quiz = due_candidates(plan, 'az_ru')
+        if len(az_ru_quiz) > 0:
+            await translation_quiz(user_id, words, az_ru_quiz, 'word_az', 'word_ru', is_fast=fast)
+            return
+    if plan['plain'] > 20:
+        word_translation = due_candidates(plan, 'plain')
+        if len(word_translation) >= 5:
+            await new_words_message(user_id, user_in_voc_id, word_translation)
+            return
+    new_words = await enroll_next_words(user_in_voc_id)
+    await check_old_words(user_in_voc_id)
+    if len(new_words) >= 5:
+        await new_words_message(user_id, user_in_voc_id, new_words)
+    else:
+        if not silent:
+            await send_message(
+                user_id,
+                md.escape_md(f'''На текущий момент это все слова, которые есть в боте, хорошая работа! Скоро будут новые наборы :)'''),
+                reply_markup=default_menu(user_id)
             )
-            await asyncio.sleep(1)
-        except exceptions.ChatNotFound:
-            logging.warning(f"Chat not found for user {user_id}")
-        except exceptions.RetryAfter as e:
-            logging.warning(f"Rate limited. Sleeping for {e.timeout} seconds")
-            await asyncio.sleep(e.timeout)
-        except exceptions.TelegramAPIError as e:
-            logging.exception(f"Failed to send message to user {user_id}. Exception: {e}")
-        except Exception as e:
-            logging.exception(f"Something happened: {e}")
+
+
+async def mark_blocked(user_id):
+    identities.mark_blocked(user_id)
+    await db.execute(MARK_BLOCKED_SQL, (user_id,))
+
+
+async def send_message(chat_id, text, reply_markup=None, **params):
+    """
+    bot.send_message, or the same call queued in the outbox when it is enabled.
+    """
+    if OUTBOX_ENABLED:
+        payload = {'chat_id': chat_id, 'text': text, **params}
+        if reply_markup is not None:
+            payload['reply_markup'] = reply_markup.to_python()
+        await outbox.post(chat_id, 'send_message', payload)
+        return
+    await bot.send_message(chat_id=chat_id, text=text, reply_markup=reply_markup, **params)
 
 
 @dp.poll_answer_handler()
 async def poll_answer(poll_answer: types.PollAnswer):
     poll_id = poll_answer.poll_id
     answer_ids = poll_answer.option_ids
-    answers = c.execute(
-        '''SELECT correct_answer_id FROM user_vocabulary
-        WHERE poll_id = %s''',
-        (poll_id,)
-    )
-    answer = answers.fetchall()[0]['correct_answer_id']
+    poll = await find_poll(poll_id)
+    if poll is None:
+        logging.warning(f'Unknown poll {poll_id}')
+        return
+    answer = poll.correct_answer_id
     logging.info(f'Poll answer! Got {answer_ids[0]}, right is {answer}! You are {answer == answer_ids[0]}')
     dt = datetime.now()
-    if answer == answer_ids[0]:
-        c.execute(
-            '''
-            UPDATE user_vocabulary
-            SET num_right_guesses = num_right_guesses + 1, poll_id = NULL, correct_answer_id = -1, last_send = %s
-            WHERE
-            poll_id = %s
-            ''',
-            (dt, poll_id,)
-        )
-    else:
-        c.execute(
-            '''
-            UPDATE user_vocabulary
-            SET num_right_guesses = num_right_guesses - 1, poll_id = NULL, correct_answer_id = -1, last_send = %s
-            WHERE
-            poll_id = %s
-            ''',
-            (dt, poll_id,)
-        )
-    conn.commit()
+    delta = 1 if answer == answer_ids[0] else -1
+    await progress.add(poll_answer.user.id, poll.user_id, poll.vocabulary_id, dt, delta=delta)
     await send_messages(poll_answer.user.id, fast=True)
 
 
 async def scheduler():
     schedule = SafeScheduler()
-    schedule.every().day.at("05:30").do(send_statistics_by_ids, ids=[])
+    # Рассылку, опоздавшую больше чем на полчаса, пропускаем, а не шлём посреди дня.
+    # Здесь она только ставится в shard_jobs: защита от наложения запусков, таймаут
+    # и метрики длительности — в shards.enqueue и ShardWorker
+    schedule.every().day.at("05:30").grace(30 * 60).timeout(60).do(
+        shards.enqueue, 'send_statistics', max_attempts=SHARD_SEND_ATTEMPTS
+    )
+    schedule.every(DASHBOARD_REFRESH_MINUTES).minutes.jitter(30).timeout(5 * 60).do(dashboard.refresh)
+    schedule.every().day.at("03:00").timeout(30 * 60).do(outbox.cleanup)
     for time in SCHEDULE:
-        schedule.every().day.at(time).do(send_messages, silent=True)
-    while True:
-        await schedule.run_pending()
-        await asyncio.sleep(1)
+        schedule.every().day.at(time).grace(30 * 60).timeout(60).do(
+            shards.enqueue, 'send_messages', silent=True, max_attempts=SHARD_SEND_ATTEMPTS
+        )
+    await schedule.run_forever()
+
+
+# Плановые рассылки выполняются по частям, см. shards.py
+SHARD_JOBS = {
+    'send_messages': lambda tg_ids, **params: send_messages(tg_ids=tg_ids, **params),
+    'send_statistics': lambda tg_ids: send_statistics_by_ids(tg_ids),
+}
+# Повтор части заново шлёт всем её пользователям. Без outbox сообщения уходят
+# сразу и повторно получат их и те, кто уже получил, поэтому части не повторяются
+SHARD_SEND_ATTEMPTS = SHARD_MAX_ATTEMPTS if OUTBOX_ENABLED else 1
+shard_worker = shards.ShardWorker(SHARD_JOBS)
 
 
 async def on_startup(dp):
+    await db.open_pool()
+    await migrations.setup()
+    await content.load()
+    content.start()
+    await identities.load()
+    identities.start()
+    progress.start()
+    start_outbox()
+    await metrics.start_server()
+    if SHARD_WORKER_IN_BOT:
+        shard_worker.start()
+
+
+def start_outbox():
+    if OUTBOX_ENABLED:
+        outbox.sender.start(bot, on_sent={'send_poll': poll_sent}, on_blocked=mark_blocked)
+
+
+async def start_scheduler(dp):
     asyncio.create_task(scheduler())
 
 
+async def on_shutdown(dp):
+    await metrics.stop_server()
+    await shard_worker.stop()
+    await outbox.sender.stop()
+    await content.stop()
+    await identities.stop()
+    await progress.stop()
+    await db.close_pool()
+
+
+async def run_shard_worker():
+    """
+    Process that only runs shards of the scheduled broadcasts, without the
+    dispatcher. Start several next to the bot: BOT_MODE=worker python main.py
+    """
+    await db.open_pool()
+    await content.load()
+    content.start()
+    await identities.load()
+    identities.start()
+    progress.start()
+    start_outbox()
+    await metrics.start_server()
+    try:
+        await shard_worker.run()
+    finally:
+        await on_shutdown(dp)
+        await bot.close()
+
+
 async def translation_quiz(user_id, words: List, right_words: List, from_lang: str, to_lang: str, is_fast: bool = False):
     right_word = random.choice(right_words)
     logging.info(f'Word for user {user_id}: {right_word}')
-    words = list(filter(lambda word: word['word_ru'] != right_word['word_ru'], words))
-    wrong_words = words[:3]
+    # На поздней стадии варианты похожей длины, чтобы было сложнее угадать
+    wrong_words = distractors.pick(
+        right_word, to_lang,
+        hard=right_word.get('stage') == 'ru_az',
+        prefer=words if DISTRACTORS_PREFER_KNOWN else (),
+    )
     answers = [word[to_lang] for word in wrong_words] + [right_word[to_lang]]
     shuffle(answers)
     right_answer_index = answers.index(right_word[to_lang])
@@ -429,31 +472,30 @@ async def translation_quiz(user_id, words: List, right_words: List, from_lang: s
     }
     if is_fast:
         poll_params['open_period'] = 60
+    if OUTBOX_ENABLED:
+        poll_params['reply_markup'] = keyboard.to_python()
+        meta = {'user_id': right_word['user_id'], 'vocabulary_id': right_word['vocabulary_id'], 'correct_answer_id': right_answer_index}
+        key = f'poll:{right_word["user_id"]}:{right_word["vocabulary_id"]}:{datetime.now():%Y%m%d%H%M}'
+        await outbox.post(user_id, 'send_poll', poll_params, meta=meta, key=key)
+        return
     message_poll_id: types.Message = await bot.send_poll(**poll_params)
+    await save_poll(message_poll_id, right_word['user_id'], right_word['vocabulary_id'], right_answer_index)
+
+
+async def save_poll(message_poll_id: types.Message, user_id, vocabulary_id, correct_answer_id):
     logging.info(f'Message poll: {message_poll_id.poll.id}')
-    c.execute(
-        '''
-        UPDATE user_vocabulary
-        SET correct_answer_id = %s, poll_id = %s
-        WHERE
-        user_id = %s AND vocabulary_id = %s
-        ''',
-        (right_answer_index, message_poll_id.poll.id, right_word['user_id'], right_word['vocabulary_id'],)
-    )
-    conn.commit()
+    polls.add(message_poll_id.poll.id, user_id, vocabulary_id, correct_answer_id)
+    await db.execute(SAVE_POLL_SQL, (correct_answer_id, message_poll_id.poll.id, user_id, vocabulary_id,))
+
+
+async def poll_sent(meta, message_poll_id: types.Message):
+    # Опрос ушёл из outbox, теперь известен его poll_id
+    await save_poll(message_poll_id, meta['user_id'], meta['vocabulary_id'], meta['correct_answer_id'])
 
 
 async def new_words_message(user_id, internal_user_id, learn_words: List):
     message = ''
     learn_words = learn_words[:5]
-    keyboard = types.InlineKeyboardMarkup()
-    button = types.InlineKeyboardButton(
-        text=f"Ещё слово",
-        callback_data=f'learn_more '
-    )
-    keyboard.add(button)
-    menu_keyboard = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    menu_keyboard.add("Ещё слово", "Произношение букв")
     dt = datetime.now()
     for word in learn_words:
         if word['num_right_guesses'] == -1:
@@ -461,17 +503,18 @@ async def new_words_message(user_id, internal_user_id, learn_words: List):
         else:
             escaped = f'{escape_md(word["word_emoji"])} {escape_md(word["word_ru"])} \- ||{escape_md(word["word_az"])} \[{escape_md(get_transcription(word))}\]||'
         message += f'{escaped}\n'
-        c.execute(
-            '''
-            UPDATE user_vocabulary
-            SET num_right_guesses = num_right_guesses + 1, poll_id = NULL, correct_answer_id = -1, last_send = %s
-            WHERE
-            user_id = %s AND vocabulary_id = %s
-            ''',
-            (dt, internal_user_id, word['vocabulary_id'])
-        )
-        conn.commit()
-    await bot.send_message(user_id, text=message, reply_markup=keyboard)
+    if OUTBOX_ENABLED:
+        # Отложенные изменения этих слов пишутся раньше: иначе буфер потом затрёт
+        # last_send и счётчик, записанные здесь мимо него
+        await progress.flush([user_id])
+        # Слова помечаются показанными в одной транзакции с постановкой сообщения в очередь
+        async with db.transaction() as conn:
+            await progress_buffer.write(conn, [(internal_user_id, word['vocabulary_id'], None, 1, dt) for word in learn_words])
+            await outbox.enqueue(conn, user_id, 'send_message', {'chat_id': user_id, 'text': message, 'reply_markup': MORE_WORDS_KEYBOARD.to_python()})
+        return
+    # Все слова сообщения одной записью, а не UPDATE и commit на каждое
+    await progress.add_many(user_id, [(internal_user_id, word['vocabulary_id'], dt, 1) for word in learn_words])
+    await bot.send_message(user_id, text=message, reply_markup=MORE_WORDS_KEYBOARD)
 
 
 async def send_alphabet(message: types.Message):
@@ -483,177 +526,58 @@ async def send_alphabet(message: types.Message):
 
 
 async def send_statistics_by_ids(ids):
-    if not len(ids):
-        # ids = ADMINS
-        c.execute('SELECT DISTINCT tg_id FROM users WHERE is_blocked = false')
-        ids = [row["tg_id"] for row in c.fetchall()]
-    for user_id in ids:
-        try:
-            logging.info(f'Getting statistics for {user_id}')
-            start_learning = []
-            active_learning = []
-            learned_words = []
-            max_level = 0
-            words = c.execute(
-                '''SELECT num_right_guesses, level FROM user_vocabulary
-                JOIN users ON user_vocabulary.user_id = users.id
-                JOIN vocabulary ON user_vocabulary.vocabulary_id = vocabulary.id
-                WHERE users.tg_id = %s AND user_vocabulary.num_right_guesses >= 0
-                ORDER BY random()''',
-                (user_id,)
-            )
-            words = words.fetchall()
-            for word in words:
-                if word['num_right_guesses'] >= 10:
-                    learned_words.append(word)
-                elif word['num_right_guesses'] >= 2:
-                    active_learning.append(word)
-                else:
-                    start_learning.append(word)
-            max_level = max([word['level'] for word in words])
-            message_to_send = STATISTICS.format(max_level, len(learned_words), len(active_learning), len(start_learning))
-            logging.info(f'Statistics for {user_id}: {message_to_send}')
-            await bot.send_message(
-                chat_id=user_id,
-                text=message_to_send,
-                reply_markup=default_menu(user_id)
-            )
-        except exceptions.BotBlocked:
-            logging.warning(f"Bot was blocked by user {user_id}")
-            await asyncio.sleep(1)
-        except exceptions.ChatNotFound:
-            logging.warning(f"Chat not found for user {user_id}")
-        except exceptions.RetryAfter as e:
-            logging.warning(f"Rate limited. Sleeping for {e.timeout} seconds")
-            await asyncio.sleep(e.timeout)
-        except exceptions.TelegramAPIError:
-            logging.exception(f"Failed to send message to user {user_id}")
-        except Exception as e:
-            logging.exception(f"Something happened: {e}")
-
-
-def add_new_words_for_user(user_id):
-    word_to_add = c.execute(
-        '''SELECT id as vocabulary_id, word_az, word_ru, word_emoji, level FROM (SELECT user_id, vocabulary_id FROM user_vocabulary
-        WHERE user_id = %s) AS user_words
-        RIGHT JOIN vocabulary ON user_words.vocabulary_id = vocabulary.id
-        WHERE user_words.user_id IS NULL
-        ORDER BY vocabulary.level ASC
-        LIMIT 20''',
-        (user_id,)
-    ).fetchall()
-    for word in word_to_add:
-        c.execute(
-            '''INSERT INTO user_vocabulary (user_id, vocabulary_id, correct_answer_id, num_right_guesses, poll_id)
-            VALUES (%s, %s, %s, %s, %s)
-            ON CONFLICT DO NOTHING''',
-            (user_id, word["vocabulary_id"], -1, -1, None)
-        )
-        conn.commit()
-        word['num_right_guesses'] = -1
-    return word_to_add
+    # Пустой список — ежедневный отчёт всем незаблокированным
+    stats = await collect_statistics(ids or None)
+    if len(ids) == 1:
+        await deliver(ids[0], lambda user_id: send_user_statistics(user_id, stats.get(user_id)), on_blocked=mark_blocked)
+        return
+    await broadcast(
+        'send_statistics',
+        stats.keys(),
+        lambda user_id: send_user_statistics(user_id, stats[user_id]),
+        on_blocked=mark_blocked,
+        limit=not OUTBOX_ENABLED,
+    )
 
 
-def default_menu(user_id=0) -> types.ReplyKeyboardMarkup:
+async def send_user_statistics(user_id, stats=None):
+    logging.info(f'Getting statistics for {user_id}')
+    if stats is None:
+        stats = (await collect_statistics([user_id])).get(user_id)
+        if stats is None:
+            logging.info(f'User {user_id} not found')
+            return
+    message_to_send = STATISTICS.format(stats['max_level'], stats['learned'], stats['active'], stats['new'])
+    logging.info(f'Statistics for {user_id}: {message_to_send}')
+    await send_message(user_id, message_to_send, reply_markup=default_menu(user_id))
+
+
+def build_menu(is_admin=False) -> types.ReplyKeyboardMarkup:
     menu_keyboard = types.ReplyKeyboardMarkup(resize_keyboard=True)
     menu_keyboard.add("Ещё слово", "Уроки грамматики", "Мой прогресс", "Произношение букв", "Ресурсы по изучению 🇦🇿", "Предложения по боту")
-    if user_id in ADMINS_ALL:
+    if is_admin:
         menu_keyboard.add(Keyboard.ADM_STAT.value, Keyboard.ADM_HELP.value)
     return menu_keyboard
 
 
-def get_unasked_words(words):
-    dt = datetime.now()
-    words_to_ask = []
-    for word in words:
-        if word['last_send'] is None:
-            words_to_ask.append(word)
-        elif dt - word['last_send'] >= timedelta(hours=6):
-            words_to_ask.append(word)
-    return words_to_ask
+# Клавиатуры не меняются, собираем их один раз
+MENU = build_menu()
+ADMIN_MENU = build_menu(is_admin=True)
 
 
-def get_asked_words(words):
-    dt = datetime.now()
-    words_to_ask = []
-    for word in words:
-        if word['last_send'] is None:
-            continue
-        elif dt - word['last_send'] < timedelta(hours=6):
-            words_to_ask.append(word)
-    return words_to_ask
-
-
-def get_transcription(word):
-    transcription = word.get('transcription', '')
-    if transcription == '':
-        transcription = transcription_inner(word['word_az'])
-    return transcription
-
-
-def transcription_inner(word: str):
-    transcription = ''
-    is_start = True
-    is_end = False
-    count = 0
-    letter_after = word[1]
-    letter_before = ''
-    for letter in word:
-        transcribe_part = ''
-        is_transcribed = False
-        letter = letter.lower()
-        is_end = (count == len(word) - 1)
-        if not is_end:
-            letter_after = word[count + 1]
-        if not is_start:
-            letter_before = word[count - 1]
-        if letter in transcribe_az_dict:
-            transcription_rule = transcribe_az_dict[letter]
-            if is_start & ('start' in transcription_rule):
-                transcribe_part = transcription_rule['start']
-                is_transcribed = True
-            if 'after' in transcription_rule:
-                for key in transcription_rule['after']:
-                    if letter_before in key:
-                        transcribe_part = transcription_rule['after'][key]
-                        is_transcribed = True
-            if 'before' in transcription_rule:
-                for key in transcription_rule['before']:
-                    if letter_after in key:
-                        transcribe_part = transcription_rule['before'][key]
-                        is_transcribed = True
-            if not is_transcribed:
-                transcribe_part = transcription_rule['regular']
-        else:
-            transcribe_part = letter
-        transcription += transcribe_part
-        is_start = False
-        count += 1
-    return transcription
+def default_menu(user_id=0) -> types.ReplyKeyboardMarkup:
+    return ADMIN_MENU if user_id in ADMINS_ALL else MENU
 
 
-def check_old_words(internal_user_id):
+async def check_old_words(internal_user_id):
     if internal_user_id in ADMINS_ALL:
-        c.execute(
-            '''
-            UPDATE user_vocabulary
-            SET num_right_guesses = num_right_guesses -2
-            WHERE id in (
-                SELECT id
-                FROM user_vocabulary
-                WHERE user_id = %s AND NOW() - last_send > interval '1 month' AND num_right_guesses >= 10
-                ORDER BY last_send ASC
-                LIMIT 5
-            )
-            ''',
-            (internal_user_id,)
-        )
-        conn.commit()
+        await db.execute(OLD_WORDS_BACK_SQL, (internal_user_id,))
 
 
 if __name__ == "__main__":
-    c.execute('SELECT DISTINCT tg_id FROM users WHERE is_blocked = false')
-    USER_IDS_TO_SEND_MESSAGES_TO = [row["tg_id"] for row in c.fetchall()]
-    logging.info(USER_IDS_TO_SEND_MESSAGES_TO)
-
-    executor.start_polling(dp, skip_updates=False, on_startup=on_startup)
+    if BOT_MODE == 'webhook':
+        webhook.run(dp, on_startup=[on_startup], on_shutdown=[on_shutdown], primary_startup=[start_scheduler])
+    elif BOT_MODE == 'worker':
+        asyncio.run(run_shard_worker())
+    else:
+        executor.start_polling(dp, skip_updates=False, on_startup=[on_startup, start_scheduler], on_shutdown=on_shutdown)
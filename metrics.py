@@ -0,0 +1,270 @@
+import functools
+import logging
+import re
+import time
+from bisect import bisect_left
+
+from aiogram import Bot
+from aiogram.dispatcher.handler import current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiohttp import web
+
+from settings import METRICS_ENABLED, METRICS_HOST, METRICS_PORT
+
+
+logger = logging.getLogger('metrics')
+
+# Метрики в текстовом формате Prometheus на http://METRICS_HOST:METRICS_PORT/metrics.
+# При METRICS_ENABLED=0 inc / observe / set подменяются пустыми функциями,
+# а timed() возвращает функцию как есть.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 1800)
+
+_metrics = []
+_collectors = []
+
+
+def _noop(*args, **kwargs):
+    pass
+
+
+def _labels_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, enabled=METRICS_ENABLED):
+        self.name = name
+        self.documentation = documentation
+        self.values = {}
+        if enabled:
+            _metrics.append(self)
+        else:
+            self.inc = self.observe = self.set = _noop
+
+    def header(self):
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+
+    def render(self):
+        return self.header() + [f'{self.name}{_format_labels(key)} {value}' for key, value in self.values.items()]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = _labels_key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        self.values[_labels_key(labels)] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, buckets=LATENCY_BUCKETS, enabled=METRICS_ENABLED):
+        super().__init__(name, documentation, enabled)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = _labels_key(labels)
+        series = self.values.get(key)
+        if series is None:
+            # счётчики по корзинам, потом сумма и количество
+            series = self.values[key] = [0] * len(self.buckets) + [0.0, 0]
+        index = bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            series[index] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def render(self):
+        lines = self.header()
+        for key, series in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{_format_labels(key, [("le", bound)])} {cumulative}')
+            lines.append(f'{self.name}_bucket{_format_labels(key, [("le", "+Inf")])} {series[-1]}')
+            lines.append(f'{self.name}_sum{_format_labels(key)} {series[-2]}')
+            lines.append(f'{self.name}_count{_format_labels(key)} {series[-1]}')
+        return lines
+
+
+HANDLER_SECONDS = Histogram('azbot_handler_seconds', 'Time spent in update handlers')
+DB_SECONDS = Histogram('azbot_db_seconds', 'Time spent in SQL statements')
+DB_ERRORS = Counter('azbot_db_errors_total', 'Failed SQL statements')
+DB_POOL = Gauge('azbot_db_pool', 'Connection pool stats from psycopg_pool')
+TELEGRAM_SECONDS = Histogram('azbot_telegram_seconds', 'Telegram Bot API call latency')
+TELEGRAM_ERRORS = Counter('azbot_telegram_errors_total', 'Telegram Bot API errors by class')
+BROADCAST_MESSAGES = Counter('azbot_broadcast_messages_total', 'Broadcast outcomes')
+BROADCAST_DONE = Gauge('azbot_broadcast_done', 'Users processed by the current or last broadcast')
+BROADCAST_TOTAL = Gauge('azbot_broadcast_users', 'Users in the current or last broadcast')
+BROADCAST_RATE = Gauge('azbot_broadcast_users_per_second', 'Throughput of the current or last broadcast')
+JOB_SECONDS = Histogram('azbot_job_seconds', 'Scheduler job durations')
+JOB_RUNS = Counter('azbot_job_runs_total', 'Scheduler job runs by result')
+
+
+def collector(function):
+    """
+    Registers a function called right before rendering, e.g. to read gauges
+    from another object. Not registered when metrics are disabled.
+    """
+    if METRICS_ENABLED:
+        _collectors.append(function)
+    return function
+
+
+def render():
+    for function in _collectors:
+        try:
+            function()
+        except Exception:
+            logger.exception(f'Metrics collector {function.__name__} failed')
+    lines = []
+    for metric in _metrics:
+        lines += metric.render()
+    return '\n'.join(lines) + '\n'
+
+
+def timed(histogram, **labels):
+    """
+    Decorator for coroutine functions: observes their duration.
+    """
+    def decorator(function):
+        if not METRICS_ENABLED:
+            return function
+
+        @functools.wraps(function)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await function(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - started, **labels)
+        wrapper.metrics_timed = True
+        return wrapper
+    return decorator
+
+
+SQL_TABLE = re.compile(r'\b(?:FROM|INTO|UPDATE|JOIN|TABLE|VIEW)\s+(?:IF\s+(?:NOT\s+)?EXISTS\s+)?(?:CONCURRENTLY\s+)?(\w+)', re.I)
+
+
+@functools.lru_cache(maxsize=1024)
+def statement_name(query):
+    """
+    Short label for a SQL statement: the command and the first table,
+    e.g. 'UPDATE user_vocabulary'. Queries are module constants, so the
+    number of labels stays small.
+    """
+    words = query.split()
+    if not words:
+        return 'empty'
+    command = words[0].upper()
+    table = SQL_TABLE.search(query)
+    return f'{command} {table.group(1)}' if table else command
+
+
+class HandlerTimingMiddleware(BaseMiddleware):
+    """
+    Observes the duration of every message, callback query and poll answer
+    handler, labelled with the handler's function name.
+    """
+
+    def _start(self, data):
+        handler = current_handler.get()
+        if getattr(handler, 'metrics_timed', False):
+            return
+        data['metrics_handler'] = getattr(handler, '__name__', 'unknown')
+        data['metrics_started'] = time.perf_counter()
+
+    def _finish(self, data):
+        if 'metrics_started' in data:
+            HANDLER_SECONDS.observe(time.perf_counter() - data['metrics_started'], handler=data['metrics_handler'])
+
+    async def on_process_message(self, message, data):
+        self._start(data)
+
+    async def on_post_process_message(self, message, results, data):
+        self._finish(data)
+
+    async def on_process_callback_query(self, callback_query, data):
+        self._start(data)
+
+    async def on_post_process_callback_query(self, callback_query, results, data):
+        self._finish(data)
+
+    async def on_process_poll_answer(self, poll_answer, data):
+        self._start(data)
+
+    async def on_post_process_poll_answer(self, poll_answer, results, data):
+        self._finish(data)
+
+
+class InstrumentedBot(Bot):
+    """
+    Bot that observes the latency of every Bot API call and counts errors
+    by exception class (RetryAfter, BotBlocked, ChatNotFound...).
+    """
+
+    async def request(self, method, data=None, files=None, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await super().request(method, data, files, **kwargs)
+        except Exception as e:
+            TELEGRAM_ERRORS.inc(method=method, error=type(e).__name__)
+            raise
+        finally:
+            TELEGRAM_SECONDS.observe(time.perf_counter() - started, method=method)
+
+
+async def handle_metrics(request):
+    return web.Response(text=render(), content_type='text/plain', charset='utf-8')
+
+
+_runner = None
+
+
+async def start_server(host=METRICS_HOST, port=METRICS_PORT, attempts=16):
+    """
+    Serves /metrics. Several processes on one host (webhook workers,
+    BOT_MODE=worker) take the next free port after METRICS_PORT.
+    """
+    global _runner
+    if not METRICS_ENABLED or _runner is not None:
+        return
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    for candidate in range(port, port + attempts):
+        try:
+            await web.TCPSite(runner, host, candidate).start()
+        except OSError:
+            continue
+        _runner = runner
+        logger.info(f'Metrics on http://{host}:{candidate}/metrics')
+        return
+    await runner.cleanup()
+    logger.warning(f'No free port for metrics in {port}-{port + attempts - 1}')
+
+
+async def stop_server():
+    global _runner
+    if _runner is not None:
+        await _runner.cleanup()
+        _runner = None
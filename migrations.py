@@ -0,0 +1,172 @@
+import logging
+
+import content_cache
+import dashboard
+import db
+import due_queue
+import identity
+import outbox
+import shards
+import transcription
+import user_progress
+
+
+logger = logging.getLogger('migrations')
+
+# Номер блокировки, чтобы процессы, стартующие одновременно, не применяли миграции дважды
+LOCK_ID = 461742
+# Блокировка на всю настройку схемы при старте: воркеры webhook стартуют одновременно,
+# а DROP / CREATE TRIGGER и заполнение user_progress в модулях не переживают гонку
+SETUP_LOCK_ID = 461743
+
+SCHEMA_MIGRATIONS_SQL = '''
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+        version integer PRIMARY KEY,
+        name text NOT NULL,
+        applied_at timestamp NOT NULL DEFAULT NOW()
+    )
+'''
+
+# Базовые таблицы бота и индексы горячих запросов. Применяются по порядку,
+# каждая миграция в своей транзакции и один раз. Таблицы и триггеры модулей
+# (due_queue, user_progress, outbox...) создаются их ensure_schema после миграций.
+# Новые изменения добавляются новой версией в конец, старые не редактируются.
+MIGRATIONS = [
+    (1, 'base_tables', [
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            id serial PRIMARY KEY,
+            tg_id bigint NOT NULL UNIQUE,
+            username text,
+            first_name text,
+            registration_date timestamp,
+            is_blocked boolean NOT NULL DEFAULT false
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS vocabulary (
+            id serial PRIMARY KEY,
+            word_az text NOT NULL,
+            word_ru text NOT NULL,
+            word_emoji text,
+            level integer NOT NULL
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS lessons (
+            id serial PRIMARY KEY,
+            name text NOT NULL,
+            link text NOT NULL,
+            learn_order integer
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS user_vocabulary (
+            id serial PRIMARY KEY,
+            user_id integer NOT NULL REFERENCES users (id),
+            vocabulary_id integer NOT NULL REFERENCES vocabulary (id),
+            correct_answer_id integer NOT NULL DEFAULT -1,
+            num_right_guesses integer NOT NULL DEFAULT 0,
+            poll_id text,
+            last_send timestamp,
+            UNIQUE (user_id, vocabulary_id)
+        )
+        ''',
+    ]),
+    (2, 'hot_path_indexes', [
+        # Выборка слов пользователя по индексу, см. sampling.py, и UPDATE по (user_id, vocabulary_id)
+        'CREATE INDEX IF NOT EXISTS user_vocabulary_user_word_idx ON user_vocabulary (user_id, vocabulary_id)',
+        # Ответ на опрос, которого нет в реестре процесса, см. poll_registry.py
+        '''
+        CREATE INDEX IF NOT EXISTS user_vocabulary_poll_id_idx
+        ON user_vocabulary (poll_id)
+        WHERE poll_id IS NOT NULL
+        ''',
+        # Последние регистрации в админской статистике
+        'CREATE INDEX IF NOT EXISTS users_registration_date_idx ON users (registration_date)',
+        # Запись слов уровня при /start
+        'CREATE INDEX IF NOT EXISTS vocabulary_level_idx ON vocabulary (level)',
+    ]),
+    (3, 'user_vocabulary_unique_word', [
+        # В старых базах (user_id, vocabulary_id) не уникален, а запись слов при /start
+        # полагается на ON CONFLICT. Повторы убираются, остаётся строка с лучшим прогрессом.
+        '''
+        DELETE FROM user_vocabulary
+        USING (
+            SELECT id, row_number() OVER (
+                PARTITION BY user_id, vocabulary_id ORDER BY num_right_guesses DESC, id
+            ) AS position
+            FROM user_vocabulary
+        ) AS ranked
+        WHERE user_vocabulary.id = ranked.id AND ranked.position > 1
+        ''',
+        # В новых базах уникальный индекс уже есть от UNIQUE в base_tables
+        '''
+        DO $$
+        BEGIN
+            IF NOT EXISTS (
+                SELECT 1 FROM pg_index
+                WHERE indrelid = 'user_vocabulary'::regclass
+                    AND indisunique
+                    AND indkey::int2[] = ARRAY[
+                        (SELECT attnum FROM pg_attribute WHERE attrelid = 'user_vocabulary'::regclass AND attname = 'user_id'),
+                        (SELECT attnum FROM pg_attribute WHERE attrelid = 'user_vocabulary'::regclass AND attname = 'vocabulary_id')
+                    ]
+            ) THEN
+                CREATE UNIQUE INDEX user_vocabulary_user_id_vocabulary_id_key ON user_vocabulary (user_id, vocabulary_id);
+            END IF;
+        END
+        $$
+        ''',
+        # Обычный индекс из hot_path_indexes повторяет уникальный
+        'DROP INDEX IF EXISTS user_vocabulary_user_word_idx',
+    ]),
+    (4, 'admin_views_day_words', [
+        # Топ для админов снова считает разные слова за 24 часа, а не показы за суточное окно.
+        # dashboard.ensure_schema после миграций создаст представления заново.
+        'DROP MATERIALIZED VIEW IF EXISTS admin_leaderboard',
+        'DROP MATERIALIZED VIEW IF EXISTS admin_summary',
+    ]),
+]
+
+
+async def migrate():
+    """
+    Applies migrations that are not in schema_migrations yet.
+    """
+    async with db.transaction() as conn:
+        await conn.execute('SELECT pg_advisory_xact_lock(%s)', (LOCK_ID,))
+        await conn.execute(SCHEMA_MIGRATIONS_SQL)
+    for version, name, statements in MIGRATIONS:
+        async with db.transaction() as conn:
+            await conn.execute('SELECT pg_advisory_xact_lock(%s)', (LOCK_ID,))
+            applied = await (await conn.execute(
+                'SELECT 1 FROM schema_migrations WHERE version = %s', (version,)
+            )).fetchone()
+            if applied:
+                continue
+            for statement in statements:
+                await conn.execute(statement)
+            await conn.execute('INSERT INTO schema_migrations (version, name) VALUES (%s, %s)', (version, name))
+        logger.info(f'Applied migration {version} {name}')
+
+
+async def setup():
+    """
+    Migrations, then every module's ensure_schema, one process at a time.
+    """
+    async with db.pool.connection() as conn:
+        await conn.execute('SELECT pg_advisory_lock(%s)', (SETUP_LOCK_ID,))
+        try:
+            await migrate()
+            await due_queue.ensure_schema()
+            await transcription.ensure_schema()
+            await transcription.persist_transcriptions()
+            await user_progress.ensure_schema()
+            await dashboard.ensure_schema()
+            await shards.ensure_schema()
+            await outbox.ensure_schema()
+            await content_cache.ensure_schema()
+            await identity.ensure_schema()
+        finally:
+            await conn.execute('SELECT pg_advisory_unlock(%s)', (SETUP_LOCK_ID,))
@@ -0,0 +1,246 @@
+import asyncio
+import hashlib
+import json
+import logging
+from datetime import datetime
+
+from aiogram.utils import exceptions
+from psycopg.types.json import Jsonb
+
+import db
+from broadcast import chat_limiter, telegram_limiter
+from settings import (
+    OUTBOX_BACKOFF_SECONDS, OUTBOX_BATCH_SIZE, OUTBOX_LEASE_SECONDS, OUTBOX_MAX_ATTEMPTS,
+    OUTBOX_POLL_MS, OUTBOX_SENDERS,
+)
+
+
+logger = logging.getLogger('outbox')
+
+PENDING = 'pending'
+SENDING = 'sending'
+SENT = 'sent'
+BLOCKED = 'blocked'
+FAILED = 'failed'
+
+# Исходящие сообщения пишутся в outbox в той же транзакции, что и изменения
+# прогресса, а отправляет их отдельный пул. Строка в статусе sending, чей
+# lease истёк (процесс упал посреди отправки), забирается снова.
+SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS outbox (
+        id bigserial PRIMARY KEY,
+        idempotency_key text NOT NULL UNIQUE,
+        chat_id bigint NOT NULL,
+        method text NOT NULL,
+        payload jsonb NOT NULL,
+        meta jsonb NOT NULL DEFAULT '{}',
+        status text NOT NULL DEFAULT 'pending',
+        attempts integer NOT NULL DEFAULT 0,
+        available_at timestamp NOT NULL DEFAULT NOW(),
+        locked_until timestamp,
+        error text,
+        created_at timestamp NOT NULL DEFAULT NOW(),
+        sent_at timestamp
+    )
+    ''',
+    '''
+    CREATE INDEX IF NOT EXISTS outbox_ready_idx ON outbox (available_at, id)
+    WHERE status IN ('pending', 'sending')
+    ''',
+]
+
+ENQUEUE_SQL = '''
+    INSERT INTO outbox (idempotency_key, chat_id, method, payload, meta)
+    VALUES (%(key)s, %(chat_id)s, %(method)s, %(payload)s, %(meta)s)
+    ON CONFLICT (idempotency_key) DO NOTHING
+    RETURNING id
+'''
+
+CLAIM_SQL = '''
+    UPDATE outbox
+    SET status = 'sending', attempts = attempts + 1,
+        locked_until = NOW() + %(lease)s * interval '1 second'
+    WHERE id IN (
+        SELECT id FROM outbox
+        WHERE (status = 'pending' OR (status = 'sending' AND locked_until < NOW()))
+            AND available_at <= NOW()
+        ORDER BY available_at, id
+        LIMIT %(limit)s
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING id, chat_id, method, payload, meta, attempts
+'''
+
+FINISH_SQL = '''
+    UPDATE outbox
+    SET status = %(status)s, locked_until = NULL, error = %(error)s,
+        sent_at = CASE WHEN %(status)s = 'sent' THEN NOW() END
+    WHERE id = %(id)s
+'''
+
+RETRY_SQL = '''
+    UPDATE outbox
+    SET status = 'pending', locked_until = NULL, error = %(error)s,
+        attempts = attempts - %(free)s,
+        available_at = NOW() + %(delay)s * interval '1 second'
+    WHERE id = %(id)s
+'''
+
+CLEANUP_SQL = '''
+    DELETE FROM outbox
+    WHERE status IN ('sent', 'blocked', 'failed') AND created_at < NOW() - interval '7 days'
+'''
+
+
+def idempotency_key(chat_id, method, payload):
+    """
+    The same message to the same chat within one minute is sent once,
+    e.g. when a crashed shard is run again.
+    """
+    body = json.dumps([chat_id, method, payload], sort_keys=True, ensure_ascii=False, default=str)
+    digest = hashlib.sha1(body.encode()).hexdigest()
+    return f'{chat_id}:{method}:{datetime.now():%Y%m%d%H%M}:{digest}'
+
+
+async def ensure_schema():
+    for statement in SCHEMA:
+        await db.execute(statement)
+
+
+async def enqueue(conn, chat_id, method, payload, meta=None, key=None):
+    """
+    Adds a Bot API call (method name of aiogram's Bot and its keyword
+    arguments, keyboards as to_python() dicts) in the caller's transaction.
+    Returns the outbox id, or None when the same key was already queued.
+    """
+    cursor = await conn.execute(ENQUEUE_SQL, {
+        'key': key or idempotency_key(chat_id, method, payload),
+        'chat_id': chat_id,
+        'method': method,
+        'payload': Jsonb(payload),
+        'meta': Jsonb(meta or {}),
+    })
+    row = await cursor.fetchone()
+    sender.wake()
+    return row['id'] if row else None
+
+
+async def post(chat_id, method, payload, meta=None, key=None):
+    """
+    enqueue() in a transaction of its own, for messages without state changes.
+    """
+    async with db.transaction() as conn:
+        return await enqueue(conn, chat_id, method, payload, meta, key)
+
+
+class OutboxSender:
+    """
+    Drains the outbox: one loop claims ready rows in batches, a pool of
+    senders calls the Bot API under the global and per-chat limits.
+    RetryAfter postpones the row by the requested timeout without counting
+    an attempt, other temporary errors back off exponentially up to
+    max_attempts. on_sent[method](meta, result) runs after a successful
+    call, on_blocked(chat_id) when the user blocked the bot.
+    """
+
+    def __init__(self, senders=OUTBOX_SENDERS, batch_size=OUTBOX_BATCH_SIZE, max_attempts=OUTBOX_MAX_ATTEMPTS,
+                 backoff=OUTBOX_BACKOFF_SECONDS, lease=OUTBOX_LEASE_SECONDS, poll_ms=OUTBOX_POLL_MS):
+        self.senders = senders
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.lease = lease
+        self.poll_ms = poll_ms
+        self.bot = None
+        self.on_sent = {}
+        self.on_blocked = None
+        self._queue = asyncio.Queue(maxsize=batch_size)
+        self._wake = asyncio.Event()
+        self._tasks = []
+
+    def wake(self):
+        self._wake.set()
+
+    async def _claim(self):
+        while True:
+            try:
+                rows = await db.fetchall(CLAIM_SQL, {'lease': self.lease, 'limit': self.batch_size})
+            except Exception:
+                logger.exception('Failed to claim outbox rows')
+                rows = []
+            for row in rows:
+                await self._queue.put(row)
+            if len(rows) < self.batch_size:
+                self._wake.clear()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), self.poll_ms / 1000)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _send_loop(self):
+        while True:
+            row = await self._queue.get()
+            try:
+                await self.send(row)
+            except Exception:
+                logger.exception(f'Failed to process outbox row {row["id"]}')
+            finally:
+                self._queue.task_done()
+
+    async def send(self, row):
+        chat_id = row['chat_id']
+        await telegram_limiter.acquire()
+        await chat_limiter.acquire(chat_id)
+        try:
+            result = await getattr(self.bot, row['method'])(**row['payload'])
+        except exceptions.RetryAfter as e:
+            logger.warning(f'Outbox {row["id"]}: rate limited, retry in {e.timeout} seconds')
+            await db.execute(RETRY_SQL, {'id': row['id'], 'error': str(e), 'free': 1, 'delay': e.timeout})
+            return
+        except exceptions.BotBlocked as e:
+            logger.warning(f'Bot was blocked by user {chat_id}')
+            await db.execute(FINISH_SQL, {'id': row['id'], 'status': BLOCKED, 'error': str(e)})
+            if self.on_blocked is not None:
+                await self.on_blocked(chat_id)
+            return
+        except (exceptions.ChatNotFound, exceptions.BadRequest) as e:
+            logger.warning(f'Outbox {row["id"]} to {chat_id} rejected: {e}')
+            await db.execute(FINISH_SQL, {'id': row['id'], 'status': FAILED, 'error': str(e)})
+            return
+        except Exception as e:
+            if row['attempts'] >= self.max_attempts:
+                logger.exception(f'Outbox {row["id"]} to {chat_id} failed after {row["attempts"]} attempts')
+                await db.execute(FINISH_SQL, {'id': row['id'], 'status': FAILED, 'error': str(e)})
+            else:
+                delay = self.backoff * 2 ** (row['attempts'] - 1)
+                logger.warning(f'Outbox {row["id"]} to {chat_id} failed: {e}, retry in {delay} seconds')
+                await db.execute(RETRY_SQL, {'id': row['id'], 'error': str(e), 'free': 0, 'delay': delay})
+            return
+        await db.execute(FINISH_SQL, {'id': row['id'], 'status': SENT, 'error': None})
+        hook = self.on_sent.get(row['method'])
+        if hook is not None:
+            await hook(row['meta'], result)
+
+    def start(self, bot, on_sent=None, on_blocked=None):
+        self.bot = bot
+        self.on_sent = on_sent or {}
+        self.on_blocked = on_blocked
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._claim())]
+            self._tasks += [asyncio.create_task(self._send_loop()) for _ in range(self.senders)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        # Строки, которые не успели отправить, вернутся в работу после истечения lease
+        self._queue = asyncio.Queue(maxsize=self.batch_size)
+
+
+sender = OutboxSender()
+
+
+async def cleanup():
+    await db.execute(CLEANUP_SQL)
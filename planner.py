@@ -0,0 +1,102 @@
+import logging
+from datetime import datetime
+
+import db
+from content_cache import content
+from identity import TARGET_SQL, identities
+from progress_buffer import progress
+from sampling import pivots, sample_sql
+from settings import DISTRACTORS_PREFER_KNOWN
+
+
+logger = logging.getLogger('planner')
+
+# Сколько слов на каждую стадию отдаём в план: самые просроченные из
+# очереди due_at плюс случайные невыученные для неправильных вариантов в опросе.
+# Случайные нужны только если варианты берутся из слов пользователя.
+CANDIDATES_PER_STAGE = 10
+FILLERS = CANDIDATES_PER_STAGE if DISTRACTORS_PREFER_KNOWN else 0
+
+PLAN_SQL = '''
+    WITH target AS ({target}),
+    due AS (
+        SELECT target.id AS user_id, due_words.*
+        FROM target
+        CROSS JOIN (VALUES ('plain'), ('az_ru'), ('ru_az')) AS stages (stage)
+        CROSS JOIN LATERAL (
+            SELECT vocabulary_id, num_right_guesses, true AS is_due
+            FROM user_vocabulary
+            WHERE user_vocabulary.user_id = target.id
+                AND learning_stage(num_right_guesses) = stages.stage
+                AND due_at <= %(now)s
+            ORDER BY due_at
+            LIMIT %(candidates)s
+        ) AS due_words
+    ),
+    fillers AS (
+        SELECT user_id, vocabulary_id, num_right_guesses, false AS is_due
+        FROM ({fillers}) AS sampled_words
+    ),
+    candidates AS (
+        SELECT picked.*, learning_stage(picked.num_right_guesses) AS stage
+        FROM (SELECT * FROM due UNION ALL SELECT * FROM fillers) AS picked
+    )
+    SELECT target.tg_id, target.id AS user_id,
+        COALESCE(user_progress.unseen + user_progress.plain, 0) AS plain,
+        COALESCE(user_progress.az_ru, 0) AS az_ru,
+        COALESCE(user_progress.ru_az, 0) AS ru_az,
+        CASE WHEN user_progress.window_started_at > %(now)s - interval '6 hours'
+            THEN user_progress.window_shown ELSE 0 END AS asked,
+        COALESCE(
+            (SELECT json_agg(candidates) FROM candidates WHERE candidates.user_id = target.id),
+            '[]'
+        ) AS candidates
+    FROM target
+    LEFT JOIN user_progress ON user_progress.user_id = target.id
+'''
+
+FILLERS_SQL = sample_sql('num_right_guesses < 10 AND due_at > %(now)s')
+ACTIVE_USERS_PLAN_SQL = PLAN_SQL.format(target='SELECT id, tg_id FROM users WHERE is_blocked = false', fillers=FILLERS_SQL)
+USERS_PLAN_SQL = PLAN_SQL.format(target=TARGET_SQL, fillers=FILLERS_SQL)
+
+
+async def plan_next_actions(tg_ids=None):
+    """
+    One grouped query for the next learning action of many users at once.
+    Without tg_ids plans every non-blocked user (the scheduled broadcast).
+    Returns tg_id -> plan row: counts of unlearned words per stage
+    (plain / az_ru / ru_az) and how many were asked in the current 6 hour
+    window, both from the user_progress counters, and
+    candidate words: the most overdue ones of every stage from the due_at
+    index plus, with DISTRACTORS_PREFER_KNOWN, a few random not yet due
+    words sampled by index probes (see sampling.py) to use as wrong answers.
+    Word texts come from the content cache and users.id of the given
+    tg_ids from the identity cache, so for them the query only reads
+    user_progress and user_vocabulary.
+    """
+    await progress.flush(tg_ids)
+    params = {
+        'now': datetime.now(),
+        'candidates': CANDIDATES_PER_STAGE,
+        'pivots': pivots(FILLERS, max(content.words, default=0) + 1),
+        'pivot_range': max(content.words, default=0) + 1,
+    }
+    if tg_ids is None:
+        rows = await db.fetchall(ACTIVE_USERS_PLAN_SQL, params)
+    else:
+        known = await identities.resolve(tg_ids)
+        if not known:
+            return {}
+        rows = await db.fetchall(USERS_PLAN_SQL, {
+            **params,
+            'tg_ids': list(known),
+            'user_ids': [identity.id for identity in known.values()],
+        })
+    for row in rows:
+        row['candidates'] = await content.with_words(row['candidates'])
+    logger.info(f'Planned next actions for {len(rows)} users')
+    return {row['tg_id']: row for row in rows}
+
+
+def due_candidates(plan, stage):
+    return [word for word in plan['candidates'] if word['stage'] == stage and word['is_due']]
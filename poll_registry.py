@@ -0,0 +1,62 @@
+import logging
+import time
+from collections import OrderedDict, namedtuple
+
+import db
+from settings import POLL_REGISTRY_SIZE, POLL_REGISTRY_TTL
+
+
+logger = logging.getLogger('poll_registry')
+
+PollEntry = namedtuple('PollEntry', ['user_id', 'vocabulary_id', 'correct_answer_id', 'created'])
+
+POLL_BY_ID_SQL = '''
+    SELECT user_id, vocabulary_id, correct_answer_id FROM user_vocabulary
+    WHERE poll_id = %s
+'''
+
+
+class PollRegistry:
+    """
+    Polls sent by this process: poll_id -> who was asked which word and the
+    right option. Bounded by size (least recently added polls are dropped
+    first) and by age, so a poll answered after a restart or much later
+    is looked up in the database instead.
+    """
+
+    def __init__(self, max_size=POLL_REGISTRY_SIZE, ttl=POLL_REGISTRY_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._polls = OrderedDict()
+
+    def add(self, poll_id, user_id, vocabulary_id, correct_answer_id):
+        self._polls[poll_id] = PollEntry(user_id, vocabulary_id, correct_answer_id, time.monotonic())
+        self._polls.move_to_end(poll_id)
+        while len(self._polls) > self.max_size:
+            self._polls.popitem(last=False)
+
+    def pop(self, poll_id):
+        entry = self._polls.pop(poll_id, None)
+        if entry is not None and time.monotonic() - entry.created > self.ttl:
+            return None
+        return entry
+
+    def __len__(self):
+        return len(self._polls)
+
+
+polls = PollRegistry()
+
+
+async def find_poll(poll_id):
+    """
+    Registry first, the poll_id index on user_vocabulary on a miss.
+    """
+    entry = polls.pop(poll_id)
+    if entry is not None:
+        return entry
+    row = await db.fetchone(POLL_BY_ID_SQL, (poll_id,))
+    if row is None:
+        return None
+    logger.info(f'Poll {poll_id} is not in the registry, loaded from the database')
+    return PollEntry(row['user_id'], row['vocabulary_id'], row['correct_answer_id'], None)
@@ -0,0 +1,132 @@
+import asyncio
+import logging
+
+import db
+from settings import WRITE_BEHIND_ENABLED, WRITE_BEHIND_FLUSH_MS, WRITE_BEHIND_MAX_ROWS
+
+
+logger = logging.getLogger('progress_buffer')
+
+# Все накопленные изменения прогресса одним UPDATE ... FROM unnest(...)
+FLUSH_SQL = '''
+    UPDATE user_vocabulary
+    SET num_right_guesses = COALESCE(changes.set_to, user_vocabulary.num_right_guesses) + changes.delta,
+        last_send = changes.last_send, poll_id = NULL, correct_answer_id = -1
+    FROM unnest(%s::bigint[], %s::bigint[], %s::integer[], %s::integer[], %s::timestamp[])
+        AS changes (user_id, vocabulary_id, set_to, delta, last_send)
+    WHERE user_vocabulary.user_id = changes.user_id AND user_vocabulary.vocabulary_id = changes.vocabulary_id
+'''
+
+
+async def write(conn, changes):
+    """
+    Writes (user_id, vocabulary_id, set_to, delta, last_send) changes in
+    the caller's transaction, past the buffer.
+    """
+    await conn.execute(FLUSH_SQL, tuple(list(column) for column in zip(*changes)))
+
+
+class ProgressBuffer:
+    """
+    Write-behind buffer for num_right_guesses / last_send updates of poll
+    answers, shown words and "already know" taps.
+
+    Changes to the same word are coalesced: increments are summed, setting
+    an absolute value drops earlier increments. Pending changes are written
+    with one statement every flush_ms, as soon as max_rows are pending,
+    before the same user's data is read (flush(tg_ids)) and on shutdown.
+    When disabled every change is written immediately with the same query.
+    """
+
+    def __init__(self, enabled=WRITE_BEHIND_ENABLED, flush_ms=WRITE_BEHIND_FLUSH_MS, max_rows=WRITE_BEHIND_MAX_ROWS):
+        self.enabled = enabled
+        self.flush_ms = flush_ms
+        self.max_rows = max_rows
+        # (user_id, vocabulary_id) -> [tg_id, set_to, delta, last_send]
+        self._pending = {}
+        self._lock = asyncio.Lock()
+        self._task = None
+
+    def _merge(self, tg_id, user_id, vocabulary_id, last_send, delta=0, set_to=None):
+        key = (user_id, vocabulary_id)
+        change = self._pending.get(key)
+        if change is None or set_to is not None:
+            self._pending[key] = [tg_id, set_to, delta, last_send]
+        else:
+            change[2] += delta
+            change[3] = max(change[3], last_send)
+
+    async def _added(self, tg_id):
+        if not self.enabled:
+            await self.flush([tg_id])
+        elif len(self._pending) >= self.max_rows:
+            await self.flush()
+
+    async def add(self, tg_id, user_id, vocabulary_id, last_send, delta=0, set_to=None):
+        self._merge(tg_id, user_id, vocabulary_id, last_send, delta, set_to)
+        await self._added(tg_id)
+
+    async def add_many(self, tg_id, changes):
+        """
+        add() for several (user_id, vocabulary_id, last_send, delta) changes
+        of one user; when disabled they are written with one statement.
+        """
+        for change in changes:
+            self._merge(tg_id, *change)
+        await self._added(tg_id)
+
+    async def flush(self, tg_ids=None):
+        """
+        Writes pending changes of the given Telegram users, or all of them.
+        """
+        async with self._lock:
+            if tg_ids is None:
+                keys = list(self._pending)
+            else:
+                tg_ids = set(tg_ids)
+                keys = [key for key, change in self._pending.items() if change[0] in tg_ids]
+            if not keys:
+                return
+            changes = {key: self._pending.pop(key) for key in keys}
+            try:
+                await db.execute(FLUSH_SQL, (
+                    [user_id for user_id, _ in changes],
+                    [vocabulary_id for _, vocabulary_id in changes],
+                    [change[1] for change in changes.values()],
+                    [change[2] for change in changes.values()],
+                    [change[3] for change in changes.values()],
+                ))
+            except Exception:
+                # Вернём изменения в буфер, поверх них лягут более новые изменения тех же слов
+                for key, change in changes.items():
+                    newer = self._pending.get(key)
+                    if newer is not None and newer[1] is None:
+                        change[2] += newer[2]
+                        change[3] = max(change[3], newer[3])
+                        newer = None
+                    self._pending[key] = newer or change
+                raise
+            if self.enabled:
+                logger.debug(f'Flushed {len(changes)} progress changes')
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_ms / 1000)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception('Failed to flush progress changes')
+
+    def start(self):
+        if self.enabled and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+
+progress = ProgressBuffer()
@@ -1,13 +1,95 @@
+import asyncio
 import logging
+import random
+import time
 from traceback import format_exc
 import datetime
 
-from aioschedule import Scheduler
+from aioschedule import CancelJob, Job, Scheduler
+
+import metrics
 
 
 logger = logging.getLogger('schedule')
 
 
+class JobStats:
+    """
+    Counters and timings of one job key.
+    """
+
+    def __init__(self):
+        self.runs = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.timed_out = 0
+        self.skipped = 0
+        self.missed = 0
+        self.running = 0
+        self.last_duration = None
+        self.max_duration = 0.0
+        self.total_duration = 0.0
+        self.last_started = None
+        self.last_error = None
+
+    def as_dict(self):
+        return dict(vars(self))
+
+
+class SafeJob(Job):
+    """
+    Job with the extra settings SafeScheduler understands:
+    every().day.at('05:30').timeout(3600).jitter(60).grace(1800).guard('send_messages').do(...)
+    """
+
+    def __init__(self, interval, scheduler=None):
+        super().__init__(interval, scheduler)
+        self.guard_key = None
+        self.timeout_seconds = None
+        self.jitter_seconds = 0
+        self.grace_seconds = None
+
+    def guard(self, key):
+        """
+        Jobs with the same key never run at the same time. By default the
+        key is the function name with its positional arguments.
+        """
+        self.guard_key = key
+        return self
+
+    def timeout(self, seconds):
+        self.timeout_seconds = seconds
+        return self
+
+    def jitter(self, seconds):
+        """
+        Every run starts up to seconds later than scheduled.
+        """
+        self.jitter_seconds = seconds
+        return self
+
+    def grace(self, seconds):
+        """
+        Runs that are more than seconds late (the process was busy or
+        asleep) are skipped instead of started late.
+        """
+        self.grace_seconds = seconds
+        return self
+
+    @property
+    def key(self):
+        if self.guard_key is not None:
+            return self.guard_key
+        func = getattr(self.job_func, 'func', self.job_func)
+        args = getattr(self.job_func, 'args', ())
+        return ':'.join([getattr(func, '__name__', repr(func))] + [str(arg) for arg in args])
+
+    def _schedule_next_run(self):
+        super()._schedule_next_run()
+        if self.jitter_seconds:
+            self.next_run += datetime.timedelta(seconds=random.uniform(0, self.jitter_seconds))
+
+
 class SafeScheduler(Scheduler):
     """
     An implementation of Scheduler that catches jobs that fail, logs their
@@ -15,21 +97,94 @@ class SafeScheduler(Scheduler):
     next run time, and keeps going.
     Use this to run jobs that may or may not crash without worrying about
     whether other jobs will run or if they'll crash the entire script.
+
+    Due jobs are started as tasks and rescheduled before they run, so a long
+    job doesn't hold up the others. run_forever() sleeps until the next job
+    is due instead of polling. Per-key stats are kept in self.stats.
     """
 
-    def __init__(self, reschedule_on_failure=True):
+    def __init__(self, reschedule_on_failure=True, max_sleep=60):
         """
         If reschedule_on_failure is True, jobs will be rescheduled for their
         next run as if they had completed successfully. If False, they'll run
         on the next run_pending() tick.
+        max_sleep caps how long run_forever() sleeps between checks.
         """
         self.reschedule_on_failure = reschedule_on_failure
+        self.max_sleep = max_sleep
+        self.stats = {}
+        self._running = {}
         super().__init__()
 
-    def _run_job(self, job):
+    def every(self, interval=1):
+        return SafeJob(interval, self)
+
+    async def run_pending(self):
+        now = datetime.datetime.now()
+        started = []
+        for job in [job for job in self.jobs if job.should_run]:
+            scheduled = job.next_run
+            job.last_run = now
+            job._schedule_next_run()
+            key = getattr(job, 'key', repr(job))
+            stats = self.stats.setdefault(key, JobStats())
+            grace = getattr(job, 'grace_seconds', None)
+            if grace is not None and (now - scheduled).total_seconds() > grace:
+                logger.warning(f'Skipping {key}: it was due at {scheduled:%H:%M:%S}, more than {grace}s ago')
+                stats.missed += 1
+                metrics.JOB_RUNS.inc(job=key, result='missed')
+                continue
+            running = self._running.get(key)
+            if running is not None and not running.done():
+                logger.warning(f'Skipping {key}: the previous run is still going')
+                stats.skipped += 1
+                metrics.JOB_RUNS.inc(job=key, result='skipped')
+                continue
+            self._running[key] = asyncio.create_task(self._run_job(job, key, stats))
+            started.append(self._running[key])
+        return started
+
+    async def _run_job(self, job, key, stats):
+        logger.info(f'Running job {key}')
+        stats.runs += 1
+        stats.running += 1
+        stats.last_started = datetime.datetime.now()
+        started = time.monotonic()
+        result = 'failed'
         try:
-            super()._run_job(job)
-        except Exception:
+            ret = await asyncio.wait_for(job.job_func(), getattr(job, 'timeout_seconds', None))
+        except asyncio.TimeoutError:
+            logger.error(f'Job {key} timed out after {job.timeout_seconds}s')
+            stats.timed_out += 1
+            result = 'timed_out'
+            stats.last_error = 'timeout'
+            self._failed(job)
+        except Exception as e:
             logger.error(format_exc())
-            job.last_run = datetime.datetime.now()
-            job._schedule_next_run()
\ No newline at end of file
+            stats.failed += 1
+            stats.last_error = repr(e)
+            self._failed(job)
+        else:
+            stats.succeeded += 1
+            result = 'succeeded'
+            if isinstance(ret, CancelJob) or ret is CancelJob:
+                self.cancel_job(job)
+        finally:
+            duration = time.monotonic() - started
+            stats.running -= 1
+            stats.last_duration = duration
+            stats.max_duration = max(stats.max_duration, duration)
+            stats.total_duration += duration
+            metrics.JOB_SECONDS.observe(duration, job=key)
+            metrics.JOB_RUNS.inc(job=key, result=result)
+            logger.info(f'Job {key} finished in {duration:.1f}s')
+
+    def _failed(self, job):
+        if not self.reschedule_on_failure:
+            job.next_run = datetime.datetime.now()
+
+    async def run_forever(self):
+        while True:
+            await self.run_pending()
+            idle = self.idle_seconds if self.jobs else None
+            await asyncio.sleep(self.max_sleep if idle is None else min(max(idle, 0.1), self.max_sleep))
@@ -0,0 +1,49 @@
+import random
+
+
+# Случайная выборка слов пользователя без сортировки всех его строк: для
+# каждой точки-пивота берём первое подходящее слово с vocabulary_id >= пивота
+# по индексу (user_id, vocabulary_id), а если таких нет — первое с начала.
+# Пивоты общие на запрос, сдвиг на user_id даёт разным пользователям разные
+# слова. Повторы отбрасываются, поэтому слов может прийти меньше, чем пивотов.
+SAMPLE_SQL = '''
+    SELECT DISTINCT ON (target.id, sampled.vocabulary_id)
+        target.id AS user_id, sampled.vocabulary_id, sampled.num_right_guesses
+    FROM target
+    CROSS JOIN unnest(%(pivots)s::bigint[]) AS pivots (pivot)
+    CROSS JOIN LATERAL (
+        (
+            SELECT vocabulary_id, num_right_guesses FROM {table}
+            WHERE user_id = target.id
+                AND vocabulary_id >= (pivots.pivot + target.id::bigint * 7919) %% %(pivot_range)s
+                AND {condition}
+            ORDER BY vocabulary_id
+            LIMIT 1
+        )
+        UNION ALL
+        (
+            SELECT vocabulary_id, num_right_guesses FROM {table}
+            WHERE user_id = target.id AND {condition}
+            ORDER BY vocabulary_id
+            LIMIT 1
+        )
+        LIMIT 1
+    ) AS sampled
+'''
+
+
+def sample_sql(condition, table='user_vocabulary'):
+    """
+    Sampling query for users of a target CTE (id column) and rows
+    matching condition. Parameters: pivots(), pivot_range.
+    """
+    return SAMPLE_SQL.format(table=table, condition=condition)
+
+
+def pivots(count, pivot_range):
+    """
+    count distinct random pivots in [0, pivot_range), pivot_range being
+    e.g. the largest vocabulary id + 1.
+    """
+    pivot_range = max(pivot_range, 1)
+    return random.sample(range(pivot_range), min(count, pivot_range))
@@ -0,0 +1,77 @@
+import os
+from datetime import timedelta
+
+# Настройки окружения. Секреты лежат в secret_constants, здесь только то,
+# что можно переопределить переменными окружения без правки кода.
+
+DB_HOST = os.environ.get('DB_HOST', 'localhost')
+DB_POOL_MIN_SIZE = int(os.environ.get('DB_POOL_MIN_SIZE', 2))
+DB_POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', 10))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 30))
+
+BROADCAST_WORKERS = int(os.environ.get('BROADCAST_WORKERS', 16))
+BROADCAST_MAX_RETRIES = int(os.environ.get('BROADCAST_MAX_RETRIES', 3))
+BROADCAST_PROGRESS_SECONDS = float(os.environ.get('BROADCAST_PROGRESS_SECONDS', 10))
+TELEGRAM_GLOBAL_RATE = float(os.environ.get('TELEGRAM_GLOBAL_RATE', 30))
+TELEGRAM_PER_CHAT_INTERVAL = float(os.environ.get('TELEGRAM_PER_CHAT_INTERVAL', 1))
+
+# Через сколько слово снова становится доступным для показа на каждой стадии
+DUE_INTERVALS = {
+    'plain': timedelta(hours=float(os.environ.get('DUE_INTERVAL_PLAIN_HOURS', 6))),
+    'az_ru': timedelta(hours=float(os.environ.get('DUE_INTERVAL_AZ_RU_HOURS', 6))),
+    'ru_az': timedelta(hours=float(os.environ.get('DUE_INTERVAL_RU_AZ_HOURS', 6))),
+    'review': timedelta(days=float(os.environ.get('DUE_INTERVAL_REVIEW_DAYS', 30))),
+}
+
+POLL_REGISTRY_SIZE = int(os.environ.get('POLL_REGISTRY_SIZE', 20000))
+POLL_REGISTRY_TTL = float(os.environ.get('POLL_REGISTRY_TTL', 24 * 60 * 60))
+
+WRITE_BEHIND_ENABLED = os.environ.get('WRITE_BEHIND_ENABLED', '0') == '1'
+WRITE_BEHIND_FLUSH_MS = int(os.environ.get('WRITE_BEHIND_FLUSH_MS', 500))
+WRITE_BEHIND_MAX_ROWS = int(os.environ.get('WRITE_BEHIND_MAX_ROWS', 500))
+
+# polling, webhook или worker (только части плановых рассылок, см. shards.py)
+BOT_MODE = os.environ.get('BOT_MODE', 'polling')
+# Свой сервер Bot API, например локальная заглушка Telegram для тестов
+TELEGRAM_API_SERVER = os.environ.get('TELEGRAM_API_SERVER', '')
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL', '')
+WEBHOOK_PATH = os.environ.get('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET', '')
+WEBHOOK_HOST = os.environ.get('WEBHOOK_HOST', '127.0.0.1')
+WEBHOOK_PORT = int(os.environ.get('WEBHOOK_PORT', 8080))
+WEBHOOK_WORKERS = int(os.environ.get('WEBHOOK_WORKERS', 1))
+
+TRANSCRIPTION_CACHE_SIZE = int(os.environ.get('TRANSCRIPTION_CACHE_SIZE', 20000))
+
+# Как часто пересчитывать статистику для админов
+DASHBOARD_REFRESH_MINUTES = int(os.environ.get('DASHBOARD_REFRESH_MINUTES', 5))
+
+# Плановые рассылки делятся на SHARD_COUNT частей по хэшу tg_id, части
+# разбирают процессы бота и BOT_MODE=worker через таблицу shard_jobs.
+# TELEGRAM_GLOBAL_RATE считается на процесс: при нескольких процессах его
+# нужно разделить между ними.
+SHARD_COUNT = int(os.environ.get('SHARD_COUNT', 8))
+SHARD_LEASE_SECONDS = int(os.environ.get('SHARD_LEASE_SECONDS', 120))
+SHARD_POLL_SECONDS = float(os.environ.get('SHARD_POLL_SECONDS', 2))
+SHARD_MAX_ATTEMPTS = int(os.environ.get('SHARD_MAX_ATTEMPTS', 3))
+# Запас сверх времени на отправку части: часть из N пользователей может работать
+# 2 * N / TELEGRAM_GLOBAL_RATE + SHARD_TIMEOUT_SECONDS секунд, потом попытка неудачна
+SHARD_TIMEOUT_SECONDS = int(os.environ.get('SHARD_TIMEOUT_SECONDS', 5 * 60))
+SHARD_WORKER_IN_BOT = os.environ.get('SHARD_WORKER_IN_BOT', '1') == '1'
+
+# Исходящие сообщения через таблицу outbox (см. outbox.py) вместо прямой отправки
+OUTBOX_ENABLED = os.environ.get('OUTBOX_ENABLED', '0') == '1'
+OUTBOX_SENDERS = int(os.environ.get('OUTBOX_SENDERS', 8))
+OUTBOX_BATCH_SIZE = int(os.environ.get('OUTBOX_BATCH_SIZE', 50))
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get('OUTBOX_MAX_ATTEMPTS', 5))
+OUTBOX_BACKOFF_SECONDS = float(os.environ.get('OUTBOX_BACKOFF_SECONDS', 2))
+OUTBOX_LEASE_SECONDS = int(os.environ.get('OUTBOX_LEASE_SECONDS', 60))
+OUTBOX_POLL_MS = int(os.environ.get('OUTBOX_POLL_MS', 200))
+
+# Метрики Prometheus на http://METRICS_HOST:METRICS_PORT/metrics, см. metrics.py
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '0') == '1'
+METRICS_HOST = os.environ.get('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 9100))
+
+# Неправильные варианты в опросах сначала берутся из слов, которые пользователь уже видел
+DISTRACTORS_PREFER_KNOWN = os.environ.get('DISTRACTORS_PREFER_KNOWN', '0') == '1'
@@ -0,0 +1,340 @@
+import asyncio
+import logging
+import os
+import socket
+import time
+from datetime import datetime
+
+from psycopg.types.json import Jsonb
+
+import db
+import metrics
+from settings import (
+    SHARD_COUNT, SHARD_LEASE_SECONDS, SHARD_MAX_ATTEMPTS, SHARD_POLL_SECONDS, SHARD_TIMEOUT_SECONDS,
+    TELEGRAM_GLOBAL_RATE,
+)
+
+
+logger = logging.getLogger('shards')
+
+# Плановые рассылки режутся на SHARD_COUNT частей по хэшу tg_id. Каждая часть —
+# строка shard_jobs, которую любой процесс (или хост) берёт через SKIP LOCKED
+# и держит lease, пока работает. Если процесс упал, lease истекает и часть
+# забирает другой процесс.
+SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS shard_jobs (
+        run_id text NOT NULL,
+        shard integer NOT NULL,
+        shards integer NOT NULL,
+        job text NOT NULL,
+        params jsonb NOT NULL DEFAULT '{}',
+        status text NOT NULL DEFAULT 'pending',
+        attempts integer NOT NULL DEFAULT 0,
+        worker text,
+        lease_until timestamp,
+        created_at timestamp NOT NULL DEFAULT NOW(),
+        finished_at timestamp,
+        PRIMARY KEY (run_id, shard)
+    )
+    ''',
+    '''
+    CREATE INDEX IF NOT EXISTS shard_jobs_open_idx ON shard_jobs (created_at)
+    WHERE status IN ('pending', 'running')
+    ''',
+    # Отметка на части 0, что итог рассылки уже посчитан
+    'ALTER TABLE shard_jobs ADD COLUMN IF NOT EXISTS run_reported boolean NOT NULL DEFAULT false',
+    # Сколько раз можно брать часть; задаётся при постановке, старые строки не повторяются
+    'ALTER TABLE shard_jobs ADD COLUMN IF NOT EXISTS max_attempts integer NOT NULL DEFAULT 1',
+]
+
+# run_id включает минуту запуска: если расписание крутится в нескольких
+# процессах, каждая рассылка всё равно создаётся один раз
+ENQUEUE_SQL = '''
+    INSERT INTO shard_jobs (run_id, shard, shards, job, params, max_attempts)
+    SELECT %(run_id)s, shard, %(shards)s, %(job)s, %(params)s, %(max_attempts)s
+    FROM generate_series(0, %(shards)s - 1) AS shard
+    ON CONFLICT DO NOTHING
+'''
+
+# Незаконченный прошлый запуск той же рассылки: новый в это время не создаём
+ACTIVE_RUN_SQL = '''
+    SELECT run_id FROM shard_jobs
+    WHERE job = %(job)s AND run_id <> %(run_id)s AND status IN ('pending', 'running')
+    LIMIT 1
+'''
+
+CLAIM_SQL = '''
+    UPDATE shard_jobs
+    SET status = 'running', worker = %(worker)s, attempts = attempts + 1,
+        lease_until = NOW() + %(lease)s * interval '1 second'
+    WHERE (run_id, shard) = (
+        SELECT run_id, shard FROM shard_jobs
+        WHERE (status = 'pending' OR (status = 'running' AND lease_until < NOW()))
+            AND attempts < max_attempts
+        ORDER BY created_at, shard
+        LIMIT 1
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING run_id, shard, shards, job, params, attempts, max_attempts
+'''
+
+# Процесс упал на последней попытке: CLAIM_SQL такую часть больше не возьмёт,
+# и без этого она осталась бы 'running' навсегда, а с ней и запуск
+EXPIRE_SQL = '''
+    UPDATE shard_jobs
+    SET status = 'failed', lease_until = NULL, finished_at = NOW()
+    WHERE status = 'running' AND lease_until < NOW() AND attempts >= max_attempts
+    RETURNING run_id, shard, job
+'''
+
+HEARTBEAT_SQL = '''
+    UPDATE shard_jobs
+    SET lease_until = NOW() + %(lease)s * interval '1 second'
+    WHERE run_id = %(run_id)s AND shard = %(shard)s AND worker = %(worker)s AND status = 'running'
+    RETURNING lease_until
+'''
+
+FINISH_SQL = '''
+    UPDATE shard_jobs
+    SET status = %(status)s, lease_until = NULL, finished_at = NOW()
+    WHERE run_id = %(run_id)s AND shard = %(shard)s AND worker = %(worker)s
+'''
+
+RELEASE_SQL = '''
+    UPDATE shard_jobs
+    SET status = 'pending', lease_until = NULL
+    WHERE run_id = %(run_id)s AND shard = %(shard)s AND worker = %(worker)s
+'''
+
+# Итог запуска считает тот, кто закончил последнюю часть: строка части 0
+# блокируется, поэтому при одновременном завершении итог будет один
+COMPLETE_RUN_SQL = '''
+    UPDATE shard_jobs
+    SET run_reported = true
+    WHERE run_id = %(run_id)s AND shard = 0 AND NOT run_reported
+        AND NOT EXISTS (
+            SELECT 1 FROM shard_jobs AS open
+            WHERE open.run_id = %(run_id)s AND open.status IN ('pending', 'running')
+        )
+    RETURNING job,
+        (SELECT COUNT(*) FROM shard_jobs AS failed WHERE failed.run_id = %(run_id)s AND failed.status = 'failed') AS failed,
+        EXTRACT(EPOCH FROM NOW() - created_at)::float AS seconds
+'''
+
+CLEANUP_SQL = '''
+    DELETE FROM shard_jobs
+    WHERE status IN ('done', 'failed') AND finished_at < NOW() - interval '7 days'
+'''
+
+SHARD_USERS_SQL = '''
+    SELECT tg_id FROM users
+    WHERE is_blocked = false AND (hashtext(tg_id::text)::bigint + 2147483648) %% %(shards)s = %(shard)s
+'''
+
+
+def worker_name():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+async def ensure_schema():
+    for statement in SCHEMA:
+        await db.execute(statement)
+
+
+async def enqueue(job, shards=SHARD_COUNT, max_attempts=SHARD_MAX_ATTEMPTS, **params):
+    """
+    Creates a run of job split into shards, each tried up to max_attempts
+    times. Jobs that must not run twice for the same users (direct sends)
+    pass max_attempts=1. While an earlier run of the same job has
+    unfinished shards nothing is created and False is returned, so runs of
+    one job never overlap.
+    """
+    run_id = f'{job}:{datetime.now():%Y-%m-%d %H:%M}'
+    await db.execute(CLEANUP_SQL)
+    # Зависшие части старого запуска иначе не дали бы создать новый
+    await expire()
+    async with db.transaction() as conn:
+        # Расписание может крутиться в нескольких процессах: проверку и вставку делаем под блокировкой
+        await conn.execute('SELECT pg_advisory_xact_lock(hashtext(%s))', (f'shard_jobs:{job}',))
+        active = await (await conn.execute(ACTIVE_RUN_SQL, {'job': job, 'run_id': run_id})).fetchone()
+        if active is not None:
+            logger.warning(f'Skipping {run_id}: {active["run_id"]} is not finished yet')
+            metrics.JOB_RUNS.inc(job=job, result='skipped')
+            return False
+        await conn.execute(ENQUEUE_SQL, {
+            'run_id': run_id, 'shards': shards, 'job': job, 'params': Jsonb(params), 'max_attempts': max_attempts,
+        })
+    logger.info(f'Enqueued {run_id} in {shards} shards')
+    return True
+
+
+async def expire():
+    """
+    Fails shards whose lease ran out on their last attempt and reports
+    the runs this finishes. Returns the number of expired shards.
+    """
+    rows = await db.fetchall(EXPIRE_SQL)
+    for row in rows:
+        logger.error(f'{row["run_id"]} shard {row["shard"]} lost its worker on the last attempt, marked failed')
+        metrics.JOB_RUNS.inc(job=f'{row["job"]}:shard', result='expired')
+    for run_id in {row['run_id'] for row in rows}:
+        await complete(run_id)
+    return len(rows)
+
+
+async def complete(run_id):
+    """
+    Reports the run once its last shard is done or failed.
+    """
+    run = await db.fetchone(COMPLETE_RUN_SQL, {'run_id': run_id})
+    if run is None:
+        return
+    result = 'failed' if run['failed'] else 'succeeded'
+    logger.info(f'{run_id} finished in {run["seconds"]:.1f}s, {run["failed"]} shards failed')
+    metrics.JOB_SECONDS.observe(run['seconds'], job=run['job'])
+    metrics.JOB_RUNS.inc(job=run['job'], result=result)
+
+
+def shard_timeout(users, timeout=SHARD_TIMEOUT_SECONDS, rate=TELEGRAM_GLOBAL_RATE):
+    """
+    Time a shard of users may take: twice what sending at rate needs,
+    plus timeout seconds of slack.
+    """
+    return timeout + 2 * users / rate
+
+
+class LeaseLost(Exception):
+    pass
+
+
+async def shard_user_ids(shard, shards):
+    rows = await db.fetchall(SHARD_USERS_SQL, {'shard': shard, 'shards': shards})
+    return [row['tg_id'] for row in rows]
+
+
+class ShardWorker:
+    """
+    Takes shard jobs one by one and runs handlers[job](tg_ids, **params)
+    for the non-blocked users of the shard, within shard_timeout() of the
+    shard size. The lease is extended while the handler runs; when it
+    cannot be, the handler is cancelled before another worker takes the
+    shard. A failed or timed out shard goes back to the queue until it has
+    been tried max_attempts times (set by enqueue); one whose worker died
+    on the last attempt is marked failed by expire(). Shard and whole run
+    durations and results go to the job metrics.
+    """
+
+    def __init__(self, handlers, name=None, lease=SHARD_LEASE_SECONDS, poll=SHARD_POLL_SECONDS,
+                 timeout=SHARD_TIMEOUT_SECONDS, rate=TELEGRAM_GLOBAL_RATE):
+        self.handlers = handlers
+        self.name = name or worker_name()
+        self.lease = lease
+        self.poll = poll
+        self.timeout = timeout
+        self.rate = rate
+        self._task = None
+
+    async def run_once(self):
+        """
+        Runs one shard if there is one. Returns False when the queue is empty.
+        """
+        await expire()
+        job = await db.fetchone(CLAIM_SQL, {'worker': self.name, 'lease': self.lease})
+        if job is None:
+            return False
+        key = {'run_id': job['run_id'], 'shard': job['shard'], 'worker': self.name}
+        logger.info(
+            f'{self.name} took {job["run_id"]} shard {job["shard"]}/{job["shards"]}, '
+            f'attempt {job["attempts"]} of {job["max_attempts"]}'
+        )
+        started = time.monotonic()
+        result = 'failed'
+        try:
+            handler = self.handlers[job['job']]
+            tg_ids = await shard_user_ids(job['shard'], job['shards'])
+            if tg_ids:
+                await self._run_handler(key, handler(tg_ids, **job['params']), shard_timeout(len(tg_ids), self.timeout, self.rate))
+        except asyncio.CancelledError:
+            result = 'cancelled'
+            await db.execute(RELEASE_SQL, key)
+            raise
+        except LeaseLost:
+            # Часть уже не наша: её заберёт другой воркер или expire()
+            result = 'lease_lost'
+            logger.error(f'{job["run_id"]} shard {job["shard"]} lost its lease, handler cancelled')
+        except Exception as e:
+            if isinstance(e, asyncio.TimeoutError):
+                result = 'timed_out'
+                logger.error(f'{job["run_id"]} shard {job["shard"]} of {len(tg_ids)} users timed out')
+            else:
+                logger.exception(f'{job["run_id"]} shard {job["shard"]} failed')
+            if job['attempts'] >= job['max_attempts']:
+                await db.execute(FINISH_SQL, {**key, 'status': 'failed'})
+                await complete(job['run_id'])
+            else:
+                await db.execute(RELEASE_SQL, key)
+        else:
+            result = 'succeeded'
+            await db.execute(FINISH_SQL, {**key, 'status': 'done'})
+            await complete(job['run_id'])
+        finally:
+            metrics.JOB_SECONDS.observe(time.monotonic() - started, job=f'{job["job"]}:shard')
+            metrics.JOB_RUNS.inc(job=f'{job["job"]}:shard', result=result)
+        return True
+
+    async def _run_handler(self, key, coroutine, timeout):
+        handler = asyncio.create_task(coroutine)
+        heartbeat = asyncio.create_task(self._heartbeat(key, handler))
+        try:
+            await asyncio.wait_for(handler, timeout)
+        except asyncio.CancelledError:
+            # Обработчик отменил heartbeat, а не остановка воркера
+            if heartbeat.done() and not heartbeat.cancelled():
+                raise LeaseLost(key) from None
+            raise
+        finally:
+            heartbeat.cancel()
+
+    async def _heartbeat(self, key, handler):
+        """
+        Extends the lease every lease / 3 seconds, retrying failed updates.
+        Cancels handler and returns when another worker owns the shard or
+        the lease would run out before the next try.
+        """
+        renewed = time.monotonic()
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            try:
+                row = await db.fetchone(HEARTBEAT_SQL, {**key, 'lease': self.lease})
+            except Exception:
+                logger.exception(f'Failed to extend the lease of {key["run_id"]} shard {key["shard"]}')
+                if time.monotonic() - renewed + self.lease / 3 < self.lease:
+                    continue
+            else:
+                if row is not None:
+                    renewed = time.monotonic()
+                    continue
+            handler.cancel()
+            return
+
+    async def run(self):
+        while True:
+            try:
+                if await self.run_once():
+                    continue
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('Shard worker failed to take a job')
+            await asyncio.sleep(self.poll)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
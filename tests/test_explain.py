@@ -0,0 +1,38 @@
+"""
+Plan regression gate for the hot queries, see benchmarks/explain_check.py.
+Runs against a separate Postgres database that the bot user can write to
+and is skipped when EXPLAIN_DBNAME is not set:
+
+    createdb azbot_explain
+    EXPLAIN_DBNAME=azbot_explain python -m pytest tests/test_explain.py
+"""
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+import explain_check
+
+DBNAME = os.environ.get('EXPLAIN_DBNAME')
+USERS = os.environ.get('EXPLAIN_USERS', '2000')
+
+# Имена проверок известны без базы, параметры подставятся при запуске
+CHECK_NAMES = [check.name for check in explain_check.checks({'id': 0, 'tg_id': 0}, 0, '', 1, 1)]
+
+
+@pytest.fixture(scope='module')
+def results():
+    if not DBNAME:
+        pytest.skip('EXPLAIN_DBNAME is not set, no database for plan checks')
+    args = explain_check.parse_args(['--dbname', DBNAME, '--users', USERS])
+    return {result['name']: result for result in asyncio.run(explain_check.start(args))}
+
+
+@pytest.mark.parametrize('name', CHECK_NAMES)
+def test_hot_query_plan(results, name):
+    result = results[name]
+    assert not result['problems'], f'{name}: {", ".join(result["problems"])}'
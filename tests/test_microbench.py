@@ -0,0 +1,31 @@
+"""
+CPU budget of the per-message hot path, see benchmarks/microbench.py.
+Needs no database or Telegram. Slow machines can loosen the budgets:
+
+    MICROBENCH_BUDGET_SCALE=2 python -m pytest tests/test_microbench.py
+"""
+import asyncio
+import logging
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+import microbench
+
+ITERATIONS = int(os.environ.get('MICROBENCH_ITERATIONS', 1000))
+BUDGET_SCALE = os.environ.get('MICROBENCH_BUDGET_SCALE', '1')
+
+
+def test_hot_path_within_cpu_budget(monkeypatch):
+    # Как в microbench.py: логи форматируются, но никуда не пишутся
+    monkeypatch.setattr(logging.getLogger(), 'handlers', [logging.NullHandler()])
+    args = microbench.parse_args(['--iterations', str(ITERATIONS), '--budget-scale', BUDGET_SCALE])
+    results = asyncio.run(microbench.run(args))
+    assert set(results) == set(microbench.BUDGETS_US)
+    over = {
+        name: f'{result["cpu_us"]:.1f} us > {result["budget_us"]:.0f} us'
+        for name, result in results.items() if result['over_budget']
+    }
+    assert not over, f'Over CPU budget: {over}'
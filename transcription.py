@@ -0,0 +1,114 @@
+import logging
+import re
+from functools import lru_cache
+
+import db
+from constants import transcribe_az_dict
+from settings import TRANSCRIPTION_CACHE_SIZE
+
+
+logger = logging.getLogger('transcription')
+
+SCHEMA = [
+    'ALTER TABLE vocabulary ADD COLUMN IF NOT EXISTS transcription text',
+]
+
+MISSING_TRANSCRIPTIONS_SQL = '''
+    SELECT id, word_az FROM vocabulary
+    WHERE transcription IS NULL OR transcription = ''
+'''
+
+SAVE_TRANSCRIPTIONS_SQL = '''
+    UPDATE vocabulary
+    SET transcription = saved.transcription
+    FROM unnest(%s::bigint[], %s::text[]) AS saved (id, transcription)
+    WHERE vocabulary.id = saved.id
+'''
+
+
+def compile_rules(rules):
+    """
+    Turns transcribe_az_dict into lookup tables:
+    regular: letter -> its usual sound, for every letter;
+    context: letter -> (start, after, before) for letters whose sound
+    depends on the position or a neighbour; after / before map the
+    neighbouring letter straight to the sound. When several groups contain
+    the same neighbour the last one wins, as it did when the groups were
+    checked one by one.
+    """
+    regular = {}
+    context = {}
+    for letter, rule in rules.items():
+        regular[letter] = rule['regular']
+        after = {}
+        for neighbours, sound in rule.get('after', {}).items():
+            after.update(dict.fromkeys(neighbours, sound))
+        before = {}
+        for neighbours, sound in rule.get('before', {}).items():
+            before.update(dict.fromkeys(neighbours, sound))
+        if 'start' in rule or after or before:
+            context[letter] = (rule.get('start'), after, before)
+    return regular, context
+
+
+REGULAR, CONTEXT = compile_rules(transcribe_az_dict)
+# Одна буква может быть записана несколькими символами (i̇), такие правила никогда не срабатывали
+CONTEXT_LETTERS = re.compile('|'.join(re.escape(letter) for letter in CONTEXT if len(letter) == 1))
+
+
+@lru_cache(maxsize=TRANSCRIPTION_CACHE_SIZE)
+def transcribe(word: str) -> str:
+    """
+    Russian transcription of an Azerbaijani word. Every letter gets its
+    usual sound, then letters with context rules are fixed up: a rule for
+    the previous letter overrides the start of the word, a rule for the
+    next letter overrides both. Neighbours are compared as written.
+    """
+    lowered = word.lower()
+    if len(lowered) == len(word):
+        letters = lowered
+    else:
+        # lower() меняет длину у редких букв вроде İ, тогда позиции считаем по исходному слову
+        letters = [char.lower() for char in word]
+        lowered = ''.join(letter if len(letter) == 1 else '\0' for letter in letters)
+    parts = [REGULAR.get(letter, letter) for letter in letters]
+    last = len(word) - 1
+    for match in CONTEXT_LETTERS.finditer(lowered):
+        index = match.start()
+        start, after, before = CONTEXT[match.group()]
+        sound = start if index == 0 else None
+        if index > 0:
+            sound = after.get(word[index - 1], sound)
+        if index < last:
+            sound = before.get(word[index + 1], sound)
+        if sound is not None:
+            parts[index] = sound
+    return ''.join(parts)
+
+
+def transcribe_many(words):
+    return [transcribe(word) for word in words]
+
+
+def get_transcription(word):
+    return word.get('transcription') or transcribe(word['word_az'])
+
+
+async def ensure_schema():
+    for statement in SCHEMA:
+        await db.execute(statement)
+
+
+async def persist_transcriptions():
+    """
+    Fills vocabulary.transcription for words that don't have one yet.
+    """
+    rows = await db.fetchall(MISSING_TRANSCRIPTIONS_SQL)
+    if not rows:
+        return 0
+    await db.execute(SAVE_TRANSCRIPTIONS_SQL, (
+        [row['id'] for row in rows],
+        transcribe_many([row['word_az'] for row in rows]),
+    ))
+    logger.info(f'Saved transcriptions for {len(rows)} words')
+    return len(rows)
@@ -0,0 +1,103 @@
+import asyncio
+import contextvars
+import logging
+
+
+logger = logging.getLogger('user_actors')
+
+# (actor, generation) задачи, которая выполняется сейчас в этом контексте
+_current = contextvars.ContextVar('user_actor', default=None)
+
+
+class _Actor:
+    __slots__ = ('generation', 'pending', 'waiters', 'task')
+
+    def __init__(self):
+        self.generation = 0
+        self.pending = None
+        self.waiters = []
+        self.task = None
+
+
+class UserActors:
+    """
+    Serializes work per key (tg_id): at most one job runs for a user at a
+    time. Calls that arrive while a job is running are coalesced, only the
+    latest of them runs after it. A running job can call is_stale() before
+    doing anything visible and give up when a newer call has arrived.
+    """
+
+    def __init__(self):
+        self._actors = {}
+
+    async def run(self, key, job):
+        """
+        Schedules job() for key and waits until a job started after this
+        call has finished (its own one or a newer one that replaced it).
+        """
+        actor = self._actors.get(key)
+        if actor is None:
+            actor = self._actors[key] = _Actor()
+        actor.generation += 1
+        actor.pending = job
+        waiter = asyncio.get_running_loop().create_future()
+        actor.waiters.append(waiter)
+        if actor.task is None:
+            actor.task = asyncio.create_task(self._drain(key, actor))
+        await waiter
+
+    async def call(self, key, function):
+        """
+        Like run(), but re-raises in the caller what function() raised, so
+        a broadcast still sees BotBlocked and RetryAfter. Returns None when
+        a newer call replaced this one before it started.
+        """
+        outcome = {}
+
+        async def job():
+            try:
+                outcome['result'] = await function()
+            except Exception as e:
+                outcome['error'] = e
+
+        await self.run(key, job)
+        if 'error' in outcome:
+            raise outcome['error']
+        return outcome.get('result')
+
+    async def _drain(self, key, actor):
+        try:
+            while actor.pending is not None:
+                job, actor.pending = actor.pending, None
+                waiters, actor.waiters = actor.waiters, []
+                _current.set((actor, actor.generation))
+                try:
+                    await job()
+                except Exception:
+                    logger.exception(f'Job for {key} failed')
+                finally:
+                    for waiter in waiters:
+                        if not waiter.done():
+                            waiter.set_result(None)
+        finally:
+            actor.task = None
+            if actor.pending is None and self._actors.get(key) is actor:
+                del self._actors[key]
+
+    @staticmethod
+    def is_stale():
+        """
+        True inside a job when a newer call for the same key is waiting.
+        Outside of jobs always False.
+        """
+        current = _current.get()
+        if current is None:
+            return False
+        actor, generation = current
+        return actor.generation != generation
+
+    def __len__(self):
+        return len(self._actors)
+
+
+actors = UserActors()
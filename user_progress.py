@@ -0,0 +1,186 @@
+import logging
+
+import db
+
+
+logger = logging.getLogger('user_progress')
+
+# Сводка по пользователю, которую держат в актуальном виде триггеры на
+# user_vocabulary: сколько слов на каждой стадии, сколько показано в текущем
+# 6-часовом окне (ограничение в 70 слов) и в текущих сутках (топ для админов).
+# Окна «плавающие»: начинаются с первого показа и сбрасываются, когда истекли.
+# Счётчики окон считают показы, а не разные слова.
+WINDOW = "interval '6 hours'"
+DAY = "interval '24 hours'"
+
+APPLY_SQL = f'''
+    INSERT INTO user_progress AS progress (
+        user_id, unseen, plain, az_ru, ru_az, learned, max_level,
+        window_started_at, window_shown, day_started_at, day_shown, last_activity_at
+    )
+    SELECT user_id,
+        COALESCE(SUM(sign) FILTER (WHERE guess < 0), 0),
+        COALESCE(SUM(sign) FILTER (WHERE guess >= 0 AND guess < 2), 0),
+        COALESCE(SUM(sign) FILTER (WHERE guess >= 2 AND guess <= 7), 0),
+        COALESCE(SUM(sign) FILTER (WHERE guess > 7 AND guess < 10), 0),
+        COALESCE(SUM(sign) FILTER (WHERE guess >= 10), 0),
+        MAX(level) FILTER (WHERE guess >= 0 AND sign >= 0),
+        MIN(shown_at), COUNT(shown_at), MIN(shown_at), COUNT(shown_at), MAX(shown_at)
+    FROM unnest(user_ids, guesses, signs, shown, levels) AS changes (user_id, guess, sign, shown_at, level)
+    GROUP BY user_id
+    ON CONFLICT (user_id) DO UPDATE SET
+        unseen = progress.unseen + EXCLUDED.unseen,
+        plain = progress.plain + EXCLUDED.plain,
+        az_ru = progress.az_ru + EXCLUDED.az_ru,
+        ru_az = progress.ru_az + EXCLUDED.ru_az,
+        learned = progress.learned + EXCLUDED.learned,
+        max_level = GREATEST(progress.max_level, EXCLUDED.max_level),
+        window_started_at = CASE
+            WHEN EXCLUDED.window_shown = 0 OR progress.window_started_at > EXCLUDED.window_started_at - {WINDOW}
+            THEN progress.window_started_at ELSE EXCLUDED.window_started_at END,
+        window_shown = CASE
+            WHEN EXCLUDED.window_shown = 0 OR progress.window_started_at > EXCLUDED.window_started_at - {WINDOW}
+            THEN progress.window_shown + EXCLUDED.window_shown ELSE EXCLUDED.window_shown END,
+        day_started_at = CASE
+            WHEN EXCLUDED.day_shown = 0 OR progress.day_started_at > EXCLUDED.day_started_at - {DAY}
+            THEN progress.day_started_at ELSE EXCLUDED.day_started_at END,
+        day_shown = CASE
+            WHEN EXCLUDED.day_shown = 0 OR progress.day_started_at > EXCLUDED.day_started_at - {DAY}
+            THEN progress.day_shown + EXCLUDED.day_shown ELSE EXCLUDED.day_shown END,
+        last_activity_at = GREATEST(progress.last_activity_at, EXCLUDED.last_activity_at)
+'''
+
+# Строки-изменения для APPLY_SQL: +1 в новую стадию, -1 из старой,
+# shown_at — новое last_send, если слово было показано
+APPLY_CHANGES = '''
+        PERFORM user_progress_apply(
+            array_agg(changes.user_id::bigint), array_agg(changes.guesses::integer), array_agg(changes.sign),
+            array_agg(changes.shown_at::timestamp), array_agg(vocabulary.level::integer)
+        )
+        FROM ({changes}) AS changes
+        LEFT JOIN vocabulary ON vocabulary.id = changes.vocabulary_id;
+'''
+
+INSERT_CHANGES = '''
+    SELECT user_id, vocabulary_id, num_right_guesses AS guesses, 1 AS sign, last_send AS shown_at
+    FROM new_rows
+'''
+
+DELETE_CHANGES = '''
+    SELECT user_id, vocabulary_id, num_right_guesses AS guesses, -1 AS sign, NULL::timestamp AS shown_at
+    FROM old_rows
+'''
+
+UPDATE_CHANGES = '''
+    SELECT new_rows.user_id, new_rows.vocabulary_id, new_rows.num_right_guesses AS guesses,
+        CASE WHEN new_rows.num_right_guesses IS DISTINCT FROM old_rows.num_right_guesses THEN 1 ELSE 0 END AS sign,
+        CASE WHEN new_rows.last_send IS DISTINCT FROM old_rows.last_send THEN new_rows.last_send END AS shown_at
+    FROM new_rows JOIN old_rows ON new_rows.id = old_rows.id
+    WHERE new_rows.num_right_guesses IS DISTINCT FROM old_rows.num_right_guesses
+        OR new_rows.last_send IS DISTINCT FROM old_rows.last_send
+    UNION ALL
+    SELECT old_rows.user_id, old_rows.vocabulary_id, old_rows.num_right_guesses, -1, NULL
+    FROM new_rows JOIN old_rows ON new_rows.id = old_rows.id
+    WHERE new_rows.num_right_guesses IS DISTINCT FROM old_rows.num_right_guesses
+'''
+
+SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS user_progress (
+        user_id bigint PRIMARY KEY,
+        unseen integer NOT NULL DEFAULT 0,
+        plain integer NOT NULL DEFAULT 0,
+        az_ru integer NOT NULL DEFAULT 0,
+        ru_az integer NOT NULL DEFAULT 0,
+        learned integer NOT NULL DEFAULT 0,
+        max_level integer,
+        window_started_at timestamp,
+        window_shown integer NOT NULL DEFAULT 0,
+        day_started_at timestamp,
+        day_shown integer NOT NULL DEFAULT 0,
+        last_activity_at timestamp
+    )
+    ''',
+    f'''
+    CREATE OR REPLACE FUNCTION user_progress_apply(
+        user_ids bigint[], guesses integer[], signs integer[], shown timestamp[], levels integer[]
+    ) RETURNS void
+    LANGUAGE sql AS $$
+        {APPLY_SQL}
+    $$
+    ''',
+    f'''
+    CREATE OR REPLACE FUNCTION user_progress_count() RETURNS trigger
+    LANGUAGE plpgsql AS $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            {APPLY_CHANGES.format(changes=INSERT_CHANGES)}
+        ELSIF TG_OP = 'UPDATE' THEN
+            {APPLY_CHANGES.format(changes=UPDATE_CHANGES)}
+        ELSE
+            {APPLY_CHANGES.format(changes=DELETE_CHANGES)}
+        END IF;
+        RETURN NULL;
+    END
+    $$
+    ''',
+    # Триггер с transition tables может реагировать только на одно событие
+    'DROP TRIGGER IF EXISTS user_progress_insert ON user_vocabulary',
+    '''
+    CREATE TRIGGER user_progress_insert
+    AFTER INSERT ON user_vocabulary
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION user_progress_count()
+    ''',
+    'DROP TRIGGER IF EXISTS user_progress_update ON user_vocabulary',
+    '''
+    CREATE TRIGGER user_progress_update
+    AFTER UPDATE ON user_vocabulary
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION user_progress_count()
+    ''',
+    'DROP TRIGGER IF EXISTS user_progress_delete ON user_vocabulary',
+    '''
+    CREATE TRIGGER user_progress_delete
+    AFTER DELETE ON user_vocabulary
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION user_progress_count()
+    ''',
+]
+
+# Пользователи, у которых сводки ещё нет, считаются по user_vocabulary целиком
+BACKFILL_SQL = f'''
+    INSERT INTO user_progress (
+        user_id, unseen, plain, az_ru, ru_az, learned, max_level,
+        window_started_at, window_shown, day_started_at, day_shown, last_activity_at
+    )
+    SELECT user_id,
+        COUNT(*) FILTER (WHERE num_right_guesses < 0),
+        COUNT(*) FILTER (WHERE num_right_guesses >= 0 AND num_right_guesses < 2),
+        COUNT(*) FILTER (WHERE num_right_guesses >= 2 AND num_right_guesses <= 7),
+        COUNT(*) FILTER (WHERE num_right_guesses > 7 AND num_right_guesses < 10),
+        COUNT(*) FILTER (WHERE num_right_guesses >= 10),
+        MAX(vocabulary.level) FILTER (WHERE num_right_guesses >= 0),
+        MIN(last_send) FILTER (WHERE last_send > NOW() - {WINDOW}),
+        COUNT(*) FILTER (WHERE last_send > NOW() - {WINDOW}),
+        MIN(last_send) FILTER (WHERE last_send > NOW() - {DAY}),
+        COUNT(*) FILTER (WHERE last_send > NOW() - {DAY}),
+        MAX(last_send)
+    FROM user_vocabulary
+    LEFT JOIN vocabulary ON vocabulary.id = user_vocabulary.vocabulary_id
+    WHERE NOT EXISTS (SELECT 1 FROM user_progress WHERE user_progress.user_id = user_vocabulary.user_id)
+    GROUP BY user_id
+'''
+
+
+async def ensure_schema():
+    """
+    Creates user_progress with its triggers and fills it for users that
+    don't have a row yet, in one transaction so no update slips between.
+    """
+    async with db.transaction() as conn:
+        for statement in SCHEMA:
+            await conn.execute(statement)
+        cursor = await conn.execute(BACKFILL_SQL)
+        if cursor.rowcount:
+            logger.info(f'Backfilled progress counters for {cursor.rowcount} users')
@@ -0,0 +1,41 @@
+import logging
+
+import db
+from identity import TARGET_SQL, identities
+from progress_buffer import progress
+
+
+logger = logging.getLogger('user_stats')
+
+# Счётчики по стадиям ведёт user_progress, здесь только читаем их
+STATISTICS_SQL = '''
+    SELECT users.tg_id, users.id AS user_id,
+        COALESCE(user_progress.max_level, 0) AS max_level,
+        COALESCE(user_progress.learned, 0) AS learned,
+        COALESCE(user_progress.az_ru + user_progress.ru_az, 0) AS active,
+        COALESCE(user_progress.plain, 0) AS new
+    FROM ({target}) AS users
+    LEFT JOIN user_progress ON user_progress.user_id = users.id
+'''
+
+ACTIVE_USERS_STATISTICS_SQL = STATISTICS_SQL.format(target='SELECT id, tg_id FROM users WHERE is_blocked = false')
+USERS_STATISTICS_SQL = STATISTICS_SQL.format(target=TARGET_SQL)
+
+
+async def collect_statistics(tg_ids=None):
+    """
+    Learned / active / new word counts and the level of many users from
+    the user_progress counters. Without tg_ids covers every non-blocked user (the daily
+    report). Users without words get zeros. Returns tg_id -> row.
+    """
+    await progress.flush(tg_ids)
+    if tg_ids is None:
+        rows = await db.fetchall(ACTIVE_USERS_STATISTICS_SQL)
+    else:
+        known = await identities.resolve(tg_ids)
+        rows = await db.fetchall(USERS_STATISTICS_SQL, {
+            'tg_ids': list(known),
+            'user_ids': [identity.id for identity in known.values()],
+        }) if known else []
+    logger.info(f'Collected statistics for {len(rows)} users')
+    return {row['tg_id']: row for row in rows}
@@ -0,0 +1,90 @@
+import hmac
+import logging
+import multiprocessing
+import signal
+import sys
+
+from aiogram.utils import executor
+from aiohttp import web
+
+from settings import WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_WORKERS
+
+
+logger = logging.getLogger('webhook')
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+def secret_token_middleware(secret):
+    @web.middleware
+    async def check_secret_token(request, handler):
+        if not hmac.compare_digest(request.headers.get(SECRET_HEADER, ''), secret):
+            logger.warning(f'Rejected webhook request from {request.remote}: wrong secret token')
+            raise web.HTTPForbidden()
+        return await handler(request)
+    return check_secret_token
+
+
+def make_app(secret=WEBHOOK_SECRET):
+    middlewares = [secret_token_middleware(secret)] if secret else []
+    return web.Application(middlewares=middlewares)
+
+
+async def register_webhook(dp):
+    if not WEBHOOK_URL:
+        logger.info('WEBHOOK_URL is not set, expecting the webhook to be registered already')
+        return
+    await dp.bot.set_webhook(WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET or None)
+    logger.info(f'Webhook registered at {WEBHOOK_URL}')
+
+
+def run_worker(dispatcher, on_startup, on_shutdown, primary_startup=(), worker=0):
+    startup = list(on_startup)
+    if worker == 0:
+        startup += [register_webhook, *primary_startup]
+    logger.info(f'Webhook worker {worker} listening on {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}')
+    webhook_executor = executor.set_webhook(
+        dispatcher,
+        WEBHOOK_PATH,
+        skip_updates=False,
+        on_startup=startup,
+        on_shutdown=list(on_shutdown),
+        web_app=make_app(),
+    )
+    webhook_executor.run_app(host=WEBHOOK_HOST, port=WEBHOOK_PORT, reuse_port=WEBHOOK_WORKERS > 1, print=None)
+
+
+def run(dispatcher, on_startup=(), on_shutdown=(), primary_startup=(), workers=WEBHOOK_WORKERS):
+    """
+    Serves Telegram updates over a webhook. With several workers every
+    process binds the same port with SO_REUSEPORT, so a local reverse proxy
+    can point at one address. Only worker 0 registers the webhook and runs
+    primary_startup callbacks (the scheduler), the others just handle
+    updates. SIGINT / SIGTERM shut the workers down through aiohttp, so
+    on_shutdown callbacks still run.
+    """
+    if workers <= 1:
+        run_worker(dispatcher, on_startup, on_shutdown, primary_startup)
+        return
+    processes = [
+        multiprocessing.Process(
+            target=run_worker,
+            args=(dispatcher, on_startup, on_shutdown, primary_startup, worker),
+            name=f'webhook-worker-{worker}',
+        )
+        for worker in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        for process in processes:
+            process.join()
+    except (KeyboardInterrupt, SystemExit):
+        logger.info('Stopping webhook workers')
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        for process in processes:
+            process.join()